@@ -3,17 +3,29 @@ import json
 import re
 import time
 import csv
+import math
+import copy
 import hashlib
 import base64
+import zlib
+import pickle
+import struct
+import mmap
+import sys
 import threading
 import functools
 import schedule
 import atexit
-from collections import defaultdict
+import socket
+import sqlite3
+import fcntl
+from collections import defaultdict, OrderedDict, deque
+from collections.abc import Mapping
+from abc import ABC, abstractmethod
 from urllib.parse import quote, urlencode
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List, Tuple
-from io import BytesIO
+from io import BytesIO, BufferedReader, RawIOBase, StringIO, TextIOWrapper
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
@@ -161,13 +173,82 @@ def start_facebook_worker():
 # ============================================
 # GLOBAL LOCKS
 # ============================================
-POSTBACK_LOCKS = {}
+class UserLease:
+    """
+    Khóa theo (user, scope). Chỉ tồn tại trong USER_LEASES khi còn thread đang giữ
+    hoặc đang chờ, nên số lock trong RAM tỉ lệ với số user đang xử lý, không tăng mãi.
+    Dùng với `with` hoặc gọi release() khi xong.
+    """
+    __slots__ = ("key", "lock", "refs")
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.refs = 0
+
+    def release(self):
+        self.lock.release()
+        _return_user_lease(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+USER_LEASES = {}
+USER_LEASES_LOCK = threading.Lock()
+USER_LEASE_STATS = {
+    'acquired': 0,
+    'busy': 0,
+    'peak_active': 0
+}
+
+def _borrow_user_lease(key: str) -> UserLease:
+    with USER_LEASES_LOCK:
+        lease = USER_LEASES.get(key)
+        if lease is None:
+            lease = UserLease(key)
+            USER_LEASES[key] = lease
+            if len(USER_LEASES) > USER_LEASE_STATS['peak_active']:
+                USER_LEASE_STATS['peak_active'] = len(USER_LEASES)
+        lease.refs += 1
+        return lease
+
+def _return_user_lease(lease: UserLease):
+    with USER_LEASES_LOCK:
+        lease.refs -= 1
+        if lease.refs <= 0 and USER_LEASES.get(lease.key) is lease:
+            del USER_LEASES[lease.key]
+
+def acquire_user_lease(uid: str, scope: str = "default", timeout: float = -1) -> Optional[UserLease]:
+    """
+    Lấy lease cho user. timeout = -1: chờ đến khi được, 0: không chờ.
+    Trả về None nếu không lấy được trong thời gian chờ.
+    """
+    lease = _borrow_user_lease(f"{uid}:{scope}")
+    if timeout == 0:
+        acquired = lease.lock.acquire(blocking=False)
+    else:
+        acquired = lease.lock.acquire(timeout=timeout)
+    
+    if acquired:
+        USER_LEASE_STATS['acquired'] += 1
+        return lease
+    
+    USER_LEASE_STATS['busy'] += 1
+    _return_user_lease(lease)
+    return None
 
-def get_postback_lock(uid: str, payload: str):
-    key = f"{uid}_{payload}"
-    if key not in POSTBACK_LOCKS:
-        POSTBACK_LOCKS[key] = threading.Lock()
-    return POSTBACK_LOCKS[key]
+def try_acquire_user_lease(uid: str, scope: str = "default") -> Optional[UserLease]:
+    """Lấy lease nếu đang rảnh, ngược lại trả về None ngay"""
+    return acquire_user_lease(uid, scope, timeout=0)
+
+def get_user_lease_stats() -> dict:
+    stats = dict(USER_LEASE_STATS)
+    stats['active'] = len(USER_LEASES)
+    return stats
 
 # ============================================
 # OPENAI CLIENT
@@ -178,6 +259,57 @@ client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 # PERSISTENT STORAGE FOR USER_CONTEXT - GOOGLE SHEETS
 # ============================================
 
+# Mã hóa gọn cho các cột JSON lớn (product_history, order_data, conversation_history):
+# JSON compact -> zlib -> base64, có tiền tố phiên bản. Ô không có tiền tố là JSON cũ.
+CONTEXT_CODEC_PREFIX = "z1:"
+CONTEXT_CODEC_MIN_BYTES = 256  # JSON ngắn hơn giữ nguyên (đọc được trực tiếp trên sheet)
+
+CONTEXT_CODEC_STATS = {
+    'encoded': 0,
+    'compressed': 0,
+    'json_bytes': 0,       # dung lượng nếu ghi JSON như trước
+    'written_bytes': 0,    # dung lượng thực ghi lên sheet
+    'decoded': 0,
+    'decoded_legacy': 0,
+    'read_bytes': 0,       # dung lượng ô đọc từ sheet
+    'decoded_json_bytes': 0
+}
+
+def encode_context_column(value) -> str:
+    """Mã hóa giá trị 1 cột JSON của sheet UserContext"""
+    legacy = json.dumps(value, ensure_ascii=False)
+    payload = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    encoded = legacy
+    if len(payload) >= CONTEXT_CODEC_MIN_BYTES:
+        packed = CONTEXT_CODEC_PREFIX + base64.b64encode(zlib.compress(payload, 9)).decode("ascii")
+        if len(packed) < len(payload):
+            encoded = packed
+            CONTEXT_CODEC_STATS['compressed'] += 1
+    CONTEXT_CODEC_STATS['encoded'] += 1
+    CONTEXT_CODEC_STATS['json_bytes'] += len(legacy.encode("utf-8"))
+    CONTEXT_CODEC_STATS['written_bytes'] += len(encoded.encode("utf-8"))
+    return encoded
+
+def decode_context_column(cell: str):
+    """Giải mã 1 ô JSON của sheet UserContext (cả dạng nén mới lẫn JSON cũ)"""
+    CONTEXT_CODEC_STATS['decoded'] += 1
+    CONTEXT_CODEC_STATS['read_bytes'] += len(cell.encode("utf-8"))
+    if cell.startswith(CONTEXT_CODEC_PREFIX):
+        payload = zlib.decompress(base64.b64decode(cell[len(CONTEXT_CODEC_PREFIX):])).decode("utf-8")
+    else:
+        payload = cell
+        CONTEXT_CODEC_STATS['decoded_legacy'] += 1
+    CONTEXT_CODEC_STATS['decoded_json_bytes'] += len(payload.encode("utf-8"))
+    return json.loads(payload)
+
+def get_context_codec_stats() -> dict:
+    stats = dict(CONTEXT_CODEC_STATS)
+    if stats['json_bytes']:
+        stats['write_ratio'] = round(stats['written_bytes'] / stats['json_bytes'], 3)
+    if stats['decoded_json_bytes']:
+        stats['read_ratio'] = round(stats['read_bytes'] / stats['decoded_json_bytes'], 3)
+    return stats
+
 # Không dùng file JSON nữa, dùng Google Sheets làm database
 def init_user_context_sheet():
     """Khởi tạo sheet UserContext nếu chưa tồn tại"""
@@ -192,7 +324,7 @@ def init_user_context_sheet():
             return False
         
         # Lấy thông tin tất cả sheets
-        spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
+        spreadsheet = sheets_execute(service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID))
         sheets = spreadsheet.get('sheets', [])
         
         # Kiểm tra xem sheet UserContext đã tồn tại chưa
@@ -218,10 +350,10 @@ def init_user_context_sheet():
                 }
             }]
             
-            service.spreadsheets().batchUpdate(
+            sheets_execute(service.spreadsheets().batchUpdate(
                 spreadsheetId=GOOGLE_SHEET_ID,
                 body={'requests': requests}
-            ).execute()
+            ), SHEETS_PRIORITY_BACKGROUND)
             
             # Đợi một chút để sheet được tạo
             time.sleep(2)
@@ -234,12 +366,12 @@ def init_user_context_sheet():
                  'last_msg_time', 'has_sent_first_carousel']
             ]
             
-            service.spreadsheets().values().update(
+            sheets_execute(service.spreadsheets().values().update(
                 spreadsheetId=GOOGLE_SHEET_ID,
                 range=f"{USER_CONTEXT_SHEET_NAME}!A1:L1",
                 valueInputOption="USER_ENTERED",
                 body={'values': headers}
-            ).execute()
+            ), SHEETS_PRIORITY_BACKGROUND)
             
             print(f"[INIT SHEET] Đã tạo sheet {USER_CONTEXT_SHEET_NAME} thành công")
             return True
@@ -265,10 +397,10 @@ def save_user_context_to_sheets():
         
         # Lấy tất cả dữ liệu hiện tại từ sheet
         try:
-            result = service.spreadsheets().values().get(
+            result = sheets_execute(service.spreadsheets().values().get(
                 spreadsheetId=GOOGLE_SHEET_ID,
                 range=f"{USER_CONTEXT_SHEET_NAME}!A2:L"
-            ).execute()
+            ), SHEETS_PRIORITY_BACKGROUND)
             existing_values = result.get('values', [])
         except Exception as e:
             print(f"[SAVE CONTEXT] Lỗi khi lấy dữ liệu cũ: {e}")
@@ -300,9 +432,9 @@ def save_user_context_to_sheets():
                 context["last_updated"] = time.time()
             
             # Chuẩn bị dữ liệu
-            product_history = json.dumps(context.get("product_history", []), ensure_ascii=False)
-            order_data = json.dumps(context.get("order_data", {}), ensure_ascii=False)
-            conversation_history = json.dumps(context.get("conversation_history", []), ensure_ascii=False)
+            product_history = encode_context_column(context.get("product_history", []))
+            order_data = encode_context_column(context.get("order_data", {}))
+            conversation_history = encode_context_column(context.get("conversation_history", []))
             
             # Lấy số điện thoại và tên từ order_data
             phone = ""
@@ -355,9 +487,9 @@ def save_user_context_to_sheets():
             # Kiểm tra user_id đã có trong user_row_map chưa
             if user_id not in user_row_map:
                 # Chuẩn bị row data cho user mới
-                product_history = json.dumps(context.get("product_history", []), ensure_ascii=False)
-                order_data = json.dumps(context.get("order_data", {}), ensure_ascii=False)
-                conversation_history = json.dumps(context.get("conversation_history", []), ensure_ascii=False)
+                product_history = encode_context_column(context.get("product_history", []))
+                order_data = encode_context_column(context.get("order_data", {}))
+                conversation_history = encode_context_column(context.get("conversation_history", []))
                 
                 phone = ""
                 customer_name = ""
@@ -394,12 +526,12 @@ def save_user_context_to_sheets():
             # Cập nhật các dòng hiện có
             for update_req in update_requests:
                 try:
-                    service.spreadsheets().values().update(
+                    sheets_execute(service.spreadsheets().values().update(
                         spreadsheetId=GOOGLE_SHEET_ID,
                         range=update_req['range'],
                         valueInputOption="USER_ENTERED",
                         body={'values': update_req['values']}
-                    ).execute()
+                    ), SHEETS_PRIORITY_BACKGROUND)
                 except Exception as e:
                     print(f"[CONTEXT UPDATE ERROR] Lỗi khi cập nhật user: {e}")
             
@@ -410,13 +542,13 @@ def save_user_context_to_sheets():
                     start_row = len(existing_values) + 2  # +2 vì bắt đầu từ row 2
                     range_name = f"{USER_CONTEXT_SHEET_NAME}!A{start_row}"
                     
-                    service.spreadsheets().values().append(
+                    sheets_execute(service.spreadsheets().values().append(
                         spreadsheetId=GOOGLE_SHEET_ID,
                         range=range_name,
                         valueInputOption="USER_ENTERED",
                         insertDataOption="INSERT_ROWS",
                         body={'values': new_rows}
-                    ).execute()
+                    ), SHEETS_PRIORITY_BACKGROUND)
                     
                     print(f"[CONTEXT SAVE] Đã thêm {len(new_rows)} users mới")
                 except Exception as e:
@@ -432,136 +564,19 @@ def save_user_context_to_sheets():
         traceback.print_exc()
 
 def cleanup_inactive_users():
-    """Dọn dẹp users không hoạt động để giảm RAM"""
-    now = time.time()
+    """
+    Dọn dẹp users không hoạt động để giảm RAM.
+    USER_CONTEXT giữ thứ tự LRU nên chỉ duyệt các user ở đầu danh sách;
+    user dirty bị đẩy ra được chuyển sang write-behind, không lưu Sheets tại chỗ.
+    Giới hạn tổng RAM do chính USER_CONTEXT đảm nhiệm (CONTEXT_HOT_MEMORY_MB).
+    """
     inactive_threshold = 86400  # 24 giờ
-    max_users = 1000  # Giới hạn số users trong RAM
     
-    users_to_remove = []
-    
-    for user_id, context in USER_CONTEXT.items():
-        last_updated = context.get("last_updated", 0)
-        if now - last_updated > inactive_threshold:
-            # Lưu context trước khi xóa nếu dirty
-            if context.get("dirty", False):
-                try:
-                    # Lưu riêng user này
-                    save_single_user_to_sheets(user_id, context)
-                except Exception as e:
-                    print(f"[CLEANUP SAVE ERROR] Lỗi khi lưu user {user_id}: {e}")
-            users_to_remove.append(user_id)
-    
-    # Xóa users không hoạt động
-    for user_id in users_to_remove:
-        del USER_CONTEXT[user_id]
-    
-    # Giới hạn số lượng users trong RAM
-    if len(USER_CONTEXT) > max_users:
-        # Lấy danh sách users cũ nhất
-        sorted_users = sorted(
-            USER_CONTEXT.items(),
-            key=lambda x: x[1].get("last_updated", 0)
-        )
-        
-        # Xóa users cũ nhất vượt quá giới hạn
-        for i in range(len(USER_CONTEXT) - max_users):
-            user_id, context = sorted_users[i]
-            if context.get("dirty", False):
-                try:
-                    save_single_user_to_sheets(user_id, context)
-                except Exception as e:
-                    print(f"[LIMIT CLEANUP ERROR] Lỗi khi lưu user {user_id}: {e}")
-            del USER_CONTEXT[user_id]
+    removed = USER_CONTEXT.evict_idle(inactive_threshold)
     
-    if users_to_remove:
-        print(f"[CLEANUP] Đã xóa {len(users_to_remove)} users không hoạt động")
+    if removed:
+        print(f"[CLEANUP] Đã xóa {removed} users không hoạt động khỏi RAM")
 
-def save_single_user_to_sheets(user_id: str, context: dict = None):
-    """Lưu riêng 1 user vào Google Sheets NGAY LẬP TỨC"""
-    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
-        print("[IMMEDIATE SAVE] Chưa cấu hình Google Sheets, bỏ qua")
-        return
-    
-    try:
-        # Nếu không truyền context, lấy từ USER_CONTEXT
-        if context is None:
-            if user_id not in USER_CONTEXT:
-                print(f"[IMMEDIATE SAVE] User {user_id} không tồn tại trong USER_CONTEXT")
-                return
-            context = USER_CONTEXT[user_id]
-        
-        service = get_google_sheets_service()
-        if not service:
-            print("[IMMEDIATE SAVE] Không thể khởi tạo Google Sheets service")
-            return
-        
-        # Lấy dữ liệu từ cache
-        user_row_map, existing_values = get_sheet_data_cached()
-        
-        # Chuẩn bị dữ liệu
-        product_history = json.dumps(context.get("product_history", []), ensure_ascii=False)
-        order_data = json.dumps(context.get("order_data", {}), ensure_ascii=False)
-        conversation_history = json.dumps(context.get("conversation_history", []), ensure_ascii=False)
-        
-        phone = ""
-        customer_name = ""
-        if context.get("order_data"):
-            phone = context["order_data"].get("phone", "")
-            customer_name = context["order_data"].get("customer_name", "")
-        
-        row_data = [
-            user_id,
-            context.get("last_ms", ""),
-            product_history,
-            order_data,
-            conversation_history,
-            str(context.get("real_message_count", 0)),
-            context.get("referral_source", ""),
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            phone,
-            customer_name,
-            str(context.get("last_msg_time", 0)),
-            str(context.get("has_sent_first_carousel", False))
-        ]
-        
-        # Kiểm tra xem user đã có trong sheet chưa
-        if user_id in user_row_map:
-            range_name = f"{USER_CONTEXT_SHEET_NAME}!A{user_row_map[user_id]}:L{user_row_map[user_id]}"
-            
-            service.spreadsheets().values().update(
-                spreadsheetId=GOOGLE_SHEET_ID,
-                range=range_name,
-                valueInputOption="USER_ENTERED",
-                body={'values': [row_data]}
-            ).execute()
-            
-            print(f"[IMMEDIATE SAVE] Đã cập nhật user {user_id} với MS {context.get('last_ms')}")
-        else:
-            # Thêm dòng mới
-            start_row = len(existing_values) + 2
-            range_name = f"{USER_CONTEXT_SHEET_NAME}!A{start_row}"
-            
-            service.spreadsheets().values().append(
-                spreadsheetId=GOOGLE_SHEET_ID,
-                range=range_name,
-                valueInputOption="USER_ENTERED",
-                insertDataOption="INSERT_ROWS",
-                body={'values': [row_data]}
-            ).execute()
-            
-            # Reset cache
-            SHEETS_CACHE['last_read'] = 0
-            
-            print(f"[IMMEDIATE SAVE] Đã thêm mới user {user_id} với MS {context.get('last_ms')}")
-        
-        # Reset dirty flag và cập nhật thời gian lưu
-        if user_id in USER_CONTEXT:
-            USER_CONTEXT[user_id]["dirty"] = False
-            USER_CONTEXT[user_id]["last_saved"] = time.time()
-        
-    except Exception as e:
-        print(f"[IMMEDIATE SAVE ERROR] Lỗi khi lưu user {user_id}: {e}")
-        
 def save_user_context_to_sheets_optimized(force_all: bool = False):
     """
     Lưu USER_CONTEXT vào Google Sheets - CHỈ lưu users có dirty = True
@@ -571,6 +586,8 @@ def save_user_context_to_sheets_optimized(force_all: bool = False):
         print("[SAVE CONTEXT] Chưa cấu hình Google Sheets")
         return
     
+    # Compaction (kể cả ở worker khác) không được xóa/dịch dòng giữa lúc lấy vị trí và lúc ghi
+    lock_sheet_layout()
     try:
         service = get_google_sheets_service()
         if not service:
@@ -583,6 +600,7 @@ def save_user_context_to_sheets_optimized(force_all: bool = False):
         # Chuẩn bị dữ liệu để lưu
         update_requests = []
         new_rows = []
+        saved_contexts = []
         
         now = time.time()
         save_threshold = 30  # Chỉ lưu nếu chưa lưu trong 30 giây
@@ -613,52 +631,21 @@ def save_user_context_to_sheets_optimized(force_all: bool = False):
             
             print(f"[CONTEXT SAVE] Đang lưu user {user_id} (dirty={context.get('dirty')})")
             
-            # Chuẩn bị dữ liệu
-            product_history = json.dumps(context.get("product_history", []), ensure_ascii=False)
-            order_data = json.dumps(context.get("order_data", {}), ensure_ascii=False)
-            conversation_history = json.dumps(context.get("conversation_history", []), ensure_ascii=False)
-            
-            # Lấy số điện thoại và tên từ order_data
-            phone = ""
-            customer_name = ""
-            if context.get("order_data"):
-                phone = context["order_data"].get("phone", "")
-                customer_name = context["order_data"].get("customer_name", "")
-            
-            # Lấy các trường khác
-            last_ms = context.get("last_ms", "")
-            last_msg_time = context.get("last_msg_time", 0)
-            real_message_count = context.get("real_message_count", 0)
-            referral_source = context.get("referral_source", "")
-            has_sent_first_carousel = context.get("has_sent_first_carousel", False)
-            
-            # Chuẩn bị row data (12 cột)
-            row_data = [
-                user_id,  # Cột A: user_id
-                last_ms,  # Cột B: last_ms
-                product_history,  # Cột C: product_history
-                order_data,  # Cột D: order_data
-                conversation_history,  # Cột E: conversation_history
-                str(real_message_count),  # Cột F: real_message_count
-                referral_source,  # Cột G: referral_source
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # Cột H: last_updated
-                phone,  # Cột I: phone
-                customer_name,  # Cột J: customer_name
-                str(last_msg_time),  # Cột K: last_msg_time
-                str(has_sent_first_carousel)  # Cột L: has_sent_first_carousel
-            ]
-            
             # Kiểm tra xem user đã có trong sheet chưa
             if user_id in user_row_map:
-                # Cập nhật dòng hiện có
-                range_name = f"{USER_CONTEXT_SHEET_NAME}!A{user_row_map[user_id]}:L{user_row_map[user_id]}"
-                update_requests.append({
-                    'range': range_name,
-                    'values': [row_data]
-                })
+                # Cập nhật dòng hiện có: chỉ các ô đã thay đổi, cả dòng khi lưu full
+                changes = take_context_changes(context)
+                if force_all or last_saved == 0:
+                    changes = None
+                update_requests.extend(build_context_update_data(
+                    user_id, context, user_row_map[user_id], changes
+                ))
             else:
-                # Thêm dòng mới
-                new_rows.append(row_data)
+                # Thêm dòng mới (12 cột)
+                if hasattr(context, "mark_clean"):
+                    context.mark_clean()
+                new_rows.append(build_context_row(user_id, context))
+            saved_contexts.append(context)
             
             # Đánh dấu đã lưu và reset dirty flag
             context["dirty"] = False
@@ -683,34 +670,27 @@ def save_user_context_to_sheets_optimized(force_all: bool = False):
                         'data': batch_data
                     }
                     
-                    service.spreadsheets().values().batchUpdate(
+                    sheets_execute(service.spreadsheets().values().batchUpdate(
                         spreadsheetId=GOOGLE_SHEET_ID,
                         body=body
-                    ).execute()
+                    ), SHEETS_PRIORITY_BACKGROUND)
                     
-                    print(f"[CONTEXT SAVE] Đã batch update {len(update_requests)} users")
+                    print(f"[CONTEXT SAVE] Đã batch update {len(update_requests)} ranges")
                 except Exception as e:
                     print(f"[CONTEXT UPDATE ERROR] Lỗi batch update: {e}")
+                    # Lần sau ghi lại cả dòng cho các user chưa lưu được
+                    for context in saved_contexts:
+                        context["dirty"] = True
+                        if hasattr(context, "mark_all_changed"):
+                            context.mark_all_changed()
             
             # Append các dòng mới
             if new_rows:
                 try:
-                    start_row = len(existing_values) + 2
-                    range_name = f"{USER_CONTEXT_SHEET_NAME}!A{start_row}"
-                    
-                    service.spreadsheets().values().append(
-                        spreadsheetId=GOOGLE_SHEET_ID,
-                        range=range_name,
-                        valueInputOption="USER_ENTERED",
-                        insertDataOption="INSERT_ROWS",
-                        body={'values': new_rows}
-                    ).execute()
+                    append_context_rows(service, new_rows)
                     
                     print(f"[CONTEXT SAVE] Đã thêm {len(new_rows)} users mới")
                     
-                    # Cập nhật cache sau khi thêm mới
-                    SHEETS_CACHE['last_read'] = 0  # Reset cache để load lại
-                    
                 except Exception as e:
                     print(f"[CONTEXT APPEND ERROR] Lỗi khi thêm users mới: {e}")
             
@@ -722,6 +702,8 @@ def save_user_context_to_sheets_optimized(force_all: bool = False):
         print(f"[CONTEXT SAVE ERROR] Lỗi khi lưu context: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        unlock_sheet_layout()
 
 # Thay thế hàm cũ bằng hàm tối ưu
 def save_user_context_to_sheets():
@@ -740,10 +722,10 @@ def load_user_context_from_sheets():
             return
         
         # Lấy dữ liệu từ sheet (KHÔNG load header)
-        result = service.spreadsheets().values().get(
+        result = sheets_execute(service.spreadsheets().values().get(
             spreadsheetId=GOOGLE_SHEET_ID,
             range=f"{USER_CONTEXT_SHEET_NAME}!A2:L"
-        ).execute()
+        ), SHEETS_PRIORITY_BACKGROUND)
         
         values = result.get('values', [])
         
@@ -777,21 +759,21 @@ def load_user_context_from_sheets():
             # Cột 3: product_history
             if len(row) > 2 and row[2]:
                 try:
-                    context["product_history"] = json.loads(row[2])
+                    context["product_history"] = decode_context_column(row[2])
                 except:
                     context["product_history"] = []
             
             # Cột 4: order_data
             if len(row) > 3 and row[3]:
                 try:
-                    context["order_data"] = json.loads(row[3])
+                    context["order_data"] = decode_context_column(row[3])
                 except:
                     context["order_data"] = {}
             
             # Cột 5: conversation_history
             if len(row) > 4 and row[4]:
                 try:
-                    context["conversation_history"] = json.loads(row[4])
+                    context["conversation_history"] = decode_context_column(row[4])
                 except:
                     context["conversation_history"] = []
             
@@ -842,8 +824,10 @@ def load_user_context_from_sheets():
                 except:
                     context["has_sent_first_carousel"] = False
             
-            # Lưu context vào USER_CONTEXT
+            # Lưu context vào USER_CONTEXT (vừa load, chưa có gì thay đổi)
+            context.mark_clean()
             USER_CONTEXT[user_id] = context
+            index_user_contact(user_id, context.get("order_data"))
             loaded_count += 1
         
         print(f"[CONTEXT LOADED] Đã load {loaded_count} users từ Google Sheets")
@@ -858,16 +842,25 @@ def get_user_context_from_sheets(user_id: str) -> Optional[Dict]:
     if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
         return None
     
+    # User vừa bị xóa, dòng cũ chưa được compaction dọn
+    if is_context_tombstoned(user_id):
+        return None
+    
+    # Khách nhắn lần đầu: filter khẳng định chưa có -> không đọc Sheets
+    if not might_exist_in_sheets(user_id):
+        print(f"[GET CONTEXT] User {user_id} chưa từng có trên Google Sheets, bỏ qua đọc sheet")
+        return None
+    
     try:
         service = get_google_sheets_service()
         if not service:
             return None
         
         # Lấy tất cả dữ liệu
-        result = service.spreadsheets().values().get(
+        result = sheets_execute(service.spreadsheets().values().get(
             spreadsheetId=GOOGLE_SHEET_ID,
             range=f"{USER_CONTEXT_SHEET_NAME}!A2:L"
-        ).execute()
+        ), SHEETS_PRIORITY_LOOKUP)
         
         values = result.get('values', [])
         
@@ -886,7 +879,7 @@ def get_user_context_from_sheets(user_id: str) -> Optional[Dict]:
                 
                 if len(row) > 2 and row[2]:
                     try:
-                        context["product_history"] = json.loads(row[2])
+                        context["product_history"] = decode_context_column(row[2])
                         print(f"[GET CONTEXT DEBUG] product_history: {context['product_history'][:3] if context['product_history'] else '[]'}")
                     except:
                         context["product_history"] = []
@@ -894,13 +887,13 @@ def get_user_context_from_sheets(user_id: str) -> Optional[Dict]:
                 
                 if len(row) > 3 and row[3]:
                     try:
-                        context["order_data"] = json.loads(row[3])
+                        context["order_data"] = decode_context_column(row[3])
                     except:
                         context["order_data"] = {}
                 
                 if len(row) > 4 and row[4]:
                     try:
-                        context["conversation_history"] = json.loads(row[4])
+                        context["conversation_history"] = decode_context_column(row[4])
                     except:
                         context["conversation_history"] = []
                 
@@ -943,133 +936,879 @@ def get_user_context_from_sheets(user_id: str) -> Optional[Dict]:
                 
                 print(f"[GET CONTEXT] Đã load context cho user {user_id} từ Google Sheets")
                 print(f"[GET CONTEXT SUMMARY] last_ms: {context.get('last_ms')}, product_history count: {len(context.get('product_history', []))}")
+                context.mark_clean()
+                index_user_contact(user_id, context.get("order_data"))
                 return context
         
         print(f"[GET CONTEXT] Không tìm thấy context cho user {user_id} trong Google Sheets")
+        remember_missing_identity(user_id)
         return None
         
     except Exception as e:
         print(f"[GET CONTEXT ERROR] Lỗi khi load context cho user {user_id}: {e}")
         return None
 
-def delete_user_context_from_sheets(user_id: str):
-    """Xóa context của user khỏi Google Sheets (khi cần)"""
+# ============================================
+# XÓA + COMPACTION SHEET USERCONTEXT
+# Xóa user = ghi tombstone; compaction gom dòng trùng/tombstone/dòng trống
+# vào 1 batchUpdate deleteDimension duy nhất.
+# Sheet dùng chung giữa các worker: tombstone + version bố cục dòng nằm trong SQLite dùng chung,
+# ghi theo số dòng giữ khóa shared, compaction giữ khóa exclusive (flock)
+# ============================================
+
+CONTEXT_COMPACTION = {
+    'db_path': os.getenv("CONTEXT_DB_PATH", "user_context.db"),  # rỗng -> chỉ 1 process, giữ trong RAM
+    'tombstones': set(),   # chỉ dùng khi không có db_path
+    'local': threading.local(),
+    'layout_file': None,   # file đang giữ flock bố cục dòng
+    'layout_depth': 0,     # số lần lock_sheet_layout lồng nhau (trong append_lock)
+    'lock': threading.Lock(),
+    'interval': int(os.getenv("CONTEXT_COMPACTION_INTERVAL", "21600")),  # giây (6 giờ)
+    'running': False,
+    'stats': {
+        'runs': 0,
+        'rows_scanned': 0,
+        'duplicates_removed': 0,
+        'tombstones_removed': 0,
+        'blank_removed': 0,
+        'errors': 0,
+        'last_run': 0
+    }
+}
+
+def _compaction_connection():
+    local = CONTEXT_COMPACTION['local']
+    conn = getattr(local, 'conn', None)
+    if conn is not None and getattr(local, 'pid', None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(CONTEXT_COMPACTION['db_path'], timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS context_tombstones (
+            user_id TEXT PRIMARY KEY,
+            deleted_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sheet_layout (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+def add_context_tombstone(user_id: str):
+    if not CONTEXT_COMPACTION['db_path']:
+        with CONTEXT_COMPACTION['lock']:
+            CONTEXT_COMPACTION['tombstones'].add(user_id)
+        return
+    _compaction_connection().execute(
+        "INSERT OR REPLACE INTO context_tombstones (user_id, deleted_at) VALUES (?, ?)", (user_id, time.time())
+    )
+
+def discard_context_tombstone(user_id: str):
+    """User nhắn lại sau khi bị xóa -> không còn là tombstone"""
+    if not is_context_tombstoned(user_id):
+        return
+    if not CONTEXT_COMPACTION['db_path']:
+        with CONTEXT_COMPACTION['lock']:
+            CONTEXT_COMPACTION['tombstones'].discard(user_id)
+        return
+    _compaction_connection().execute("DELETE FROM context_tombstones WHERE user_id = ?", (user_id,))
+
+def list_context_tombstones() -> dict:
+    """user_id -> thời điểm xóa"""
+    if not CONTEXT_COMPACTION['db_path']:
+        with CONTEXT_COMPACTION['lock']:
+            return dict.fromkeys(CONTEXT_COMPACTION['tombstones'], 0)
+    return dict(_compaction_connection().execute("SELECT user_id, deleted_at FROM context_tombstones").fetchall())
+
+def clear_context_tombstones(tombstones: dict):
+    """Bỏ các tombstone compaction đã xóa dòng (trừ tombstone ghi lại sau lúc đọc)"""
+    if not CONTEXT_COMPACTION['db_path']:
+        with CONTEXT_COMPACTION['lock']:
+            CONTEXT_COMPACTION['tombstones'] -= set(tombstones)
+        return
+    _compaction_connection().executemany(
+        "DELETE FROM context_tombstones WHERE user_id = ? AND deleted_at <= ?", list(tombstones.items())
+    )
+
+def read_sheet_layout_version() -> int:
+    """Version bố cục dòng UserContext, tăng mỗi lần 1 process xóa/dịch dòng"""
+    if not CONTEXT_COMPACTION['db_path']:
+        return 0
+    try:
+        row = _compaction_connection().execute(
+            "SELECT version FROM sheet_layout WHERE name = ?", (USER_CONTEXT_SHEET_NAME,)
+        ).fetchone()
+        return row[0] if row else 0
+    except Exception as e:
+        print(f"[COMPACTION ERROR] Lỗi khi đọc version bố cục sheet: {e}")
+        return SHEETS_CACHE['layout_version'] or 0
+
+def bump_sheet_layout_version() -> int:
+    if not CONTEXT_COMPACTION['db_path']:
+        return 0
+    conn = _compaction_connection()
+    conn.execute(
+        "INSERT INTO sheet_layout (name, version) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET version = version + 1", (USER_CONTEXT_SHEET_NAME,)
+    )
+    return read_sheet_layout_version()
+
+def lock_sheet_layout(exclusive: bool = False):
+    """
+    Khóa bố cục dòng sheet UserContext: append_lock trong process + flock giữa các worker.
+    Ghi theo số dòng giữ shared, compaction giữ exclusive. Gọi lồng nhau được (cùng thread).
+    """
+    append_lock = CONTEXT_WRITE_BEHIND['append_lock']
+    append_lock.acquire()
+    compaction = CONTEXT_COMPACTION
+    if compaction['layout_depth'] == 0 and compaction['db_path']:
+        try:
+            layout_file = open(f"{compaction['db_path']}.layout.lock", "a")
+            fcntl.flock(layout_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except Exception:
+            append_lock.release()
+            raise
+        compaction['layout_file'] = layout_file
+    compaction['layout_depth'] += 1
+
+def unlock_sheet_layout():
+    compaction = CONTEXT_COMPACTION
+    compaction['layout_depth'] -= 1
+    if compaction['layout_depth'] == 0 and compaction['layout_file'] is not None:
+        # Đóng file -> nhả flock
+        compaction['layout_file'].close()
+        compaction['layout_file'] = None
+    CONTEXT_WRITE_BEHIND['append_lock'].release()
+
+SHEET_IDS = {}  # tên sheet -> sheetId (gid), lấy từ metadata 1 lần
+
+def get_sheet_id(sheet_name: str) -> Optional[int]:
+    """sheetId thật của 1 sheet (deleteDimension cần sheetId, không phải tên)"""
+    if sheet_name in SHEET_IDS:
+        return SHEET_IDS[sheet_name]
+
+    service = get_google_sheets_service()
+    if not service:
+        return None
+    spreadsheet = sheets_execute(service.spreadsheets().get(
+        spreadsheetId=GOOGLE_SHEET_ID,
+        fields="sheets.properties(sheetId,title)"
+    ))
+    for sheet in spreadsheet.get('sheets', []):
+        properties = sheet.get('properties', {})
+        SHEET_IDS[properties.get('title')] = properties.get('sheetId')
+    return SHEET_IDS.get(sheet_name)
+
+def parse_context_timestamp(value) -> float:
+    """Cột last_updated: '%Y-%m-%d %H:%M:%S' (mới) hoặc epoch (cũ)"""
+    if not value:
+        return 0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S").timestamp()
+    except ValueError:
+        return 0
+
+def _row_ranges_descending(row_numbers: list) -> list:
+    """Gom số dòng thành các khoảng liên tiếp [start, end), từ dưới lên"""
+    ranges = []
+    for row_number in sorted(row_numbers, reverse=True):
+        if ranges and ranges[-1][0] == row_number + 1:
+            ranges[-1][0] = row_number
+        else:
+            ranges.append([row_number, row_number + 1])
+    return ranges
+
+def compact_user_context_sheet() -> int:
+    """
+    Dọn sheet UserContext: mỗi user giữ 1 dòng có last_updated mới nhất,
+    xóa dòng của user đã bị xóa (tombstone) và dòng trống. Trả về số dòng đã xóa.
+    """
     if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
-        return False
-    
+        return 0
+
+    compaction = CONTEXT_COMPACTION
+    stats = compaction['stats']
+
+    # Giữ bố cục dòng: không worker nào flush/append/đồng bộ cache trong lúc xóa dòng
+    lock_sheet_layout(exclusive=True)
     try:
-        service = get_google_sheets_service()
-        if not service:
-            return False
-        
-        # Lấy tất cả dữ liệu hiện tại
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{USER_CONTEXT_SHEET_NAME}!A2:L"
-        ).execute()
-        
-        values = result.get('values', [])
-        
-        # Tìm dòng cần xóa
-        rows_to_delete = []
-        for i, row in enumerate(values):
-            if len(row) > 0 and row[0] == user_id:
-                rows_to_delete.append(i + 2)  # +2 vì bắt đầu từ row 2
-        
-        if not rows_to_delete:
-            return True  # Không có dòng nào để xóa
-        
-        # Xóa từ dưới lên để không làm hỏng index
-        rows_to_delete.sort(reverse=True)
-        
-        for row_index in rows_to_delete:
-            try:
-                # Xóa dòng
+        try:
+            service = get_google_sheets_service()
+            if not service:
+                return 0
+            sheet_id = get_sheet_id(USER_CONTEXT_SHEET_NAME)
+            if sheet_id is None:
+                raise RuntimeError(f"Không tìm thấy sheet {USER_CONTEXT_SHEET_NAME}")
+
+            tombstones = list_context_tombstones()
+
+            # Chỉ cần cột user_id và last_updated
+            result = sheets_execute(service.spreadsheets().values().batchGet(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                ranges=[f"{USER_CONTEXT_SHEET_NAME}!A2:A", f"{USER_CONTEXT_SHEET_NAME}!H2:H"]
+            ), SHEETS_PRIORITY_BACKGROUND)
+            value_ranges = [vr.get('values', []) for vr in result.get('valueRanges', [])]
+            user_ids = value_ranges[0] if value_ranges else []
+            updated = value_ranges[1] if len(value_ranges) > 1 else []
+
+            newest = {}  # user_id -> (last_updated, số dòng)
+            delete_rows = []
+            duplicates = tombstoned = blank = 0
+            for i, row in enumerate(user_ids):
+                row_number = i + 2
+                user_id = row[0].strip() if row and row[0] else ""
+                if not user_id:
+                    delete_rows.append(row_number)
+                    blank += 1
+                    continue
+                if user_id in tombstones:
+                    delete_rows.append(row_number)
+                    tombstoned += 1
+                    continue
+
+                last_updated = parse_context_timestamp(updated[i][0] if i < len(updated) and updated[i] else "")
+                previous = newest.get(user_id)
+                if previous is None:
+                    newest[user_id] = (last_updated, row_number)
+                    continue
+                # Bằng nhau thì giữ dòng append sau
+                duplicates += 1
+                if last_updated >= previous[0]:
+                    delete_rows.append(previous[1])
+                    newest[user_id] = (last_updated, row_number)
+                else:
+                    delete_rows.append(row_number)
+
+            if delete_rows:
+                # Các khoảng từ dưới lên: xóa khoảng dưới không làm lệch chỉ số khoảng trên
                 requests = [{
                     'deleteDimension': {
                         'range': {
-                            'sheetId': 0,
+                            'sheetId': sheet_id,
                             'dimension': 'ROWS',
-                            'startIndex': row_index - 1,
-                            'endIndex': row_index
+                            'startIndex': start - 1,
+                            'endIndex': end - 1
                         }
                     }
-                }]
-                
-                service.spreadsheets().batchUpdate(
+                } for start, end in _row_ranges_descending(delete_rows)]
+
+                sheets_execute(service.spreadsheets().batchUpdate(
                     spreadsheetId=GOOGLE_SHEET_ID,
                     body={'requests': requests}
-                ).execute()
-                
-                print(f"[CONTEXT DELETE] Đã xóa context của user {user_id} khỏi Google Sheets")
-            except Exception as e:
-                print(f"[CONTEXT DELETE ERROR] Lỗi khi xóa user {user_id}: {e}")
-        
-        return True
-        
+                ), SHEETS_PRIORITY_BACKGROUND)
+                # Worker khác thấy version mới -> đọc lại vị trí dòng trước khi ghi
+                SHEETS_CACHE['layout_version'] = bump_sheet_layout_version()
+
+            # Dựng lại index dòng từ kết quả đã đọc, không đọc lại sheet
+            deleted = set(delete_rows)
+            SHEETS_CACHE['user_row_map'] = {}
+            SHEETS_CACHE['existing_values'] = []
+            _apply_user_context_rows(
+                [row for i, row in enumerate(user_ids) if i + 2 not in deleted], 2
+            )
+            SHEETS_CACHE['last_read'] = time.time()
+            if not delete_rows:
+                SHEETS_CACHE['layout_version'] = read_sheet_layout_version()
+
+            clear_context_tombstones(tombstones)
+            with compaction['lock']:
+                stats['runs'] += 1
+                stats['rows_scanned'] += len(user_ids)
+                stats['duplicates_removed'] += duplicates
+                stats['tombstones_removed'] += tombstoned
+                stats['blank_removed'] += blank
+                stats['last_run'] = time.time()
+
+            if delete_rows:
+                print(f"[COMPACTION] Đã xóa {len(delete_rows)} dòng ({duplicates} trùng, {tombstoned} đã xóa, "
+                      f"{blank} trống) bằng 1 batchUpdate, còn {len(newest)} users")
+            return len(delete_rows)
+
+        except Exception as e:
+            stats['errors'] += 1
+            print(f"[COMPACTION ERROR] Lỗi khi compaction sheet UserContext: {e}")
+            return 0
+    finally:
+        unlock_sheet_layout()
+
+def delete_user_context_from_sheets(user_id: str):
+    """Xóa context của user khỏi Google Sheets: ghi tombstone rồi compaction ngay"""
+    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return False
+
+    # Tombstone nằm trong SQLite dùng chung: lỗi thì leader sẽ xóa ở lần compaction sau
+    add_context_tombstone(user_id)
+
+    compact_user_context_sheet()
+    print(f"[CONTEXT DELETE] Đã xóa context của user {user_id} khỏi Google Sheets")
+    return True
+
+def is_context_tombstoned(user_id: str) -> bool:
+    if not CONTEXT_COMPACTION['db_path']:
+        return user_id in CONTEXT_COMPACTION['tombstones']
+    try:
+        return _compaction_connection().execute(
+            "SELECT 1 FROM context_tombstones WHERE user_id = ?", (user_id,)
+        ).fetchone() is not None
     except Exception as e:
-        print(f"[CONTEXT DELETE ERROR] Lỗi khi xóa context: {e}")
+        print(f"[COMPACTION ERROR] Lỗi khi đọc tombstone: {e}")
         return False
 
-def get_sheet_data_cached():
-    """Lấy dữ liệu từ Google Sheets với cache"""
-    global SHEETS_CACHE
-    
-    now = time.time()
-    
-    # Nếu cache còn hiệu lực, trả về cache
-    if (SHEETS_CACHE['last_read'] > 0 and 
-        (now - SHEETS_CACHE['last_read']) < SHEETS_CACHE['cache_ttl'] and
-        SHEETS_CACHE['user_row_map']):
-        return SHEETS_CACHE['user_row_map'], SHEETS_CACHE['existing_values']
-    
-    # Nếu không có cấu hình Google Sheets
-    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
-        return {}, []
-    
+def context_compaction_worker():
+    """Worker compaction định kỳ"""
+    print(f"[COMPACTION] Worker đã khởi động, chạy mỗi {CONTEXT_COMPACTION['interval']} giây")
+    while True:
+        time.sleep(CONTEXT_COMPACTION['interval'])
+        # Sheet dùng chung -> chỉ leader compaction
+        if not is_leader():
+            continue
+        try:
+            compact_user_context_sheet()
+        except Exception as e:
+            print(f"[COMPACTION WORKER ERROR] {e}")
+
+def start_context_compaction_worker():
+    """Khởi động worker compaction (chỉ 1 lần mỗi process)"""
+    with CONTEXT_COMPACTION['lock']:
+        if CONTEXT_COMPACTION['running']:
+            return None
+        CONTEXT_COMPACTION['running'] = True
+
+    worker_thread = threading.Thread(target=context_compaction_worker, daemon=True)
+    worker_thread.start()
+    return worker_thread
+
+def _reset_context_compaction_after_fork():
+    """Thread compaction không sống qua fork -> worker phải tự khởi động lại"""
+    CONTEXT_COMPACTION['lock'] = threading.Lock()
+    CONTEXT_COMPACTION['local'] = threading.local()
+    CONTEXT_COMPACTION['layout_file'] = None
+    CONTEXT_COMPACTION['layout_depth'] = 0
+    CONTEXT_COMPACTION['running'] = False
+
+os.register_at_fork(after_in_child=_reset_context_compaction_after_fork)
+
+def get_context_compaction_stats() -> dict:
+    with CONTEXT_COMPACTION['lock']:
+        stats = dict(CONTEXT_COMPACTION['stats'])
     try:
-        service = get_google_sheets_service()
-        if not service:
-            return {}, []
-        
-        # Lấy dữ liệu từ sheet
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{USER_CONTEXT_SHEET_NAME}!A2:L"
-        ).execute()
-        
-        existing_values = result.get('values', [])
-        
-        # Tạo mapping user_id -> row index
-        user_row_map = {}
-        for i, row in enumerate(existing_values):
-            if len(row) > 0 and row[0]:  # Có user_id
-                user_row_map[row[0]] = i + 2  # +2 vì bắt đầu từ row 2
-        
-        # Cập nhật cache
-        SHEETS_CACHE['user_row_map'] = user_row_map
-        SHEETS_CACHE['existing_values'] = existing_values
-        SHEETS_CACHE['last_read'] = now
-        
-        print(f"[SHEETS CACHE] Đã load {len(user_row_map)} users từ Google Sheets")
-        
-        return user_row_map, existing_values
-        
+        stats['pending_tombstones'] = len(list_context_tombstones())
     except Exception as e:
-        print(f"[SHEETS CACHE ERROR] Lỗi khi load sheet: {e}")
-        return {}, []
+        stats['pending_tombstones'] = None
+        stats['error'] = str(e)
+    stats['layout_version'] = read_sheet_layout_version()
+    return stats
+
+def _apply_user_context_rows(rows: list, first_row: int):
+    """Thêm các dòng (chỉ cột A) vào cache, dòng đầu tiên ở vị trí first_row trên sheet"""
+    user_row_map = SHEETS_CACHE['user_row_map']
+    for i, row in enumerate(rows):
+        if len(row) > 0 and row[0]:  # Có user_id
+            user_row_map[row[0]] = first_row + i
+    SHEETS_CACHE['existing_values'].extend(rows)
+
+def sync_user_context_rows(force_full: bool = False) -> bool:
+    """
+    Đồng bộ user_row_map/existing_values với sheet UserContext, chỉ đọc cột A:
+    - Lần đầu (hoặc khi phát hiện sheet bị xóa/chèn dòng): đọc lại toàn bộ cột A
+    - Các lần sau: 1 batchGet gồm ô A của dòng cuối đã biết (kiểm tra sheet không bị
+      dịch dòng) + phần đuôi từ dòng kế tiếp (thường rỗng nếu không có user mới)
+    """
+    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return False
 
-def periodic_context_save_optimized():
-    """Lưu context định kỳ vào Google Sheets - CHỈ lưu users dirty"""
-    print(f"[PERIODIC SAVE THREAD] Thread lưu context đã bắt đầu")
-    
-    # Đợi app khởi động xong
-    time.sleep(30)
-    
-    # Kiểm tra và tạo sheet nếu cần
-    if GOOGLE_SHEET_ID and GOOGLE_SHEETS_CREDENTIALS_JSON:
+    service = get_google_sheets_service()
+    if not service:
+        return False
+
+    stats = SHEETS_CACHE['stats']
+    sheet = USER_CONTEXT_SHEET_NAME
+    # Giữ append_lock: append_context_rows cũng cập nhật cache, không để 2 bên ghi chồng
+    with CONTEXT_WRITE_BEHIND['append_lock']:
         try:
-            init_user_context_sheet()
+            existing_values = SHEETS_CACHE['existing_values']
+            known = len(existing_values)
+            full = force_full or SHEETS_CACHE['last_read'] == 0
+
+            if not full:
+                last_row = known + 1  # dòng cuối đã biết (dòng 1 là header)
+                ranges = [f"{sheet}!A{known + 2}:A"]
+                expected = None
+                if known:
+                    ranges.insert(0, f"{sheet}!A{last_row}:A{last_row}")
+                    expected = existing_values[-1][0] if existing_values[-1] else ""
+                result = sheets_execute(service.spreadsheets().values().batchGet(
+                    spreadsheetId=GOOGLE_SHEET_ID,
+                    ranges=ranges
+                ), SHEETS_PRIORITY_BACKGROUND)
+                value_ranges = [vr.get('values', []) for vr in result.get('valueRanges', [])]
+
+                if known:
+                    probe = value_ranges[0]
+                    actual = probe[0][0] if probe and probe[0] else ""
+                    if actual != expected:
+                        # Dòng bị xóa/chèn ở giữa sheet -> vị trí cũ không còn đúng
+                        stats['shifts_detected'] += 1
+                        full = True
+
+                if not full:
+                    tail = value_ranges[-1] if value_ranges else []
+                    _apply_user_context_rows(tail, known + 2)
+                    stats['incremental_syncs'] += 1
+                    stats['rows_fetched'] += len(tail)
+                    if tail:
+                        print(f"[SHEETS CACHE] Thêm {len(tail)} dòng mới từ Google Sheets")
+
+            if full:
+                result = sheets_execute(service.spreadsheets().values().get(
+                    spreadsheetId=GOOGLE_SHEET_ID,
+                    range=f"{sheet}!A2:A"
+                ), SHEETS_PRIORITY_BACKGROUND)
+                SHEETS_CACHE['user_row_map'] = {}
+                SHEETS_CACHE['existing_values'] = []
+                values = result.get('values', [])
+                _apply_user_context_rows(values, 2)
+                stats['full_syncs'] += 1
+                stats['rows_fetched'] += len(values)
+                print(f"[SHEETS CACHE] Đã load {len(SHEETS_CACHE['user_row_map'])} users từ Google Sheets")
+
+            SHEETS_CACHE['last_read'] = time.time()
+            return True
+
+        except Exception as e:
+            stats['errors'] += 1
+            print(f"[SHEETS CACHE ERROR] Lỗi khi đồng bộ sheet: {e}")
+            return False
+
+def user_context_sync_worker():
+    """Worker đồng bộ tăng dần sheet UserContext định kỳ"""
+    print(f"[SHEETS CACHE] Worker đồng bộ đã khởi động, mỗi {SHEETS_CACHE['cache_ttl']} giây")
+    while True:
+        time.sleep(SHEETS_CACHE['cache_ttl'])
+        try:
+            sync_user_context_rows()
+        except Exception as e:
+            print(f"[SHEETS CACHE WORKER ERROR] {e}")
+
+def start_user_context_sync_worker():
+    """Khởi động worker đồng bộ (chỉ 1 lần mỗi process)"""
+    with SHEETS_CACHE['lock']:
+        if SHEETS_CACHE['running']:
+            return None
+        SHEETS_CACHE['running'] = True
+
+    worker_thread = threading.Thread(target=user_context_sync_worker, daemon=True)
+    worker_thread.start()
+    return worker_thread
+
+def get_sheet_data_cached():
+    """
+    Lấy user_row_map và existing_values (cột A) của sheet UserContext.
+    Worker nền đồng bộ tăng dần; chỉ đọc trực tiếp khi chưa có dữ liệu
+    hoặc worker bị trễ quá lâu.
+    """
+    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return {}, []
+
+    # Worker khác vừa compaction (xóa/dịch dòng) -> vị trí dòng trong cache đã sai, đọc lại toàn bộ.
+    # Version đọc trước khi đồng bộ: compaction xen giữa sẽ bị phát hiện ở lần gọi sau
+    layout_version = read_sheet_layout_version()
+    layout_changed = layout_version != SHEETS_CACHE['layout_version']
+    if layout_changed and SHEETS_CACHE['last_read']:
+        SHEETS_CACHE['stats']['layout_resyncs'] += 1
+
+    age = time.time() - SHEETS_CACHE['last_read']
+    if SHEETS_CACHE['last_read'] == 0 or age > SHEETS_CACHE['max_staleness'] or layout_changed:
+        if not sync_user_context_rows(force_full=layout_changed):
+            return {}, []
+        SHEETS_CACHE['layout_version'] = layout_version
+    start_user_context_sync_worker()
+
+    return SHEETS_CACHE['user_row_map'], SHEETS_CACHE['existing_values']
+
+def get_user_context_sync_stats() -> dict:
+    stats = dict(SHEETS_CACHE['stats'])
+    stats['rows'] = len(SHEETS_CACHE['existing_values'])
+    stats['users'] = len(SHEETS_CACHE['user_row_map'])
+    stats['last_read'] = SHEETS_CACHE['last_read']
+    return stats
+
+# Các field của context -> chỉ số cột (0 = A) trên sheet UserContext
+CONTEXT_FIELD_COLUMNS = {
+    "last_ms": (1,),
+    "product_history": (2,),
+    "order_data": (3, 8, 9),
+    "conversation_history": (4,),
+    "real_message_count": (5,),
+    "referral_source": (6,),
+    "last_msg_time": (10,),
+    "has_sent_first_carousel": (11,),
+}
+CONTEXT_LAST_UPDATED_COLUMN = 7
+
+# Thống kê dung lượng ghi context (so sánh delta với ghi cả dòng)
+CONTEXT_DELTA_STATS = {
+    'full_rows': 0,
+    'delta_rows': 0,
+    'skipped_rows': 0,
+    'cells_written': 0,
+    'bytes_written': 0
+}
+
+def build_context_cell(user_id: str, context: dict, column: int):
+    """Giá trị 1 ô (cột A-L) của sheet UserContext"""
+    if column == 0:
+        return user_id
+    if column == 1:
+        return context.get("last_ms", "") or ""
+    if column == 2:
+        return encode_context_column(context.get("product_history", []))
+    if column == 3:
+        return encode_context_column(context.get("order_data") or {})
+    if column == 4:
+        return encode_context_column(context.get("conversation_history", []))
+    if column == 5:
+        return str(context.get("real_message_count", 0))
+    if column == 6:
+        return context.get("referral_source", "") or ""
+    if column == 7:
+        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if column == 8:
+        return (context.get("order_data") or {}).get("phone", "")
+    if column == 9:
+        return (context.get("order_data") or {}).get("customer_name", "")
+    if column == 10:
+        return str(context.get("last_msg_time", 0))
+    if column == 11:
+        return str(context.get("has_sent_first_carousel", False))
+    return ""
+
+def build_context_row(user_id: str, context: dict) -> list:
+    """Chuẩn bị 1 dòng (12 cột A-L) của sheet UserContext từ context"""
+    return [build_context_cell(user_id, context, column) for column in range(12)]
+
+def take_context_changes(context: dict):
+    """Các field đã thay đổi từ lần lưu trước, None = phải ghi cả dòng"""
+    take_changes = getattr(context, "take_changes", None)
+    return take_changes() if take_changes else None
+
+def build_context_update_data(user_id: str, context: dict, row_index: int, changes) -> list:
+    """
+    Chuẩn bị data cho values.batchUpdate của 1 dòng đã có trên sheet.
+    Chỉ ghi các ô thuộc field trong changes (gộp các cột liền nhau thành 1 range),
+    ghi cả dòng khi changes là None.
+    """
+    if changes is None:
+        row_data = build_context_row(user_id, context)
+        CONTEXT_DELTA_STATS['full_rows'] += 1
+        CONTEXT_DELTA_STATS['cells_written'] += len(row_data)
+        CONTEXT_DELTA_STATS['bytes_written'] += sum(len(v) for v in row_data)
+        return [{
+            'range': f"{USER_CONTEXT_SHEET_NAME}!A{row_index}:L{row_index}",
+            'values': [row_data]
+        }]
+
+    columns = set()
+    for field in changes:
+        columns.update(CONTEXT_FIELD_COLUMNS.get(field, ()))
+    if not columns:
+        CONTEXT_DELTA_STATS['skipped_rows'] += 1
+        return []
+    columns.add(CONTEXT_LAST_UPDATED_COLUMN)
+
+    data = []
+    run = []
+    for column in sorted(columns):
+        if run and column != run[-1] + 1:
+            data.append(_context_cells_range(user_id, context, row_index, run))
+            run = []
+        run.append(column)
+    data.append(_context_cells_range(user_id, context, row_index, run))
+
+    CONTEXT_DELTA_STATS['delta_rows'] += 1
+    return data
+
+def _context_cells_range(user_id: str, context: dict, row_index: int, columns: list) -> dict:
+    values = [build_context_cell(user_id, context, column) for column in columns]
+    CONTEXT_DELTA_STATS['cells_written'] += len(values)
+    CONTEXT_DELTA_STATS['bytes_written'] += sum(len(v) for v in values)
+    start = chr(ord('A') + columns[0])
+    end = chr(ord('A') + columns[-1])
+    return {
+        'range': f"{USER_CONTEXT_SHEET_NAME}!{start}{row_index}:{end}{row_index}",
+        'values': [values]
+    }
+
+def append_context_rows(service, rows: list) -> int:
+    """
+    Append các dòng user MỚI vào sheet UserContext - TUẦN TỰ HÓA
+    - Chỉ 1 thread được append tại một thời điểm
+    - User đã có dòng (do thread khác vừa append) sẽ được update thay vì append
+    - Cập nhật user_row_map ngay từ response, không cần đọc lại cả sheet
+    Trả về số API call đã dùng
+    """
+    if not rows:
+        return 0
+
+    api_calls = 0
+
+    lock_sheet_layout()
+    try:
+        user_row_map, existing_values = get_sheet_data_cached()
+
+        # User vừa được thread khác append -> chuyển thành update
+        late_updates = []
+        new_rows = []
+        seen = set()
+        for row in rows:
+            user_id = row[0]
+            if user_id in user_row_map:
+                row_index = user_row_map[user_id]
+                late_updates.append({
+                    'range': f"{USER_CONTEXT_SHEET_NAME}!A{row_index}:L{row_index}",
+                    'values': [row]
+                })
+            elif user_id not in seen:
+                seen.add(user_id)
+                new_rows.append(row)
+
+        if late_updates:
+            sheets_execute(service.spreadsheets().values().batchUpdate(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                body={'valueInputOption': 'USER_ENTERED', 'data': late_updates}
+            ), SHEETS_PRIORITY_BACKGROUND)
+            api_calls += 1
+
+        if new_rows:
+            start_row = len(existing_values) + 2
+            response = sheets_execute(service.spreadsheets().values().append(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                range=f"{USER_CONTEXT_SHEET_NAME}!A{start_row}",
+                valueInputOption="USER_ENTERED",
+                insertDataOption="INSERT_ROWS",
+                body={'values': new_rows}
+            ), SHEETS_PRIORITY_BACKGROUND)
+            api_calls += 1
+
+            # Lấy vị trí thực tế từ response (VD: "UserContext!A15:L17")
+            updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+            match = re.search(r'!A(\d+)', updated_range)
+            if match:
+                first_row = int(match.group(1))
+                for i, row in enumerate(new_rows):
+                    user_row_map[row[0]] = first_row + i
+                    remember_known_identity(row[0], row[8] if len(row) > 8 else None)
+                if first_row == len(existing_values) + 2:
+                    existing_values.extend([row[0]] for row in new_rows)
+                else:
+                    # Worker khác vừa append xen giữa -> đọc lại cột A
+                    SHEETS_CACHE['last_read'] = 0
+            else:
+                # Không xác định được vị trí -> buộc load lại cache
+                SHEETS_CACHE['last_read'] = 0
+                for row in new_rows:
+                    remember_known_identity(row[0], row[8] if len(row) > 8 else None)
+    finally:
+        unlock_sheet_layout()
+
+    return api_calls
+
+# ============================================
+# WRITE-BEHIND BUFFER CHO USER CONTEXT
+# Gộp nhiều lần lưu thành 1 batchUpdate + 1 append mỗi chu kỳ
+# ============================================
+
+CONTEXT_WRITE_BEHIND = {
+    'pending': {},  # user_id -> context (lưu nhiều lần cùng user sẽ được gộp)
+    'lock': threading.Lock(),
+    'append_lock': threading.RLock(),  # Tuần tự hóa append user mới (và đồng bộ cache dòng)
+    'flush_interval': int(os.getenv("CONTEXT_FLUSH_INTERVAL", "5")),  # giây
+    'running': False,
+    'stats': {
+        'queued': 0,
+        'merged': 0,
+        'flushes': 0,
+        'users_saved': 0,
+        'api_calls': 0,
+        'errors': 0,
+        'last_flush_ms': 0,
+        'total_flush_ms': 0,
+        'last_flush_at': 0
+    }
+}
+
+def queue_context_save(user_id: str, context: dict = None):
+    """Đưa user vào hàng đợi lưu - KHÔNG gọi Google Sheets ngay"""
+    if not user_id:
+        return False
+
+    if context is None:
+        if user_id not in USER_CONTEXT:
+            return False
+        context = USER_CONTEXT[user_id]
+
+    # Ghi ngay xuống warm tier (SQLite local, vài ms), Sheets chỉ là mirror ghi sau
+    USER_CONTEXT.persist(user_id, context)
+
+    # User nhắn lại sau khi bị xóa -> không còn là tombstone
+    try:
+        discard_context_tombstone(user_id)
+    except Exception as e:
+        print(f"[COMPACTION ERROR] Lỗi khi bỏ tombstone của user {user_id}: {e}")
+
+    with CONTEXT_WRITE_BEHIND['lock']:
+        stats = CONTEXT_WRITE_BEHIND['stats']
+        if user_id in CONTEXT_WRITE_BEHIND['pending']:
+            stats['merged'] += 1
+        else:
+            stats['queued'] += 1
+        CONTEXT_WRITE_BEHIND['pending'][user_id] = context
+
+    start_context_write_behind_worker()
+    return True
+
+def discard_context_save(user_id: str):
+    """Bỏ user khỏi hàng đợi lưu (khi context bị xóa hẳn)"""
+    with CONTEXT_WRITE_BEHIND['lock']:
+        return CONTEXT_WRITE_BEHIND['pending'].pop(user_id, None) is not None
+
+def flush_context_write_behind() -> int:
+    """
+    Lưu toàn bộ users đang chờ: 1 values.batchUpdate (update) + 1 append (user mới)
+    Trả về số users đã lưu
+    """
+    with CONTEXT_WRITE_BEHIND['lock']:
+        pending = CONTEXT_WRITE_BEHIND['pending']
+        if not pending:
+            return 0
+        CONTEXT_WRITE_BEHIND['pending'] = {}
+
+    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return 0
+
+    stats = CONTEXT_WRITE_BEHIND['stats']
+    started = time.time()
+    api_calls = 0
+
+    # Compaction (kể cả ở worker khác) không được xóa/dịch dòng giữa lúc lấy vị trí và lúc ghi
+    lock_sheet_layout()
+    try:
+        service = get_google_sheets_service()
+        if not service:
+            raise RuntimeError("Không thể khởi tạo Google Sheets service")
+
+        user_row_map, _ = get_sheet_data_cached()
+
+        update_data = []
+        new_rows = []
+        now = time.time()
+
+        for user_id, context in pending.items():
+            # Lấy field thay đổi (cần cờ dirty) rồi reset dirty TRƯỚC khi chụp dữ liệu:
+            # thay đổi sau đó sẽ được lưu ở lần sau
+            changes = take_context_changes(context)
+            context["dirty"] = False
+            context["last_saved"] = now
+
+            if user_id in user_row_map:
+                update_data.extend(build_context_update_data(
+                    user_id, context, user_row_map[user_id], changes
+                ))
+            else:
+                new_rows.append(build_context_row(user_id, context))
+
+        if update_data:
+            sheets_execute(service.spreadsheets().values().batchUpdate(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                body={'valueInputOption': 'USER_ENTERED', 'data': update_data}
+            ), SHEETS_PRIORITY_BACKGROUND)
+            api_calls += 1
+
+        if new_rows:
+            api_calls += append_context_rows(service, new_rows)
+
+        elapsed_ms = (time.time() - started) * 1000
+        stats['flushes'] += 1
+        stats['users_saved'] += len(pending)
+        stats['api_calls'] += api_calls
+        stats['last_flush_ms'] = round(elapsed_ms, 1)
+        stats['total_flush_ms'] += elapsed_ms
+        stats['last_flush_at'] = time.time()
+
+        print(f"[WRITE-BEHIND] Đã lưu {len(pending)} users ({len(update_data)} range update, {len(new_rows)} mới) "
+              f"bằng {api_calls} API call trong {elapsed_ms:.0f}ms")
+        return len(pending)
+
+    except Exception as e:
+        stats['errors'] += 1
+        stats['api_calls'] += api_calls
+        print(f"[WRITE-BEHIND ERROR] Lỗi khi flush {len(pending)} users: {e}")
+
+        # Đưa lại vào hàng đợi (không ghi đè bản mới hơn đã được queue), lần sau ghi cả dòng
+        with CONTEXT_WRITE_BEHIND['lock']:
+            for user_id, context in pending.items():
+                context["dirty"] = True
+                if hasattr(context, "mark_all_changed"):
+                    context.mark_all_changed()
+                CONTEXT_WRITE_BEHIND['pending'].setdefault(user_id, context)
+        return 0
+    finally:
+        unlock_sheet_layout()
+
+def context_write_behind_worker():
+    """Worker flush write-behind buffer định kỳ"""
+    print(f"[WRITE-BEHIND] Worker đã khởi động, flush mỗi {CONTEXT_WRITE_BEHIND['flush_interval']} giây")
+
+    while True:
+        time.sleep(CONTEXT_WRITE_BEHIND['flush_interval'])
+        try:
+            flush_context_write_behind()
+        except Exception as e:
+            print(f"[WRITE-BEHIND WORKER ERROR] {e}")
+
+def start_context_write_behind_worker():
+    """Khởi động worker write-behind (chỉ 1 lần mỗi process)"""
+    with CONTEXT_WRITE_BEHIND['lock']:
+        if CONTEXT_WRITE_BEHIND['running']:
+            return None
+        CONTEXT_WRITE_BEHIND['running'] = True
+
+    worker_thread = threading.Thread(target=context_write_behind_worker, daemon=True)
+    worker_thread.start()
+    return worker_thread
+
+def get_context_write_behind_stats() -> dict:
+    """Thống kê write-behind cho /stats"""
+    stats = dict(CONTEXT_WRITE_BEHIND['stats'])
+    flushes = stats['flushes']
+    stats['pending'] = len(CONTEXT_WRITE_BEHIND['pending'])
+    stats['avg_flush_ms'] = round(stats['total_flush_ms'] / flushes, 1) if flushes else 0
+    stats['avg_api_calls_per_flush'] = round(stats['api_calls'] / flushes, 2) if flushes else 0
+    stats['total_flush_ms'] = round(stats['total_flush_ms'], 1)
+    stats['cells'] = dict(CONTEXT_DELTA_STATS)
+    return stats
+
+def periodic_context_save_optimized():
+    """Lưu context định kỳ vào Google Sheets - CHỈ lưu users dirty"""
+    print(f"[PERIODIC SAVE THREAD] Thread lưu context đã bắt đầu")
+    
+    # Đợi app khởi động xong
+    time.sleep(30)
+    
+    # Kiểm tra và tạo sheet nếu cần
+    if GOOGLE_SHEET_ID and GOOGLE_SHEETS_CREDENTIALS_JSON:
+        try:
+            init_user_context_sheet()
         except Exception as e:
             print(f"[PERIODIC SAVE INIT ERROR] Lỗi khi khởi tạo sheet: {e}")
     
@@ -1086,11 +1825,13 @@ def periodic_context_save_optimized():
             for uid, ctx in USER_CONTEXT.items():
                 if ctx.get("dirty", False):
                     dirty_count += 1
+                    # Warm tier luôn được cập nhật, kể cả khi Sheets hết quota
+                    USER_CONTEXT.persist(uid, ctx)
                 if ctx.get("last_updated", 0) > now - 86400:  # 24h
                     active_users += 1
             
-            # Kiểm tra có nên lưu full không
-            save_full = (now - last_full_save) > full_save_interval
+            # Kiểm tra có nên lưu full không (chỉ leader, tránh N worker cùng ghi lại toàn bộ mỗi giờ)
+            save_full = (now - last_full_save) > full_save_interval and is_leader()
             
             if dirty_count > 0 or save_full:
                 print(f"[PERIODIC SAVE] Đang lưu {dirty_count} dirty users và {active_users} active users...")
@@ -1125,100 +1866,758 @@ def periodic_context_save():
     """Alias cho hàm tối ưu"""
     periodic_context_save_optimized()
     
-def get_user_order_history_from_sheets(user_id: str, phone: str = None) -> List[Dict]:
-    """Tra cứu lịch sử đơn hàng từ Google Sheets"""
+# ============================================
+# INDEX LỊCH SỬ ĐƠN HÀNG (user_id / số điện thoại -> đơn gần nhất)
+# ============================================
+
+ORDER_HISTORY_LIMIT = 5  # Số đơn gần nhất giữ cho mỗi user/số điện thoại
+
+ORDER_HISTORY_INDEX = {
+    'by_uid': {},            # user_id -> [(seq, order)] mới nhất trước
+    'by_phone': {},          # phone đã chuẩn hóa -> [(seq, order)] mới nhất trước
+    'order_ids': set(),      # mã đơn đã có trong index (tránh trùng khi đọc lại dòng vừa ghi)
+    'col_indices': None,     # vị trí các cột, dò từ header 1 lần
+    'row_count': 0,          # số dòng đã đọc từ sheet Orders (kể cả header)
+    'seq': 0,
+    'last_sync': 0,
+    'last_full_sync': 0,
+    'sync_interval': int(os.getenv("ORDER_INDEX_SYNC_INTERVAL", "60")),
+    'full_sync_interval': 3600,  # đọc lại toàn bộ mỗi giờ phòng khi sheet bị sửa/xóa dòng
+    'lock': threading.RLock(),
+    'sync_lock': threading.Lock(),
+    'stats': {
+        'lookups': 0,
+        'syncs': 0,
+        'full_syncs': 0,
+        'rows_read': 0,
+        'local_adds': 0,
+        'errors': 0
+    }
+}
+
+def normalize_phone(phone) -> str:
+    """Chuẩn hóa số điện thoại để so khớp: chỉ giữ chữ số, +84/84 -> 0"""
+    digits = re.sub(r"\D", "", str(phone or ""))
+    if digits.startswith("84") and len(digits) >= 11:
+        digits = "0" + digits[2:]
+    return digits
+
+def normalize_email(email) -> str:
+    """Chuẩn hóa email để so khớp: bỏ khoảng trắng, chữ thường"""
+    return str(email or "").strip().lower()
+
+def detect_order_columns(headers: list) -> dict:
+    """Dò vị trí các cột cần thiết trong sheet Orders từ dòng header"""
+    col_indices = {}
+    for i, header in enumerate(headers):
+        header_lower = header.lower()
+        if 'user' in header_lower or 'uid' in header_lower:
+            col_indices['user_id'] = i
+        elif 'phone' in header_lower or 'sđt' in header_lower or 'điện thoại' in header_lower:
+            col_indices['phone'] = i
+        elif 'ms' in header_lower or 'mã' in header_lower or 'product_code' in header_lower:
+            col_indices['ms'] = i
+        elif 'name' in header_lower or 'tên' in header_lower or 'product_name' in header_lower:
+            col_indices['product_name'] = i
+        elif 'timestamp' in header_lower or 'thời gian' in header_lower:
+            col_indices['timestamp'] = i
+    return col_indices
+
+def _order_from_row(row: list, col_indices: dict) -> dict:
+    def cell(name):
+        i = col_indices.get(name)
+        return row[i] if i is not None and i < len(row) else ""
+
+    return {
+        "timestamp": cell('timestamp'),
+        "ms": cell('ms'),
+        "product_name": cell('product_name'),
+        "phone": cell('phone'),
+        "user_id": cell('user_id')
+    }
+
+def _index_order(order: dict, order_id: str = ""):
+    """Thêm 1 đơn vào index (gọi khi đang giữ lock). Bỏ qua nếu mã đơn đã có."""
+    index = ORDER_HISTORY_INDEX
+    if order_id:
+        if order_id in index['order_ids']:
+            return False
+        index['order_ids'].add(order_id)
+
+    index['seq'] += 1
+    entry = (index['seq'], order)
+
+    keys = ((index['by_uid'], order.get("user_id")),
+            (index['by_phone'], normalize_phone(order.get("phone"))))
+    for bucket, key in keys:
+        if not key:
+            continue
+        orders = bucket.setdefault(key, [])
+        orders.insert(0, entry)
+        del orders[ORDER_HISTORY_LIMIT:]
+    return True
+
+def _index_order_rows(rows: list):
+    """Đưa các dòng đọc từ sheet vào index (gọi khi đang giữ lock)"""
+    col_indices = ORDER_HISTORY_INDEX['col_indices'] or {}
+    if not col_indices:
+        return
+    for row in rows:
+        if not row:
+            continue
+        # Cột 2 là mã đơn hàng (ORD...)
+        order_id = row[1] if len(row) > 1 else ""
+        _index_order(_order_from_row(row, col_indices), order_id)
+
+def sync_order_history_index(force_full: bool = False) -> bool:
+    """
+    Cập nhật index từ sheet Orders: lần đầu (và mỗi giờ) đọc toàn bộ,
+    các lần sau chỉ đọc các dòng được thêm sau số dòng đã biết.
+    """
     if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
-        return []
-    
+        return False
+
+    index = ORDER_HISTORY_INDEX
+    # Chỉ 1 thread đồng bộ, các thread khác dùng index hiện có
+    if not index['sync_lock'].acquire(blocking=False):
+        return False
+
     try:
         service = get_google_sheets_service()
         if not service:
-            return []
-        
-        # Lấy dữ liệu từ sheet Orders
-        result = service.spreadsheets().values().get(
+            return False
+
+        now = time.time()
+        full = (force_full or not index['col_indices']
+                or now - index['last_full_sync'] > index['full_sync_interval'])
+        start_row = 1 if full else index['row_count'] + 1
+
+        result = sheets_execute(service.spreadsheets().values().get(
             spreadsheetId=GOOGLE_SHEET_ID,
-            range="Orders!A:V"  # Lấy tất cả cột
-        ).execute()
-        
+            range=f"Orders!A{start_row}:V"
+        ), SHEETS_PRIORITY_LOOKUP)
         values = result.get('values', [])
-        if len(values) <= 1:  # Chỉ có header
-            return []
-        
-        # Tìm các cột cần thiết
-        headers = values[0]
-        col_indices = {}
-        for i, header in enumerate(headers):
-            header_lower = header.lower()
-            if 'user' in header_lower or 'uid' in header_lower:
-                col_indices['user_id'] = i
-            elif 'phone' in header_lower or 'sđt' in header_lower or 'điện thoại' in header_lower:
-                col_indices['phone'] = i
-            elif 'ms' in header_lower or 'mã' in header_lower or 'product_code' in header_lower:
-                col_indices['ms'] = i
-            elif 'name' in header_lower or 'tên' in header_lower or 'product_name' in header_lower:
-                col_indices['product_name'] = i
-            elif 'timestamp' in header_lower or 'thời gian' in header_lower:
-                col_indices['timestamp'] = i
-        
+
+        with index['lock']:
+            if full:
+                index['by_uid'] = {}
+                index['by_phone'] = {}
+                index['order_ids'] = set()
+                index['col_indices'] = detect_order_columns(values[0]) if values else {}
+                index['row_count'] = len(values)
+                index['last_full_sync'] = now
+                index['stats']['full_syncs'] += 1
+                _index_order_rows(values[1:])
+            else:
+                index['row_count'] += len(values)
+                _index_order_rows(values)
+            index['last_sync'] = now
+            index['stats']['syncs'] += 1
+            index['stats']['rows_read'] += len(values)
+
+        # Đơn do worker khác/nhân viên thêm cũng phải có trong bộ lọc negative lookup
+        col_indices = index['col_indices'] or {}
+        for row in (values[1:] if full else values):
+            if row:
+                order = _order_from_row(row, col_indices)
+                remember_known_identity(order["user_id"], order["phone"], publish=False)
+
+        if values:
+            print(f"[ORDER INDEX] Đã đọc {len(values)} dòng từ Orders (từ dòng {start_row}, full={full})")
+        return True
+
+    except Exception as e:
+        index['stats']['errors'] += 1
+        print(f"[ORDER INDEX ERROR] Lỗi khi đồng bộ index đơn hàng: {e}")
+        return False
+    finally:
+        index['sync_lock'].release()
+
+def add_order_to_history_index(row: list):
+    """Cập nhật index ngay khi bot vừa ghi 1 đơn (dòng 22 cột như sheet Orders)"""
+    index = ORDER_HISTORY_INDEX
+    with index['lock']:
+        # Chưa đồng bộ lần nào: lần đồng bộ đầu sẽ đọc cả dòng này
+        if not index['col_indices']:
+            return
+        order_id = str(row[1]) if len(row) > 1 else ""
+        if _index_order(_order_from_row([str(v) for v in row], index['col_indices']), order_id):
+            index['stats']['local_adds'] += 1
+
+def get_order_index_stats() -> dict:
+    index = ORDER_HISTORY_INDEX
+    with index['lock']:
+        stats = dict(index['stats'])
+        stats['users'] = len(index['by_uid'])
+        stats['phones'] = len(index['by_phone'])
+        stats['orders'] = len(index['order_ids'])
+        stats['row_count'] = index['row_count']
+    stats['last_sync'] = index['last_sync']
+    return stats
+
+def get_user_order_history_from_sheets(user_id: str, phone: str = None) -> List[Dict]:
+    """Tra cứu lịch sử đơn hàng (index trong RAM, đồng bộ tăng dần từ Google Sheets)"""
+    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return []
+    
+    index = ORDER_HISTORY_INDEX
+    # Chỉ đồng bộ khi user/số điện thoại có thể đã có đơn trên Sheets
+    if (time.time() - index['last_sync'] > index['sync_interval']
+            and might_exist_in_sheets(user_id, phone)):
+        sync_order_history_index()
+    
+    try:
+        with index['lock']:
+            index['stats']['lookups'] += 1
+            entries = []
+            if user_id:
+                entries.extend(index['by_uid'].get(user_id, ()))
+            phone_key = normalize_phone(phone)
+            if phone_key:
+                entries.extend(index['by_phone'].get(phone_key, ()))
+        
+        # Gộp kết quả theo user_id và phone, mới nhất trước
+        seen = set()
         user_orders = []
-        
-        for row in values[1:]:
-            if len(row) < max(col_indices.values()) + 1:
+        for seq, order in sorted(entries, key=lambda entry: entry[0], reverse=True):
+            if seq in seen:
                 continue
-            
-            # Kiểm tra xem có khớp user_id hoặc phone không
-            row_user_id = row[col_indices.get('user_id', 0)] if col_indices.get('user_id') else ""
-            row_phone = row[col_indices.get('phone', 0)] if col_indices.get('phone') else ""
-            
-            match = False
-            if user_id and row_user_id == user_id:
-                match = True
-            elif phone and row_phone == phone:
-                match = True
-            
-            if match:
-                order = {
-                    "timestamp": row[col_indices.get('timestamp', 0)] if col_indices.get('timestamp') else "",
-                    "ms": row[col_indices.get('ms', 0)] if col_indices.get('ms') else "",
-                    "product_name": row[col_indices.get('product_name', 0)] if col_indices.get('product_name') else "",
-                    "phone": row_phone,
-                    "user_id": row_user_id
-                }
-                user_orders.append(order)
+            seen.add(seq)
+            user_orders.append(dict(order))
         
-        # Sắp xếp theo thời gian mới nhất
-        user_orders.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
-        return user_orders[:5]  # Trả về 5 đơn gần nhất
+        return user_orders[:ORDER_HISTORY_LIMIT]  # Trả về 5 đơn gần nhất
         
     except Exception as e:
         print(f"[ORDER HISTORY ERROR] Lỗi khi tra cứu đơn hàng: {e}")
         return []
 
+def get_order_history_by_phones(phones: list, timeout: float = None) -> List[Dict]:
+    """
+    Tra cứu đơn hàng của nhiều số điện thoại cùng lúc, mới nhất trước.
+    - Đồng bộ sheet Orders tối đa 1 lần (đọc tăng dần), chờ không quá `timeout` giây;
+      quá hạn thì dùng index hiện có, lần đồng bộ vẫn chạy tiếp ở nền
+    - Toàn bộ các số được tra trong 1 lần giữ lock
+    """
+    phone_keys = {normalize_phone(phone) for phone in phones}
+    phone_keys.discard("")
+    if not phone_keys or not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return []
+
+    index = ORDER_HISTORY_INDEX
+    if (time.time() - index['last_sync'] > index['sync_interval']
+            and any(might_exist_in_sheets(phone=phone) for phone in phone_keys)):
+        sync_thread = threading.Thread(target=sync_order_history_index, daemon=True)
+        sync_thread.start()
+        sync_thread.join(timeout)
+        if sync_thread.is_alive():
+            print(f"[ORDER HISTORY] Đồng bộ Orders quá {timeout}s, dùng index hiện có")
+
+    with index['lock']:
+        index['stats']['lookups'] += 1
+        entries = [entry for phone in phone_keys for entry in index['by_phone'].get(phone, ())]
+
+    entries.sort(key=lambda entry: entry[0], reverse=True)
+    return [dict(order) for _, order in entries[:ORDER_HISTORY_LIMIT]]
+
+# ============================================
+# BỘ LỌC USER CHƯA TỪNG CÓ TRÊN SHEETS (NEGATIVE LOOKUP)
+# Bloom filter chứa mọi user_id + số điện thoại của UserContext và Orders.
+# Filter trả "không có" thì chắc chắn không có -> bỏ qua lượt đọc Sheets.
+# ============================================
+
+class BloomFilter:
+    """Bloom filter trên bytearray: không bao giờ sai "không có", sai "có" ~error_rate"""
+    __slots__ = ("bits", "size", "hashes", "count")
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(1000, capacity)
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+KNOWN_IDENTITY_FILTER = {
+    'filter': None,          # BloomFilter, None = chưa build xong -> coi như "có thể có"
+    'pending': [],           # key được thêm trong lúc đang build lại
+    'built_at': 0,
+    'filter_at': 0,          # lúc build filter đang dùng (built_at cũng đổi khi build lỗi)
+    'rebuild_interval': int(os.getenv("KNOWN_ID_FILTER_INTERVAL", "600")),  # giây
+    'rebuilding': False,
+    'negative': OrderedDict(),  # key -> thời điểm tra Sheets không thấy
+    'negative_ttl': 120,        # giây
+    'negative_max': 10000,
+    # Filter/negative cache là của từng worker: key do worker khác vừa ghi lên Sheets nằm trong
+    # bảng known_identities (SQLite dùng chung), tra bảng này trước khi trả lời "chắc chắn chưa có"
+    'db_path': os.getenv("CONTEXT_DB_PATH", "user_context.db"),
+    'shared_ttl': 86400,     # giây giữ key trong bảng; filter cũ hơn mức này không được dùng
+    'local': threading.local(),
+    'lock': threading.Lock(),
+    'stats': {
+        'checks': 0,
+        'skipped': 0,         # filter khẳng định chưa có -> không đọc Sheets
+        'negative_hits': 0,   # trùng cache kết quả rỗng gần đây
+        'shared_hits': 0,     # worker khác vừa ghi key này lên Sheets
+        'passed': 0,          # có thể có -> vẫn đọc Sheets
+        'rebuilds': 0,
+        'rebuild_errors': 0,
+        'added': 0
+    }
+}
+
+def _identity_keys(uid: str = None, phone: str = None) -> list:
+    keys = []
+    if uid:
+        keys.append(f"uid:{uid}")
+    phone_key = normalize_phone(phone)
+    if phone_key:
+        keys.append(f"phone:{phone_key}")
+    return keys
+
+def _known_identity_connection():
+    local = KNOWN_IDENTITY_FILTER['local']
+    conn = getattr(local, 'conn', None)
+    if conn is not None and getattr(local, 'pid', None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(KNOWN_IDENTITY_FILTER['db_path'], timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS known_identities (
+            key TEXT PRIMARY KEY,
+            added_at REAL NOT NULL
+        )
+    """)
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+def publish_known_identity_keys(keys: list):
+    """Ghi key vừa được process này ghi lên Sheets cho các worker khác thấy ngay"""
+    if not keys or not KNOWN_IDENTITY_FILTER['db_path']:
+        return
+    try:
+        now = time.time()
+        _known_identity_connection().executemany(
+            "INSERT OR REPLACE INTO known_identities (key, added_at) VALUES (?, ?)", [(key, now) for key in keys]
+        )
+    except Exception as e:
+        print(f"[KNOWN ID FILTER ERROR] Lỗi khi ghi key dùng chung: {e}")
+
+def find_shared_known_identity_keys(keys: list) -> dict:
+    """key -> lúc được ghi lên Sheets, cho các key đã được ghi (lỗi -> coi như tất cả vừa được ghi)"""
+    if not KNOWN_IDENTITY_FILTER['db_path']:
+        return {}
+    try:
+        return dict(_known_identity_connection().execute(
+            f"SELECT key, added_at FROM known_identities WHERE key IN ({', '.join('?' * len(keys))})", keys
+        ).fetchall())
+    except Exception as e:
+        print(f"[KNOWN ID FILTER ERROR] Lỗi khi đọc key dùng chung: {e}")
+        return dict.fromkeys(keys, time.time())
+
+def prune_shared_known_identities():
+    """Bỏ key cũ: filter của mọi worker đều phải build lại sau shared_ttl"""
+    if not KNOWN_IDENTITY_FILTER['db_path']:
+        return
+    try:
+        _known_identity_connection().execute(
+            "DELETE FROM known_identities WHERE added_at < ?", (time.time() - KNOWN_IDENTITY_FILTER['shared_ttl'],)
+        )
+    except Exception as e:
+        print(f"[KNOWN ID FILTER ERROR] Lỗi khi dọn key dùng chung: {e}")
+
+def rebuild_known_identity_filter() -> bool:
+    """Build lại filter từ cột user_id/phone của UserContext và index đơn hàng"""
+    state = KNOWN_IDENTITY_FILTER
+    try:
+        service = get_google_sheets_service()
+        if not service:
+            raise RuntimeError("Không có Google Sheets service")
+
+        # Chỉ đọc 2 cột cần thiết thay vì cả A:L
+        result = sheets_execute(service.spreadsheets().values().batchGet(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            ranges=[f"{USER_CONTEXT_SHEET_NAME}!A2:A", f"{USER_CONTEXT_SHEET_NAME}!I2:I"]
+        ), SHEETS_PRIORITY_BACKGROUND)
+        value_ranges = result.get('valueRanges', [])
+        columns = [[row[0] for row in vr.get('values', []) if row and row[0]] for vr in value_ranges]
+        uids = columns[0] if columns else []
+        phones = columns[1] if len(columns) > 1 else []
+
+        # Đơn hàng lấy từ index (đồng bộ nếu chưa có)
+        if not ORDER_HISTORY_INDEX['col_indices'] and not sync_order_history_index():
+            raise RuntimeError("Chưa đồng bộ được index đơn hàng")
+        with ORDER_HISTORY_INDEX['lock']:
+            uids.extend(ORDER_HISTORY_INDEX['by_uid'].keys())
+            phones.extend(ORDER_HISTORY_INDEX['by_phone'].keys())
+
+        bloom = BloomFilter(2 * (len(uids) + len(phones)))
+        for uid in uids:
+            bloom.add(f"uid:{uid}")
+        for phone in phones:
+            for key in _identity_keys(phone=phone):
+                bloom.add(key)
+
+        with state['lock']:
+            # Key được thêm trong lúc build (user/đơn mới) không được mất
+            for key in state['pending']:
+                bloom.add(key)
+            state['pending'] = []
+            state['filter'] = bloom
+            state['built_at'] = state['filter_at'] = time.time()
+            state['stats']['rebuilds'] += 1
+        prune_shared_known_identities()
+
+        print(f"[KNOWN ID FILTER] Đã build filter: {len(uids)} user_id, {len(phones)} số điện thoại, {len(bloom.bits) // 1024} KB")
+        return True
+
+    except Exception as e:
+        with state['lock']:
+            state['stats']['rebuild_errors'] += 1
+            state['built_at'] = time.time()  # Thử lại ở chu kỳ sau, không dồn dập
+        print(f"[KNOWN ID FILTER ERROR] Lỗi khi build filter: {e}")
+        return False
+    finally:
+        with state['lock']:
+            state['rebuilding'] = False
+
+def _schedule_filter_rebuild():
+    """Build lại filter ở thread nền khi đã cũ (gọi khi đang giữ lock)"""
+    state = KNOWN_IDENTITY_FILTER
+    if state['rebuilding'] or time.time() - state['built_at'] < state['rebuild_interval']:
+        return
+    state['rebuilding'] = True
+    state['pending'] = []
+    threading.Thread(target=rebuild_known_identity_filter, daemon=True).start()
+
+def remember_known_identity(uid: str = None, phone: str = None, publish: bool = True):
+    """
+    Ghi nhận user_id/số điện thoại vừa được ghi lên Sheets.
+    publish=False khi chỉ vừa đọc được từ Sheets (worker khác tự đọc, không cần báo)
+    """
+    state = KNOWN_IDENTITY_FILTER
+    keys = _identity_keys(uid, phone)
+    if publish:
+        publish_known_identity_keys(keys)
+    with state['lock']:
+        for key in keys:
+            state['negative'].pop(key, None)
+            if state['filter'] is not None:
+                state['filter'].add(key)
+            if state['rebuilding']:
+                state['pending'].append(key)
+            state['stats']['added'] += 1
+
+def remember_missing_identity(uid: str = None, phone: str = None):
+    """Lưu kết quả tra Sheets không thấy trong thời gian ngắn"""
+    state = KNOWN_IDENTITY_FILTER
+    now = time.time()
+    with state['lock']:
+        negative = state['negative']
+        for key in _identity_keys(uid, phone):
+            negative[key] = now
+            negative.move_to_end(key)
+        while len(negative) > state['negative_max']:
+            negative.popitem(last=False)
+
+def might_exist_in_sheets(uid: str = None, phone: str = None) -> bool:
+    """
+    False = chắc chắn uid/phone chưa có trên Sheets (khách nhắn lần đầu)
+    True = có thể có -> cần đọc Sheets
+    """
+    if not GOOGLE_SHEET_ID or not GOOGLE_SHEETS_CREDENTIALS_JSON:
+        return False
+
+    keys = _identity_keys(uid, phone)
+    if not keys:
+        return False
+
+    state = KNOWN_IDENTITY_FILTER
+    now = time.time()
+    with state['lock']:
+        stats = state['stats']
+        stats['checks'] += 1
+        _schedule_filter_rebuild()
+
+        negative = state['negative']
+        # Bỏ các kết quả rỗng đã hết hạn (cũ nhất ở đầu)
+        while negative:
+            key, seen_at = next(iter(negative.items()))
+            if now - seen_at <= state['negative_ttl']:
+                break
+            negative.popitem(last=False)
+        negative_hit = all(key in negative for key in keys)
+
+        bloom = state['filter']
+        # Filter cũ hơn thời gian giữ key dùng chung có thể thiếu key worker khác đã ghi
+        if not negative_hit and (bloom is None or now - state['filter_at'] > state['shared_ttl']
+                                 or any(key in bloom for key in keys)):
+            stats['passed'] += 1
+            return True
+
+    # Sắp trả lời "chắc chắn chưa có": worker khác có thể vừa append user/đơn này
+    shared = find_shared_known_identity_keys(keys)
+    with state['lock']:
+        # Kết quả rỗng chỉ còn đúng nếu tra Sheets sau lần ghi đó
+        shared = [key for key, added_at in shared.items() if added_at >= state['negative'].get(key, 0)]
+        if shared:
+            for key in shared:
+                state['negative'].pop(key, None)
+                if state['filter'] is not None:
+                    state['filter'].add(key)
+            stats['shared_hits'] += 1
+            stats['passed'] += 1
+            return True
+
+        stats['negative_hits' if negative_hit else 'skipped'] += 1
+        return False
+
+def get_known_identity_filter_stats() -> dict:
+    state = KNOWN_IDENTITY_FILTER
+    with state['lock']:
+        stats = dict(state['stats'])
+        bloom = state['filter']
+        stats['ready'] = bloom is not None
+        stats['keys'] = bloom.count if bloom else 0
+        stats['filter_bytes'] = len(bloom.bits) if bloom else 0
+        stats['negative_cached'] = len(state['negative'])
+        stats['built_at'] = state['built_at']
+        stats['filter_at'] = state['filter_at']
+    return stats
+
+def _reset_known_identity_filter_after_fork():
+    """Thread build lại không sống qua fork -> cờ rebuilding kế thừa sẽ chặn build mãi"""
+    KNOWN_IDENTITY_FILTER['lock'] = threading.Lock()
+    KNOWN_IDENTITY_FILTER['local'] = threading.local()
+    KNOWN_IDENTITY_FILTER['rebuilding'] = False
+
+os.register_at_fork(after_in_child=_reset_known_identity_filter_after_fork)
+
+# ============================================
+# USER CONTEXT GỌN NHẸ (__slots__ + RING BUFFER)
+# ============================================
+
+class RingBuffer(list):
+    """
+    List giới hạn kích thước: append() bỏ phần tử cũ nhất ở đầu,
+    appendleft() bỏ phần tử ở cuối. Vẫn là list nên slicing/json.dumps giữ nguyên.
+    """
+    __slots__ = ("maxlen",)
+
+    def __init__(self, iterable=(), maxlen=10):
+        super().__init__(iterable)
+        self.maxlen = maxlen
+
+    def append(self, item):
+        super().append(item)
+        if len(self) > self.maxlen:
+            del self[0]
+
+    def extend(self, items):
+        super().extend(items)
+        if len(self) > self.maxlen:
+            del self[:len(self) - self.maxlen]
+
+    def appendleft(self, item):
+        self.insert(0, item)
+        if len(self) > self.maxlen:
+            del self[self.maxlen:]
+
+# Các field có sẵn của mọi context, theo thứ tự
+USER_CONTEXT_FIELDS = (
+    "last_msg_time", "last_ms", "order_state", "order_data",
+    "real_message_count", "product_history", "conversation_history",
+    "referral_source", "referral_payload", "last_retailer_id", "catalog_view_time",
+    "has_sent_first_carousel", "last_processed_text", "poscake_orders",
+    "last_updated", "dirty", "last_saved",
+)
+_USER_CONTEXT_FIELD_SET = frozenset(USER_CONTEXT_FIELDS)
+# Mỗi field 1 bit để ghi nhận thay đổi bằng 1 số int thay vì 1 set mỗi user
+_USER_CONTEXT_FIELD_BITS = {field: 1 << i for i, field in enumerate(USER_CONTEXT_FIELDS)}
+
+# product_history: mới nhất ở đầu, giữ 5; conversation_history: mới nhất ở cuối, giữ 10 message
+CONTEXT_HISTORY_LIMITS = {
+    "product_history": 5,
+    "conversation_history": 10,
+}
+
+# Key cũ không còn nằm trong context (dedup đã chuyển sang bộ nhớ TTL dùng chung,
+# processing_lock thay bằng user lease)
+CONTEXT_LEGACY_KEYS = frozenset(("idempotent_postbacks", "processed_message_mids", "processing_lock"))
+
+class UserContext:
+    """
+    Context 1 user dạng __slots__ (không có __dict__ riêng cho mỗi user).
+    Dùng như dict để code cũ chạy nguyên: ctx["last_ms"], ctx.get(...), "key" in ctx,
+    ctx.items(). Key ngoài danh sách field (source_post_id, ...) nằm trong _extra.
+
+    Ghi nhận field cố định được gán lại (ctx[key] = value) kể từ lần lưu trước để chỉ ghi
+    các ô thay đổi lên Sheets. Sửa trực tiếp trong list/dict con KHÔNG được ghi nhận:
+    cần gán lại field hoặc gọi mark_changed(). update() không ghi nhận (dùng khi load).
+    """
+    __slots__ = USER_CONTEXT_FIELDS + ("_extra", "_changed", "_all_changed")
+
+    def __init__(self):
+        self.last_msg_time = 0
+        self.last_ms = None
+        self.order_state = None
+        self.order_data = {}
+        self.real_message_count = 0
+        self.product_history = RingBuffer(maxlen=CONTEXT_HISTORY_LIMITS["product_history"])
+        self.conversation_history = RingBuffer(maxlen=CONTEXT_HISTORY_LIMITS["conversation_history"])
+        self.referral_source = None
+        self.referral_payload = None
+        self.last_retailer_id = None
+        self.catalog_view_time = 0
+        self.has_sent_first_carousel = False
+        self.last_processed_text = ""
+        self.poscake_orders = []
+        self.last_updated = time.time()
+        self.dirty = False
+        self.last_saved = 0
+        self._extra = None
+        self._changed = 0
+        self._all_changed = False
+
+    @staticmethod
+    def _coerce(key, value):
+        """Chuyển list history thành RingBuffer đúng kích thước"""
+        limit = CONTEXT_HISTORY_LIMITS.get(key)
+        if limit is None or (isinstance(value, RingBuffer) and value.maxlen == limit):
+            return value
+        items = list(value or ())
+        items = items[:limit] if key == "product_history" else items[-limit:]
+        return RingBuffer(items, maxlen=limit)
+
+    def _set(self, key, value):
+        if key in _USER_CONTEXT_FIELD_SET:
+            setattr(self, key, self._coerce(key, value))
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __getitem__(self, key):
+        if key in _USER_CONTEXT_FIELD_SET:
+            return getattr(self, key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._set(key, value)
+        self._changed |= _USER_CONTEXT_FIELD_BITS.get(key, 0)
+
+    def __delitem__(self, key):
+        if key in _USER_CONTEXT_FIELD_SET:
+            # Field cố định: đưa về giá trị mặc định
+            setattr(self, key, getattr(UserContext(), key))
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+        self._changed |= _USER_CONTEXT_FIELD_BITS.get(key, 0)
+
+    def __contains__(self, key):
+        return key in _USER_CONTEXT_FIELD_SET or (self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(USER_CONTEXT_FIELDS) + (len(self._extra) if self._extra else 0)
+
+    def __repr__(self):
+        return f"UserContext({self.to_dict()!r})"
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(USER_CONTEXT_FIELDS) + (list(self._extra) if self._extra else [])
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, other=(), **kwargs):
+        """Gán nhiều field KHÔNG ghi nhận thay đổi (dùng khi load từ warm tier/Sheets)"""
+        pairs = other.items() if hasattr(other, "items") else other
+        for key, value in list(pairs) + list(kwargs.items()):
+            if key not in CONTEXT_LEGACY_KEYS:
+                self._set(key, value)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def mark_changed(self, *keys):
+        for key in keys:
+            self._changed |= _USER_CONTEXT_FIELD_BITS.get(key, 0)
+
+    def mark_all_changed(self):
+        """Lần lưu sau sẽ ghi toàn bộ dòng"""
+        self._all_changed = True
+
+    def mark_clean(self):
+        self._changed = 0
+        self._all_changed = False
+
+    def take_changes(self):
+        """
+        Lấy và reset danh sách field thay đổi.
+        Chỉ trả về các field có cột trên sheet. Trả về None nếu phải ghi toàn bộ
+        dòng (mark_all_changed, hoặc dirty mà không có field nào được ghi nhận
+        -> đã sửa trực tiếp trong list/dict con ở đâu đó).
+        """
+        changed_bits, self._changed = self._changed, 0
+        all_changed, self._all_changed = self._all_changed, False
+        if all_changed:
+            return None
+        changed = {key for key in CONTEXT_FIELD_COLUMNS if changed_bits & _USER_CONTEXT_FIELD_BITS[key]}
+        if not changed and self.dirty:
+            return None
+        return changed
+
 def default_user_context():
     """Tạo context mặc định cho user mới"""
-    return {
-        "last_msg_time": 0,
-        "last_ms": None,
-        "order_state": None,
-        "order_data": {},
-        "processing_lock": False,
-        "real_message_count": 0,
-        "product_history": [],
-        "conversation_history": [],
-        "referral_source": None,
-        "referral_payload": None,
-        "last_retailer_id": None,
-        "catalog_view_time": 0,
-        "has_sent_first_carousel": False,
-        "idempotent_postbacks": {},
-        "processed_message_mids": {},
-        "last_processed_text": "",
-        "poscake_orders": [],
-        "last_updated": time.time(),
-        "dirty": False,      # ← THÊM DÒNG NÀY
-        "last_saved": 0      # ← THÊM DÒNG NÀY
-    }
+    return UserContext()
+
+def push_product_history(ctx: dict, ms: str):
+    """Đưa MS lên đầu product_history (ring buffer 5 phần tử)"""
+    history = UserContext._coerce("product_history", ctx.get("product_history"))
+    if history[:1] == [ms]:
+        return
+    if ms in history:
+        history.remove(ms)
+    history.appendleft(ms)
+    # Gán lại để thay đổi được ghi nhận
+    ctx["product_history"] = history
+
+def push_conversation_turn(ctx: dict, user_text: str, reply: str):
+    """Thêm 1 lượt hỏi/đáp vào conversation_history (ring buffer 10 message)"""
+    history = UserContext._coerce("conversation_history", ctx.get("conversation_history"))
+    history.append({"role": "user", "content": user_text})
+    history.append({"role": "assistant", "content": reply})
+    ctx["conversation_history"] = history
 
 # ============================================
 # DIRTY FLAG HELPER FUNCTIONS
@@ -1269,20 +2668,848 @@ def normalize_vietnamese(text):
         result = result.replace(char, replacement)
     return result
 
+# ============================================
+# TIERED CONTEXT STORE: RAM (hot) -> SQLite (warm) -> Google Sheets (mirror)
+# ============================================
+
+# Các key chỉ có ý nghĩa trong RAM, không lưu xuống warm tier
+CONTEXT_TRANSIENT_KEYS = ("dirty", "last_saved")
+
+class ContextStore(ABC):
+    """
+    Interface lưu context user. USER_CONTEXT dùng như 1 dict:
+    - ctx = USER_CONTEXT[uid]  -> luôn trả về context (tạo mới nếu chưa có)
+    - USER_CONTEXT.get(uid)    -> None nếu không có ở tier nào
+    - del USER_CONTEXT[uid]    -> chỉ bỏ khỏi RAM (vẫn giữ ở tier bền vững)
+    - USER_CONTEXT.delete(uid) -> xóa hẳn khỏi store
+    """
+
+    @abstractmethod
+    def __getitem__(self, user_id):
+        ...
+
+    @abstractmethod
+    def __setitem__(self, user_id, context):
+        ...
+
+    @abstractmethod
+    def __delitem__(self, user_id):
+        ...
+
+    @abstractmethod
+    def __contains__(self, user_id):
+        ...
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    @abstractmethod
+    def get(self, user_id, default=None):
+        ...
+
+    def keys(self):
+        return [user_id for user_id, _ in self.items()]
+
+    def values(self):
+        return [context for _, context in self.items()]
+
+    @abstractmethod
+    def items(self):
+        ...
+
+    @abstractmethod
+    def persist(self, user_id, context=None):
+        """Ghi context xuống tier bền vững (không phải Sheets)"""
+
+    @abstractmethod
+    def delete(self, user_id):
+        ...
+
+    @abstractmethod
+    def find_uids_by_phone(self, phone):
+        ...
+
+    @abstractmethod
+    def find_uids_by_email(self, email):
+        ...
+
+    def get_stats(self):
+        return {}
+
+class SQLiteContextTier:
+    """Warm tier: SQLite (WAL) local, index theo user_id/phone/email, mỗi thread 1 connection"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.stats = {
+            'reads': 0,
+            'read_hits': 0,
+            'writes': 0,
+            'deletes': 0,
+            'errors': 0,
+            'total_read_ms': 0.0
+        }
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        # Không dùng lại connection của process cha sau khi gunicorn fork
+        if conn is not None and getattr(self.local, 'pid', None) == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_context (
+                user_id TEXT PRIMARY KEY,
+                phone TEXT,
+                email TEXT,
+                last_updated REAL,
+                data TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_context_phone ON user_context(phone)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_context_email ON user_context(email)")
+        # Phiên bản 1: phone/email lưu ở dạng chuẩn hóa để tra cứu khớp chính xác
+        if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            conn.create_function("normalize_phone", 1, normalize_phone)
+            conn.execute("UPDATE user_context SET phone = NULLIF(normalize_phone(phone), '') WHERE phone IS NOT NULL")
+            conn.execute("UPDATE user_context SET email = NULLIF(LOWER(TRIM(email)), '') WHERE email IS NOT NULL")
+            conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def load(self, user_id):
+        """Trả về (context, độ dài JSON) hoặc (None, 0)"""
+        started = time.perf_counter()
+        self.stats['reads'] += 1
+        try:
+            row = self._connection().execute(
+                "SELECT data FROM user_context WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[WARM TIER ERROR] Lỗi đọc user {user_id}: {e}")
+            return None, 0
+        finally:
+            self.stats['total_read_ms'] += (time.perf_counter() - started) * 1000
+
+        if not row:
+            return None, 0
+
+        self.stats['read_hits'] += 1
+        context = default_user_context()
+        try:
+            context.update(json.loads(row[0]))
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[WARM TIER ERROR] Dữ liệu hỏng cho user {user_id}: {e}")
+            return None, 0
+        context["dirty"] = False
+        context.mark_clean()
+        return context, len(row[0])
+
+    def exists(self, user_id):
+        try:
+            row = self._connection().execute(
+                "SELECT 1 FROM user_context WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            return row is not None
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[WARM TIER ERROR] Lỗi kiểm tra user {user_id}: {e}")
+            return False
+
+    def save(self, user_id, context):
+        """Ghi context, trả về độ dài JSON đã ghi (0 nếu lỗi)"""
+        data = {k: v for k, v in context.items() if k not in CONTEXT_TRANSIENT_KEYS}
+        order_data = context.get("order_data") or {}
+        try:
+            payload = json.dumps(data, ensure_ascii=False, default=str)
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO user_context (user_id, phone, email, last_updated, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, normalize_phone(order_data.get("phone")) or None,
+                 normalize_email(order_data.get("email")) or None,
+                 context.get("last_updated", time.time()), payload)
+            )
+            conn.commit()
+            self.stats['writes'] += 1
+            return len(payload)
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[WARM TIER ERROR] Lỗi ghi user {user_id}: {e}")
+            return 0
+
+    def delete(self, user_id):
+        try:
+            conn = self._connection()
+            conn.execute("DELETE FROM user_context WHERE user_id = ?", (user_id,))
+            conn.commit()
+            self.stats['deletes'] += 1
+            return True
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[WARM TIER ERROR] Lỗi xóa user {user_id}: {e}")
+            return False
+
+    def find_uids_by(self, column, value):
+        """Tra cứu uid theo phone/email (có index), mới nhất trước"""
+        if column not in ("phone", "email") or not value:
+            return []
+        try:
+            rows = self._connection().execute(
+                f"SELECT user_id FROM user_context WHERE {column} = ? ORDER BY last_updated DESC",
+                (value,)
+            ).fetchall()
+            return [row[0] for row in rows]
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[WARM TIER ERROR] Lỗi tra cứu {column}: {e}")
+            return []
+
+    def count(self):
+        try:
+            return self._connection().execute("SELECT COUNT(*) FROM user_context").fetchone()[0]
+        except Exception:
+            return 0
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['path'] = self.path
+        stats['users'] = self.count()
+        stats['avg_read_ms'] = round(stats['total_read_ms'] / stats['reads'], 3) if stats['reads'] else 0
+        stats['total_read_ms'] = round(stats['total_read_ms'], 1)
+        return stats
+
+# Ước lượng RAM của 1 context: phần cố định (object __slots__ + container rỗng)
+# cộng khoảng 3 byte RAM cho mỗi ký tự JSON của dữ liệu
+CONTEXT_BASE_BYTES = 600
+CONTEXT_BYTES_PER_JSON_CHAR = 3
+
+def estimate_context_bytes(json_length: int = 0) -> int:
+    return CONTEXT_BASE_BYTES + CONTEXT_BYTES_PER_JSON_CHAR * json_length
+
+class _ContextShard:
+    """1 phân vùng của hot tier: LRU riêng, lock riêng, snapshot copy-on-write riêng"""
+    __slots__ = ("hot", "sizes", "accessed", "hot_bytes", "lock", "snapshot", "stats")
+
+    def __init__(self):
+        self.hot = OrderedDict()
+        self.sizes = {}
+        self.accessed = {}  # user_id -> lần truy cập cuối, cùng thứ tự với LRU (dùng cho evict_idle)
+        self.hot_bytes = 0
+        self.lock = threading.RLock()
+        self.snapshot = None  # tuple (user_id, context), None = cần dựng lại
+        self.stats = {
+            'hot_hits': 0,
+            'warm_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'idle_evictions': 0
+        }
+
+class TieredContextStore(ContextStore):
+    """
+    Hot tier: chia thành nhiều shard theo hash(user_id), mỗi shard 1 lock và 1
+    OrderedDict theo thứ tự truy cập (LRU) nên thread xử lý user khác nhau ít chờ nhau.
+    User ít dùng nhất nằm đầu OrderedDict nên đẩy ra là O(1); mỗi shard được 1 phần
+    ngân sách RAM. items() trả về snapshot copy-on-write: chỉ dựng lại khi shard có
+    user được thêm/bớt, thread nền duyệt thoải mái mà không khóa webhook.
+    Warm tier: SQLite local, user bị đẩy khỏi RAM vẫn load lại được trong vài ms.
+    Google Sheets chỉ là bản mirror, được ghi bất đồng bộ qua write-behind buffer.
+    """
+
+    def __init__(self, warm_tier, memory_budget=32 * 1024 * 1024, hot_limit=0, shards=16):
+        self.shards = [_ContextShard() for _ in range(max(1, shards))]
+        self.memory_budget = memory_budget
+        self.hot_limit = hot_limit  # 0 = không giới hạn số user, chỉ theo RAM
+        self.shard_budget = memory_budget // len(self.shards)
+        self.shard_limit = -(-hot_limit // len(self.shards)) if hot_limit else 0
+        self.warm = warm_tier
+
+    def _shard(self, user_id):
+        return self.shards[hash(user_id) % len(self.shards)]
+
+    def _insert(self, shard, user_id, context, size=None):
+        """Thêm/cập nhật user ở cuối LRU, trả về danh sách user bị đẩy ra (gọi khi đang giữ lock)"""
+        if size is None:
+            size = shard.sizes.get(user_id) or estimate_context_bytes()
+        if shard.hot.get(user_id) is not context:
+            shard.snapshot = None
+        shard.hot_bytes += size - shard.sizes.get(user_id, 0)
+        shard.sizes[user_id] = size
+        shard.accessed[user_id] = time.time()
+        shard.hot[user_id] = context
+        shard.hot.move_to_end(user_id)
+        return self._evict_over_budget(shard)
+
+    def _pop(self, shard, user_id):
+        """Bỏ user khỏi hot tier (gọi khi đang giữ lock)"""
+        context = shard.hot.pop(user_id, None)
+        if context is not None:
+            shard.snapshot = None
+        shard.hot_bytes -= shard.sizes.pop(user_id, 0)
+        shard.accessed.pop(user_id, None)
+        return context
+
+    def _over_budget(self, shard):
+        if self.shard_limit and len(shard.hot) > self.shard_limit:
+            return True
+        return shard.hot_bytes > self.shard_budget
+
+    def _evict_over_budget(self, shard):
+        """Lấy các user ít dùng nhất ra khỏi RAM khi vượt ngân sách (gọi khi đang giữ lock)"""
+        evicted = []
+        # Luôn giữ lại user vừa truy cập (nằm cuối)
+        while len(shard.hot) > 1 and self._over_budget(shard):
+            user_id = next(iter(shard.hot))
+            evicted.append((user_id, self._pop(shard, user_id)))
+        shard.stats['evictions'] += len(evicted)
+        return evicted
+
+    def _spill(self, evicted):
+        """
+        Lưu các user vừa rời RAM (gọi SAU khi nhả lock):
+        dirty thì vào write-behind (đã ghi warm tier), không thì chỉ ghi warm
+        """
+        for user_id, context in evicted:
+            if context.get("dirty", False):
+                queue_context_save(user_id, context)
+            elif self.warm:
+                self.warm.save(user_id, context)
+            # Đã ở warm tier (có index phone/email) -> bỏ khỏi index liên hệ trong RAM
+            forget_user_contact(user_id)
+
+    def _load(self, user_id):
+        """Tìm context ở hot rồi warm tier, đưa lên cuối LRU"""
+        shard = self._shard(user_id)
+        with shard.lock:
+            context = shard.hot.get(user_id)
+            if context is not None:
+                shard.stats['hot_hits'] += 1
+                shard.accessed[user_id] = time.time()
+                shard.hot.move_to_end(user_id)
+                return context
+
+        context, json_length = self.warm.load(user_id) if self.warm else (None, 0)
+        if context is None:
+            return None
+
+        with shard.lock:
+            # Thread khác có thể đã load trước
+            existing = shard.hot.get(user_id)
+            if existing is not None:
+                return existing
+            shard.stats['warm_hits'] += 1
+            evicted = self._insert(shard, user_id, context, estimate_context_bytes(json_length))
+        self._spill(evicted)
+        return context
+
+    def __getitem__(self, user_id):
+        context = self._load(user_id)
+        if context is not None:
+            return context
+
+        shard = self._shard(user_id)
+        evicted = []
+        with shard.lock:
+            context = shard.hot.get(user_id)
+            if context is None:
+                shard.stats['misses'] += 1
+                context = default_user_context()
+                evicted = self._insert(shard, user_id, context)
+        self._spill(evicted)
+        return context
+
+    def __setitem__(self, user_id, context):
+        shard = self._shard(user_id)
+        with shard.lock:
+            evicted = self._insert(shard, user_id, context)
+        self._spill(evicted)
+        self.persist(user_id, context)
+
+    def __delitem__(self, user_id):
+        shard = self._shard(user_id)
+        with shard.lock:
+            if user_id not in shard.hot:
+                raise KeyError(user_id)
+            context = self._pop(shard, user_id)
+        self._spill([(user_id, context)])
+
+    def __contains__(self, user_id):
+        shard = self._shard(user_id)
+        with shard.lock:
+            if user_id in shard.hot:
+                return True
+        return bool(self.warm and self.warm.exists(user_id))
+
+    def __len__(self):
+        return sum(len(shard.hot) for shard in self.shards)
+
+    def get(self, user_id, default=None):
+        context = self._load(user_id)
+        return context if context is not None else default
+
+    def items(self):
+        """
+        Snapshot các user đang ở hot tier (không đổi thứ tự LRU).
+        Shard không có user thêm/bớt từ lần trước thì dùng lại tuple cũ, không copy.
+        """
+        result = []
+        for shard in self.shards:
+            snapshot = shard.snapshot
+            if snapshot is None:
+                with shard.lock:
+                    if shard.snapshot is None:
+                        shard.snapshot = tuple(shard.hot.items())
+                    snapshot = shard.snapshot
+            result.extend(snapshot)
+        return result
+
+    def persist(self, user_id, context=None):
+        """Ghi context xuống warm tier, đồng thời cập nhật ước lượng RAM của user"""
+        shard = self._shard(user_id)
+        if context is None:
+            with shard.lock:
+                context = shard.hot.get(user_id)
+        if context is None or not self.warm:
+            return False
+
+        json_length = self.warm.save(user_id, context)
+        if not json_length:
+            return False
+
+        evicted = []
+        with shard.lock:
+            if shard.hot.get(user_id) is context:
+                size = estimate_context_bytes(json_length)
+                shard.hot_bytes += size - shard.sizes.get(user_id, 0)
+                shard.sizes[user_id] = size
+                if self._over_budget(shard):
+                    evicted = self._evict_over_budget(shard)
+        self._spill(evicted)
+        return True
+
+    def evict_idle(self, max_idle_seconds):
+        """
+        Đẩy khỏi RAM các user không được truy cập trong max_idle_seconds: mỗi shard duyệt từ đầu LRU,
+        dừng ở user đầu tiên còn hoạt động. Thời điểm truy cập được ghi cùng lúc đưa user về cuối LRU
+        nên cùng thứ tự với LRU -> dừng sớm không bỏ sót ai. Trả về số user đã đẩy ra.
+        """
+        cutoff = time.time() - max_idle_seconds
+        total = 0
+        for shard in self.shards:
+            evicted = []
+            with shard.lock:
+                while shard.hot:
+                    user_id = next(iter(shard.hot))
+                    if shard.accessed.get(user_id, 0) > cutoff:
+                        break
+                    evicted.append((user_id, self._pop(shard, user_id)))
+                shard.stats['idle_evictions'] += len(evicted)
+            self._spill(evicted)
+            total += len(evicted)
+        return total
+
+    def delete(self, user_id):
+        shard = self._shard(user_id)
+        with shard.lock:
+            self._pop(shard, user_id)
+        forget_user_contact(user_id)
+        if self.warm:
+            self.warm.delete(user_id)
+
+    def find_uids_by_phone(self, phone):
+        return self.warm.find_uids_by("phone", normalize_phone(phone)) if self.warm else []
+
+    def find_uids_by_email(self, email):
+        return self.warm.find_uids_by("email", normalize_email(email)) if self.warm else []
+
+    def get_stats(self):
+        stats = defaultdict(int)
+        for shard in self.shards:
+            with shard.lock:
+                for key, value in shard.stats.items():
+                    stats[key] += value
+                stats['hot_users'] += len(shard.hot)
+                stats['hot_bytes'] += shard.hot_bytes
+        stats = dict(stats)
+        stats['shards'] = len(self.shards)
+        stats['memory_budget'] = self.memory_budget
+        stats['hot_limit'] = self.hot_limit
+        stats['warm'] = self.warm.get_stats() if self.warm else None
+        return stats
+
+def create_context_store() -> ContextStore:
+    """Tạo context store theo cấu hình môi trường"""
+    memory_budget = int(float(os.getenv("CONTEXT_HOT_MEMORY_MB", "32")) * 1024 * 1024)
+    hot_limit = int(os.getenv("CONTEXT_HOT_MAX_USERS", "0"))
+    shards = int(os.getenv("CONTEXT_SHARDS", "16"))
+    db_path = os.getenv("CONTEXT_DB_PATH", "user_context.db")
+    warm_tier = SQLiteContextTier(db_path) if db_path else None
+    print(f"[CONTEXT STORE] Hot tier tối đa {memory_budget // 1048576}MB"
+          f"{f' / {hot_limit} users' if hot_limit else ''} ({shards} shards), warm tier: {db_path or 'tắt'}")
+    return TieredContextStore(warm_tier, memory_budget=memory_budget, hot_limit=hot_limit, shards=shards)
+
 # ============================================
 # GLOBAL STATE
 # ============================================
-USER_CONTEXT = defaultdict(default_user_context)
+USER_CONTEXT = create_context_store()
+
+def persist_hot_contexts():
+    """Ghi các user dirty trong RAM xuống warm tier khi process thoát"""
+    saved = 0
+    for user_id, context in USER_CONTEXT.items():
+        if context.get("dirty", False) and USER_CONTEXT.persist(user_id, context):
+            saved += 1
+    if saved:
+        print(f"[CONTEXT STORE] Đã ghi {saved} users dirty xuống warm tier trước khi thoát")
+
+atexit.register(persist_hot_contexts)
+
+# ============================================
+# INDEX LIÊN HỆ KHÁCH HÀNG (phone/email -> user_id)
+# RAM chỉ cho user đang ở hot tier (bỏ khi user bị evict/xóa), warm tier cho user đã bị evict
+# ============================================
+
+CONTACT_INDEX = {
+    'by_phone': {},  # phone đã chuẩn hóa -> user_id
+    'by_email': {},  # email đã chuẩn hóa -> user_id
+    'by_user': {},   # user_id -> (phone, email) đang index, để gỡ khi user đổi số hoặc rời RAM
+    'lock': threading.Lock(),
+    'stats': {
+        'updates': 0,
+        'forgets': 0,
+        'lookups': 0,
+        'memory_hits': 0,
+        'warm_hits': 0,
+        'order_hits': 0,
+        'misses': 0
+    }
+}
+
+def index_user_contact(user_id: str, order_data: dict = None):
+    """Cập nhật index mỗi khi order_data (phone/email) của user được ghi"""
+    if not user_id or not order_data:
+        return
+    phone_key = normalize_phone(order_data.get("phone"))
+    email_key = normalize_email(order_data.get("email"))
+    if not phone_key and not email_key:
+        return
+    with CONTACT_INDEX['lock']:
+        old_phone, old_email = CONTACT_INDEX['by_user'].get(user_id, (None, None))
+        phone_key = phone_key or old_phone
+        email_key = email_key or old_email
+        # Số/email cũ không còn trỏ về user này nữa
+        _unindex_contact_keys(user_id,
+                              old_phone if old_phone != phone_key else None,
+                              old_email if old_email != email_key else None)
+        if phone_key:
+            CONTACT_INDEX['by_phone'][phone_key] = user_id
+        if email_key:
+            CONTACT_INDEX['by_email'][email_key] = user_id
+        CONTACT_INDEX['by_user'][user_id] = (phone_key, email_key)
+        CONTACT_INDEX['stats']['updates'] += 1
+
+def _unindex_contact_keys(user_id: str, phone_key: str = None, email_key: str = None):
+    """Gỡ phone/email khỏi index nếu vẫn trỏ về user_id (gọi khi đang giữ lock)"""
+    if phone_key and CONTACT_INDEX['by_phone'].get(phone_key) == user_id:
+        del CONTACT_INDEX['by_phone'][phone_key]
+    if email_key and CONTACT_INDEX['by_email'].get(email_key) == user_id:
+        del CONTACT_INDEX['by_email'][email_key]
+
+def forget_user_contact(user_id: str):
+    """User rời hot tier (evict) hoặc bị xóa: bỏ khỏi index RAM, lần tra sau đi qua warm tier"""
+    with CONTACT_INDEX['lock']:
+        keys = CONTACT_INDEX['by_user'].pop(user_id, None)
+        if keys:
+            _unindex_contact_keys(user_id, *keys)
+            CONTACT_INDEX['stats']['forgets'] += 1
+
+def find_uid_by_contact(phone: str = None, email: str = None) -> Optional[str]:
+    """
+    Tìm user_id theo số điện thoại rồi email, không duyệt USER_CONTEXT:
+    1. Index trong RAM
+    2. Warm tier (SQLite, có index phone/email) - user đã bị evict khỏi RAM
+    3. Index lịch sử đơn hàng (cột Facebook User ID của sheet Orders)
+    """
+    phone_key = normalize_phone(phone)
+    email_key = normalize_email(email)
+    stats = CONTACT_INDEX['stats']
+
+    with CONTACT_INDEX['lock']:
+        stats['lookups'] += 1
+        user_id = ((phone_key and CONTACT_INDEX['by_phone'].get(phone_key))
+                   or (email_key and CONTACT_INDEX['by_email'].get(email_key)))
+        if user_id:
+            stats['memory_hits'] += 1
+            return user_id
+
+    # Không đưa kết quả vào index RAM: warm tier/index đơn hàng đã tra theo key, user có thể không ở hot tier
+    uids = (phone_key and USER_CONTEXT.find_uids_by_phone(phone_key)) or \
+           (email_key and USER_CONTEXT.find_uids_by_email(email_key))
+    if uids:
+        stats['warm_hits'] += 1
+        return uids[0]
+
+    with ORDER_HISTORY_INDEX['lock']:
+        entries = ORDER_HISTORY_INDEX['by_phone'].get(phone_key, ()) if phone_key else ()
+        user_id = next((order.get("user_id") for _, order in entries if order.get("user_id")), None)
+    if not user_id:
+        stats['misses'] += 1
+        return None
+    stats['order_hits'] += 1
+    return user_id
+
+def get_contact_index_stats() -> dict:
+    with CONTACT_INDEX['lock']:
+        stats = dict(CONTACT_INDEX['stats'])
+        stats['phones'] = len(CONTACT_INDEX['by_phone'])
+        stats['emails'] = len(CONTACT_INDEX['by_email'])
+        stats['users'] = len(CONTACT_INDEX['by_user'])
+    return stats
+
+# ============================================
+# LEADER ELECTION GIỮA CÁC WORKER GUNICORN (SQLite lease)
+# Job singleton (keep-alive, compaction, lưu full định kỳ) chỉ chạy ở process giữ lease;
+# leader chết -> lease hết hạn -> process khác tự lên thay
+# ============================================
+
+LEADER_LEASE = {
+    'name': 'singleton_jobs',
+    'path': os.getenv("LEADER_LEASE_DB_PATH", os.getenv("CONTEXT_DB_PATH", "user_context.db")),
+    'ttl': int(os.getenv("LEADER_LEASE_TTL", "60")),  # giây
+    'renew_interval': int(os.getenv("LEADER_LEASE_RENEW_INTERVAL", "15")),  # giây, nhỏ hơn nhiều so với ttl
+    'is_leader': False,
+    'expires_at': 0,
+    'pid': None,       # process đang chạy thread gia hạn (khởi động lại sau fork)
+    'retired_pid': None,  # process đã fork worker (gunicorn master preload) -> không tranh lease nữa
+    'lock': threading.Lock(),
+    'local': threading.local(),
+    'stats': {
+        'acquired': 0,
+        'renewals': 0,
+        'lost': 0,
+        'errors': 0
+    }
+}
+
+def leader_holder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _leader_connection():
+    local = LEADER_LEASE['local']
+    conn = getattr(local, 'conn', None)
+    if conn is not None and getattr(local, 'pid', None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(LEADER_LEASE['path'], timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            pid INTEGER,
+            acquired_at REAL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+def try_acquire_leader_lease() -> bool:
+    """Giành hoặc gia hạn lease; trả về True nếu process hiện tại là leader"""
+    lease = LEADER_LEASE
+    if lease['retired_pid'] == os.getpid():
+        return False
+    # Không có file lease (VD: chạy 1 process) -> tự là leader
+    if not lease['path']:
+        lease['is_leader'] = True
+        return True
+
+    holder = leader_holder_id()
+    now = time.time()
+    try:
+        conn = _leader_connection()
+        # BEGIN IMMEDIATE: chỉ 1 process đọc-rồi-ghi lease tại một thời điểm
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT holder, acquired_at, expires_at FROM leases WHERE name = ?", (lease['name'],)
+            ).fetchone()
+            # Kiểm tra lại trong transaction: master có thể vừa nghỉ hưu trong lúc thread gia hạn đang chạy
+            is_leader = lease['retired_pid'] != os.getpid() and (row is None or row[0] == holder or row[2] < now)
+            if is_leader:
+                acquired_at = row[1] if row is not None and row[0] == holder else now
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, holder, pid, acquired_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (lease['name'], holder, os.getpid(), acquired_at, now + lease['ttl'])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    except Exception as e:
+        lease['stats']['errors'] += 1
+        print(f"[LEADER ERROR] Lỗi khi giành lease: {e}")
+        # Không chắc còn giữ lease -> tự hạ xuống khi lease cũ đã hết hạn
+        is_leader = lease['is_leader'] and now < lease['expires_at']
+
+    with lease['lock']:
+        was_leader = lease['is_leader']
+        lease['is_leader'] = is_leader
+        if is_leader:
+            lease['expires_at'] = now + lease['ttl']
+            lease['stats']['renewals' if was_leader else 'acquired'] += 1
+        elif was_leader:
+            lease['stats']['lost'] += 1
+
+    if is_leader and not was_leader:
+        print(f"[LEADER] Process {holder} đã giành lease, chạy các job singleton")
+    elif was_leader and not is_leader:
+        print(f"[LEADER] Process {holder} đã mất lease")
+    return is_leader
+
+def release_leader_lease():
+    """Nhả lease khi thoát để process khác lên thay ngay, không chờ hết hạn"""
+    lease = LEADER_LEASE
+    if not lease['path'] or not lease['is_leader'] or lease['pid'] != os.getpid():
+        return
+    try:
+        _leader_connection().execute(
+            "DELETE FROM leases WHERE name = ? AND holder = ?", (lease['name'], leader_holder_id())
+        )
+        lease['is_leader'] = False
+    except Exception as e:
+        print(f"[LEADER ERROR] Lỗi khi nhả lease: {e}")
+
+atexit.register(release_leader_lease)
+
+def retire_from_leader_election():
+    """
+    Trước khi fork (gunicorn master với preload_app): master không phục vụ request,
+    không giữ context user -> nhả lease đã giành lúc import và không bao giờ tranh lại
+    """
+    lease = LEADER_LEASE
+    with lease['lock']:
+        lease['retired_pid'] = os.getpid()
+        lease['pid'] = None  # thread gia hạn của master tự thoát
+        lease['is_leader'] = False
+        lease['expires_at'] = 0
+    if not lease['path']:
+        return
+    try:
+        _leader_connection().execute(
+            "DELETE FROM leases WHERE name = ? AND holder = ?", (lease['name'], leader_holder_id())
+        )
+    except Exception as e:
+        print(f"[LEADER ERROR] Lỗi khi nhả lease trước khi fork: {e}")
+
+def _reset_leader_lease_after_fork():
+    """Worker vừa fork: lock/kết nối/trạng thái kế thừa từ master không dùng được"""
+    lease = LEADER_LEASE
+    lease['lock'] = threading.Lock()
+    lease['local'] = threading.local()
+    lease['pid'] = None
+    lease['is_leader'] = False
+    lease['expires_at'] = 0
+
+os.register_at_fork(before=retire_from_leader_election, after_in_child=_reset_leader_lease_after_fork)
+
+def leader_election_worker():
+    """Thread gia hạn lease định kỳ (mỗi process 1 thread)"""
+    while LEADER_LEASE['pid'] == os.getpid():
+        try_acquire_leader_lease()
+        time.sleep(LEADER_LEASE['renew_interval'])
+
+def start_leader_election():
+    """Khởi động thread gia hạn lease cho process hiện tại (cả sau khi gunicorn fork)"""
+    lease = LEADER_LEASE
+    with lease['lock']:
+        if lease['pid'] == os.getpid() or lease['retired_pid'] == os.getpid():
+            return None
+        lease['pid'] = os.getpid()
+        # Trạng thái kế thừa từ process cha không có giá trị
+        lease['is_leader'] = False
+        lease['expires_at'] = 0
+
+    try_acquire_leader_lease()
+    worker_thread = threading.Thread(target=leader_election_worker, daemon=True)
+    worker_thread.start()
+    return worker_thread
+
+def is_leader() -> bool:
+    """Process hiện tại có được chạy job singleton không"""
+    start_leader_election()
+    lease = LEADER_LEASE
+    return lease['is_leader'] and time.time() < lease['expires_at']
+
+def get_leader_stats() -> dict:
+    """Process đang giữ lease và trạng thái của process hiện tại cho /stats"""
+    lease = LEADER_LEASE
+    stats = dict(lease['stats'])
+    stats['this_process'] = leader_holder_id()
+    stats['is_leader'] = is_leader()
+    stats['holder'] = stats['this_process'] if stats['is_leader'] else None
+    if lease['path']:
+        try:
+            row = _leader_connection().execute(
+                "SELECT holder, acquired_at, expires_at FROM leases WHERE name = ?", (lease['name'],)
+            ).fetchone()
+            if row:
+                stats['holder'] = row[0]
+                stats['holder_since'] = row[1]
+                stats['expires_in'] = round(row[2] - time.time(), 1)
+        except Exception as e:
+            stats['error'] = str(e)
+    return stats
 
 # ============================================
 # GLOBAL IDEMPOTENCY & ASYNC PROCESSING
 # ============================================
 
 # Lưu trữ các message ID đã xử lý trong 5 phút qua để tránh xử lý trùng lặp
-PROCESSED_MIDS = {}
+# (OrderedDict theo thời gian thêm vào: key cũ nhất nằm đầu)
+PROCESSED_MIDS = OrderedDict()
 PROCESSED_MIDS_LOCK = threading.Lock()
 PROCESSED_MIDS_TTL = 300  # 5 phút = 300 giây
 
+# Postback đã xử lý (dùng chung mọi user, thay cho idempotent_postbacks trong từng context)
+IDEMPOTENT_POSTBACKS = OrderedDict()
+IDEMPOTENT_POSTBACKS_LOCK = threading.Lock()
+IDEMPOTENT_POSTBACKS_TTL = 300  # 5 phút
+
+def ttl_seen_before(store: OrderedDict, key: str, ttl: float, now: float = None) -> bool:
+    """
+    Kiểm tra key đã có trong store (còn hạn) chưa, nếu chưa thì đánh dấu.
+    Gọi khi đang giữ lock của store. Chỉ duyệt các key đã hết hạn ở đầu store.
+    """
+    if now is None:
+        now = time.time()
+    
+    while store:
+        oldest_key = next(iter(store))
+        if now - store[oldest_key] <= ttl:
+            break
+        store.popitem(last=False)
+    
+    if key in store:
+        return True
+    
+    store[key] = now
+    return False
+
 # Queue để xử lý tin nhắn bất đồng bộ
 MESSAGE_QUEUE = Queue()
 MESSAGE_WORKER_RUNNING = False
@@ -1312,6 +3539,10 @@ def keep_alive_ping():
     if not KOYEB_KEEP_ALIVE_ENABLED:
         return
     
+    # Mọi worker dùng chung 1 URL -> chỉ leader ping
+    if not is_leader():
+        return
+    
     try:
         # Ping endpoint /ping hoặc /health
         ping_url = f"{APP_URL}/ping"
@@ -1368,7 +3599,11 @@ def warm_up_app():
         global PRODUCTS_LOADED_ON_STARTUP
         try:
             print(f"[WARM-UP] Đang load products...")
-            load_products(force=True)
+            load_catalog_snapshot()
+            if catalog_download_allowed():
+                refresh_products()
+            else:
+                sync_shared_catalog(force=True)
             PRODUCTS_LOADED_ON_STARTUP = True
             print(f"[WARM-UP] Đã load {len(PRODUCTS)} products")
         except Exception as e:
@@ -1540,24 +3775,8 @@ def is_message_processed(mid: str) -> bool:
         return False
     
     with PROCESSED_MIDS_LOCK:
-        now = time.time()
-        
-        # Dọn dẹp các MIDs cũ
-        mids_to_remove = []
-        for existing_mid, timestamp in PROCESSED_MIDS.items():
-            if now - timestamp > PROCESSED_MIDS_TTL:
-                mids_to_remove.append(existing_mid)
-        
-        for mid_to_remove in mids_to_remove:
-            del PROCESSED_MIDS[mid_to_remove]
-        
-        # Kiểm tra MID hiện tại
-        if mid in PROCESSED_MIDS:
-            return True
-        
-        # Thêm MID mới
-        PROCESSED_MIDS[mid] = now
-        return False
+        # Dọn MIDs hết hạn, kiểm tra và đánh dấu MID hiện tại
+        return ttl_seen_before(PROCESSED_MIDS, mid, PROCESSED_MIDS_TTL)
 
 
 def mark_message_processing(uid: str, message_id: str) -> bool:
@@ -1675,9 +3894,8 @@ def process_facebook_message(data: dict, client_ip: str, user_agent: str):
                     payload = event['postback'].get('payload', '')
                     print(f"[POSTBACK PROCESS] User {sender_id}: {payload}")
                     
-                    # Xử lý postback với lock
-                    postback_lock = get_postback_lock(sender_id, payload)
-                    with postback_lock:
+                    # Xử lý postback với lease theo user + payload
+                    with acquire_user_lease(sender_id, f"postback:{payload}"):
                         handle_postback_with_recovery(sender_id, payload)
                     continue
                 
@@ -1791,9 +4009,21 @@ def process_facebook_message(data: dict, client_ip: str, user_agent: str):
 # Cache để giảm số lần gọi Google Sheets API
 SHEETS_CACHE = {
     'last_read': 0,
-    'cache_ttl': 30,  # Cache 30 giây
-    'user_row_map': {},
-    'existing_values': []
+    'cache_ttl': 30,        # Chu kỳ đồng bộ tăng dần (giây)
+    'max_staleness': 300,   # Worker trễ quá lâu -> đồng bộ trực tiếp khi đọc
+    'user_row_map': {},     # user_id -> số dòng trên sheet
+    'existing_values': [],  # Các dòng cột A (user_id) từ dòng 2
+    'layout_version': None, # version bố cục dòng (SQLite dùng chung) ứng với user_row_map
+    'lock': threading.Lock(),
+    'running': False,
+    'stats': {
+        'full_syncs': 0,
+        'incremental_syncs': 0,
+        'shifts_detected': 0,
+        'layout_resyncs': 0,
+        'rows_fetched': 0,
+        'errors': 0
+    }
 }
 
 # ============================================
@@ -1858,10 +4088,7 @@ def generate_marketing_message(ms: str, user_name: str) -> str:
         return None
     
     product = PRODUCTS[ms]
-    product_name = product.get('Ten', '')
-    # Làm sạch tên sản phẩm (loại bỏ mã nếu có)
-    if f"[{ms}]" in product_name or ms in product_name:
-        product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+    product_name = product.get('display_name', '')
     
     mo_ta = product.get("MoTa", "")
     
@@ -2095,41 +4322,25 @@ def update_context_with_new_ms(uid: str, new_ms: str, source: str = "unknown"):
     ctx["referral_source"] = source
     
     # Gọi hàm update_product_context cũ
-    if "product_history" not in ctx:
-        ctx["product_history"] = []
-    
-    if not ctx["product_history"] or ctx["product_history"][0] != new_ms:
-        if new_ms in ctx["product_history"]:
-            ctx["product_history"].remove(new_ms)
-        ctx["product_history"].insert(0, new_ms)
-    
-    if len(ctx["product_history"]) > 5:
-        ctx["product_history"] = ctx["product_history"][:5]
+    push_product_history(ctx, new_ms)
     
     # Cập nhật thời gian
     ctx["last_updated"] = time.time()
     ctx["dirty"] = True  # ← THÊM DÒNG NÀY
     
     # ============================================
-    # QUAN TRỌNG: LƯU NGAY VÀO GOOGLE SHEETS KHI MS THAY ĐỔI
+    # QUAN TRỌNG: LƯU VÀO GOOGLE SHEETS KHI MS THAY ĐỔI
+    # Đưa vào write-behind buffer, được gộp và flush trong vài giây
     # ============================================
-    def save_immediately():
-        try:
-            print(f"[IMMEDIATE SAVE] Đang lưu ngay context cho user {uid} với MS {new_ms}...")
-            # Gọi hàm save_single_user_to_sheets trực tiếp
-            save_single_user_to_sheets(uid, ctx)
-            print(f"[IMMEDIATE SAVE COMPLETE] Đã lưu xong user {uid} vào Google Sheets")
-        except Exception as e:
-            print(f"[IMMEDIATE SAVE ERROR] Lỗi khi lưu ngay user {uid}: {e}")
-    
-    # Chạy trong thread riêng để không block bot
-    threading.Thread(target=save_immediately, daemon=True).start()
+    queue_context_save(uid, ctx)
     # ============================================
     
     print(f"[CONTEXT UPDATE COMPLETE] Đã cập nhật MS {new_ms} cho user {uid} (nguồn: {source}, real_message_count: {ctx['real_message_count']}, has_sent_first_carousel: {ctx['has_sent_first_carousel']})")
     
     return True
     
+RESTORE_PHONE_LOOKUP_TIMEOUT = 1.5  # giây tối đa chờ đồng bộ Orders khi tra theo số điện thoại
+
 def restore_user_context_on_wakeup(uid: str):
     """Khôi phục context cho user khi app wake up từ sleep - ƯU TIÊN LOAD TỪ SHEETS"""
     # 1. Thử load từ USER_CONTEXT trong RAM (nếu còn)
@@ -2161,31 +4372,29 @@ def restore_user_context_on_wakeup(uid: str):
                 "phone": latest_order.get("phone", ""),
                 "customer_name": latest_order.get("customer_name", "")
             }
+            index_user_contact(uid, ctx["order_data"])
             
             print(f"[RESTORE CONTEXT] Đã khôi phục context cho user {uid} từ đơn hàng: {last_ms}")
             return True
     
-    # 4. Thử tìm bằng số điện thoại trong context của user khác
-    for other_uid, other_ctx in USER_CONTEXT.items():
-        if other_uid != uid and other_ctx.get("order_data", {}).get("phone"):
-            # Kiểm tra xem có đơn hàng nào với số điện thoại này không
-            phone = other_ctx["order_data"]["phone"]
-            if phone:
-                orders_by_phone = get_user_order_history_from_sheets(None, phone)
-                if orders_by_phone:
-                    latest_order = orders_by_phone[0]
-                    last_ms = latest_order.get("ms")
-                    
-                    if last_ms and last_ms in PRODUCTS:
-                        # Cập nhật context
-                        update_context_with_new_ms(uid, last_ms, "restored_by_phone_match")
-                        
-                        # Copy order_data từ user khác
-                        ctx = USER_CONTEXT[uid]
-                        ctx["order_data"] = other_ctx["order_data"].copy()
-                        
-                        print(f"[RESTORE CONTEXT] Đã khôi phục context cho user {uid} bằng số điện thoại: {phone}")
-                        return True
+    # 4. Thử tìm bằng số điện thoại đã biết của user (index đơn hàng, không duyệt USER_CONTEXT)
+    order_data = USER_CONTEXT[uid].get("order_data") or {}
+    phone = order_data.get("phone")
+    if phone:
+        orders_by_phone = get_order_history_by_phones([phone], timeout=RESTORE_PHONE_LOOKUP_TIMEOUT)
+        for latest_order in orders_by_phone:
+            last_ms = latest_order.get("ms")
+            if last_ms and last_ms in PRODUCTS:
+                # Cập nhật context
+                update_context_with_new_ms(uid, last_ms, "restored_by_phone_match")
+                
+                ctx = USER_CONTEXT[uid]
+                if not ctx.get("order_data"):
+                    ctx["order_data"] = {"phone": phone}
+                index_user_contact(uid, ctx["order_data"])
+                
+                print(f"[RESTORE CONTEXT] Đã khôi phục context cho user {uid} bằng số điện thoại: {phone}")
+                return True
     
     print(f"[RESTORE CONTEXT] Không thể khôi phục context cho user {uid}")
     return False
@@ -2482,39 +4691,9 @@ def calculate_product_similarity_score(ms: str, product: dict, desc_lower: str,
     """Tính điểm tương đồng giữa sản phẩm và mô tả ảnh"""
     score = 0
     
-    # Lấy thông tin sản phẩm
-    ten = normalize_vietnamese(product.get("Ten", "").lower())
-    mo_ta = normalize_vietnamese(product.get("MoTa", "").lower())
-    mau_sac = normalize_vietnamese(product.get("màu (Thuộc tính)", "").lower())
-    thuoc_tinh = normalize_vietnamese(product.get("Thuộc tính", "").lower())
-    
-    # Tạo bộ từ khóa sản phẩm
-    product_keywords = set()
-    
-    # Thêm từ khóa từ tên sản phẩm
-    for word in ten.split():
-        if len(word) > 1:
-            product_keywords.add(word)
-    
-    # Thêm từ khóa từ mô tả
-    for word in mo_ta.split()[:50]:
-        word = word.strip('.,!?;:()[]{}"\'').lower()
-        if len(word) > 1:
-            product_keywords.add(word)
-    
-    # Thêm màu sắc
-    if mau_sac:
-        for color in mau_sac.split(','):
-            color_clean = color.strip().lower()
-            if color_clean:
-                product_keywords.add(color_clean)
-    
-    # Thêm thuộc tính
-    if thuoc_tinh:
-        for attr in thuoc_tinh.split(','):
-            attr_clean = attr.strip().lower()
-            if attr_clean:
-                product_keywords.add(attr_clean)
+    # Tên/từ khóa/màu đã chuẩn hóa sẵn lúc load catalog
+    ten = product.get("search_text", "")
+    product_keywords = product.get("search_keywords", frozenset())
     
     # Tính điểm: từ khóa trùng nhau
     common_keywords = desc_keywords.intersection(product_keywords)
@@ -2529,11 +4708,9 @@ def calculate_product_similarity_score(ms: str, product: dict, desc_lower: str,
             score += 8  # Trọng số rất cao cho loại sản phẩm trùng
     
     # Ưu tiên màu sắc trùng khớp
-    if mau_sac:
-        for color in mau_sac.split(','):
-            color_clean = color.strip().lower()
-            if color_clean in desc_lower:
-                score += 5  # Trọng số cao cho màu sắc trùng
+    for color_clean in product.get("search_colors", ()):
+        if color_clean in desc_lower:
+            score += 5  # Trọng số cao cho màu sắc trùng
     
     # Kiểm tra xem tên sản phẩm có trong mô tả ảnh không
     for word in ten.split():
@@ -2565,7 +4742,7 @@ def find_product_by_image_description_enhanced(description: str) -> Optional[str
     # Tìm kiếm sản phẩm với điểm số cải tiến
     product_scores = {}
     
-    for ms, product in PRODUCTS.items():
+    for ms, product in catalog_scan_items(PRODUCTS):
         score = calculate_product_similarity_score(ms, product, desc_lower, desc_keywords)
         
         if score > 0:
@@ -2608,11 +4785,11 @@ def send_suggestion_carousel(uid: str, suggestion_count: int = 3):
     
     # Lấy danh sách sản phẩm (ưu tiên sản phẩm có ảnh)
     valid_products = []
-    for ms, product in PRODUCTS.items():
-        images_field = product.get("Images", "")
-        urls = parse_image_urls(images_field)
-        if urls:  # Chỉ lấy sản phẩm có ảnh
+    for ms, product in catalog_scan_items(PRODUCTS):
+        if product.get("image_urls"):  # Chỉ lấy sản phẩm có ảnh
             valid_products.append(ms)
+            if len(valid_products) >= suggestion_count:
+                break
     
     # Nếu không đủ sản phẩm có ảnh, lấy tất cả
     if len(valid_products) < suggestion_count:
@@ -2624,19 +4801,13 @@ def send_suggestion_carousel(uid: str, suggestion_count: int = 3):
     elements = []
     for ms in suggestion_products:
         product = PRODUCTS[ms]
-        images_field = product.get("Images", "")
-        urls = parse_image_urls(images_field)
+        urls = product.get("image_urls", [])
         image_url = urls[0] if urls else ""
         
-        gia_int = extract_price_int(product.get("Gia", "")) or 0
+        gia_int = product.get("gia_int") or 0
         
         # LẤY TÊN SẢN PHẨM (KHÔNG BAO GỒM MÃ SẢN PHẨM)
-        product_name = product.get('Ten', '')
-        
-        # KIỂM TRA NẾU TÊN ĐÃ CHỨA MÃ SẢN PHẨM, CHỈ GIỮ TÊN
-        if f"[{ms}]" in product_name or ms in product_name:
-            # Xóa mã sản phẩm khỏi tên
-            product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+        product_name = product.get('display_name', '')
         
         element = {
             "title": product_name,  # CHỈ HIỂN THỊ TÊN SẢN PHẨM
@@ -3089,7 +5260,7 @@ def handle_feed_comment(change_data: dict):
             return None
         
         # 6. Load products và kiểm tra MS có tồn tại trong database
-        load_products(force=True)  # Load với force=True để đảm bảo có dữ liệu mới nhất
+        load_products()  # Snapshot hiện tại; catalog cũ sẽ được làm mới ở nền
         
         # Kiểm tra nếu MS trực tiếp tồn tại
         if detected_ms not in PRODUCTS:
@@ -3133,9 +5304,7 @@ def handle_feed_comment(change_data: dict):
         # Lấy thông tin sản phẩm NGAY tại đây để đảm bảo biến product luôn được định nghĩa
         if detected_ms in PRODUCTS:
             product = PRODUCTS[detected_ms]
-            product_name = product.get('Ten', '')
-            if f"[{detected_ms}]" in product_name or detected_ms in product_name:
-                product_name = product_name.replace(f"[{detected_ms}]", "").replace(detected_ms, "").strip()
+            product_name = product.get('display_name', '')
         else:
             # Fallback nếu không tìm thấy sản phẩm
             product = None
@@ -3336,11 +5505,9 @@ def send_order_button_template(uid: str, ms: str, product_name: str = None):
     
     # Lấy thông tin sản phẩm
     if not product_name:
-        product_name = product.get('Ten', '')
-        if f"[{ms}]" in product_name or ms in product_name:
-            product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+        product_name = product.get('display_name', '')
     
-    gia_int = extract_price_int(product.get("Gia", "")) or 0
+    gia_int = product.get("gia_int") or 0
     
     # URL webview đặt hàng
     webview_url = f"https://{DOMAIN}/messenger-order?ms={ms}&uid={uid}"
@@ -3408,221 +5575,1204 @@ def send_order_button_quick_reply(uid: str, ms: str):
 # HELPER: PRODUCTS
 # ============================================
 
-def parse_image_urls(raw: str):
-    if not raw:
-        return []
-    
-    parts = re.split(r'[,\n;|]+', raw)
-    urls = []
-    
-    for p in parts:
-        p = p.strip()
-        if not p:
-            continue
-        p = re.sub(r'^[\'"\s]+|[\'"\s]+$', '', p)
-        
-        if re.match(r'^https?://', p) or any(domain in p.lower() for domain in [
-            'alicdn.com', 'taobao', '1688.com', '.jpg', '.jpeg', 
-            '.png', '.webp', '.gif', 'image', 'img', 'photo'
-        ]):
-            urls.append(p)
-    
-    seen = set()
-    result = []
-    for u in urls:
-        if u not in seen:
-            seen.add(u)
-            result.append(u)
-    
-    return result
+def parse_image_urls(raw: str):
+    if not raw:
+        return []
+    
+    parts = re.split(r'[,\n;|]+', raw)
+    urls = []
+    
+    for p in parts:
+        p = p.strip()
+        if not p:
+            continue
+        p = re.sub(r'^[\'"\s]+|[\'"\s]+$', '', p)
+        
+        if re.match(r'^https?://', p) or any(domain in p.lower() for domain in [
+            'alicdn.com', 'taobao', '1688.com', '.jpg', '.jpeg', 
+            '.png', '.webp', '.gif', 'image', 'img', 'photo'
+        ]):
+            urls.append(p)
+    
+    seen = set()
+    result = []
+    for u in urls:
+        if u not in seen:
+            seen.add(u)
+            result.append(u)
+    
+    return result
+
+def extract_price_int(price_str: str):
+    if not price_str:
+        return None
+    
+    # Loại bỏ ký tự không phải số, dấu chấm, dấu phẩy
+    cleaned = re.sub(r'[^\d.,]', '', str(price_str))
+    
+    if not cleaned:
+        return None
+    
+    # Xử lý các định dạng giá phổ biến
+    # 1. Định dạng Việt Nam: 1.000.000
+    if cleaned.count('.') > 1 and cleaned.count(',') <= 1:
+        # Giả sử dấu chấm là phân cách nghìn, dấu phẩy là thập phân
+        cleaned = cleaned.replace('.', '')
+        if ',' in cleaned:
+            cleaned = cleaned.replace(',', '.')
+    
+    # 2. Định dạng quốc tế: 1,000,000.00
+    elif cleaned.count(',') > 1 and cleaned.count('.') <= 1:
+        # Giả sử dấu phẩy là phân cách nghìn, dấu chấm là thập phân
+        cleaned = cleaned.replace(',', '')
+    
+    # 3. Định dạng hỗn hợp
+    else:
+        # Giữ lại số cuối cùng trước dấu phẩy hoặc chấm
+        cleaned = cleaned.replace(',', '').replace('.', '')
+    
+    try:
+        # Lấy phần nguyên nếu có dấu thập phân
+        if '.' in cleaned:
+            cleaned = cleaned.split('.')[0]
+        
+        return int(float(cleaned)) if cleaned else None
+    except Exception:
+        return None
+
+class Variant:
+    """1 dòng phân loại (màu/size) của sản phẩm; đọc được như dict cũ: variant.get("mau"), variant["gia"]"""
+    __slots__ = ("mau", "size", "gia", "gia_raw", "tonkho", "images", "variant_image")
+
+    def __init__(self, mau, size, gia, gia_raw, tonkho, images, variant_image):
+        self.mau = mau
+        self.size = size
+        self.gia = gia
+        self.gia_raw = gia_raw
+        self.tonkho = tonkho
+        self.images = images
+        self.variant_image = variant_image
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in Variant.__slots__ else default
+
+    def __getitem__(self, key):
+        if key not in Variant.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in Variant.__slots__}
+
+class Product:
+    """
+    1 sản phẩm trong catalog: __slots__, không giữ dòng CSV gốc, màu/size chỉ lưu 1 lần (tuple theo thứ tự gặp).
+    Đọc được như dict cũ (product.get("Ten"), product["variants"]) để các handler không phải đổi.
+    """
+    __slots__ = ("ms", "ten", "gia", "mo_ta", "ton_kho", "thuoc_tinh", "website",
+                 "image_urls", "video_urls", "variants", "colors", "sizes",
+                 "gia_int", "display_name", "variant_index",
+                 "search_text", "search_keywords", "search_colors", "content_hash")
+
+    # Key của dict sản phẩm cũ -> thuộc tính
+    FIELDS = {
+        "MS": "ms", "Ten": "ten", "Gia": "gia", "MoTa": "mo_ta", "Tồn kho": "ton_kho",
+        "Thuộc tính": "thuoc_tinh", "Website": "website",
+        "image_urls": "image_urls", "video_urls": "video_urls", "variants": "variants",
+        "gia_int": "gia_int", "display_name": "display_name", "variant_index": "variant_index",
+        "search_text": "search_text", "search_keywords": "search_keywords",
+        "search_colors": "search_colors", "content_hash": "content_hash",
+    }
+    # Key cũ được suy ra khi đọc thay vì lưu thêm 1 bản
+    COMPUTED = {
+        "màu (Thuộc tính)": lambda p: ", ".join(sorted(p.colors)),
+        "size (Thuộc tính)": lambda p: ", ".join(sorted(p.sizes)),
+        # set dựng lại theo đúng thứ tự thêm vào như set cũ -> list(...) ra cùng thứ tự
+        "all_colors": lambda p: set(p.colors),
+        "all_sizes": lambda p: set(p.sizes),
+        "Images": lambda p: ", ".join(p.image_urls),
+        "Videos": lambda p: ", ".join(p.video_urls),
+    }
+
+    def __init__(self, ms, ten, gia, mo_ta, ton_kho, thuoc_tinh, website, image_urls, video_urls):
+        self.ms = ms
+        self.ten = ten
+        self.gia = gia
+        self.mo_ta = mo_ta
+        self.ton_kho = ton_kho
+        self.thuoc_tinh = thuoc_tinh
+        self.website = website
+        self.image_urls = image_urls
+        self.video_urls = video_urls
+        self.variants = []
+        self.colors = []
+        self.sizes = []
+        self.gia_int = None
+        self.display_name = ""
+        self.variant_index = None
+        self.search_text = ""
+        self.search_keywords = frozenset()
+        self.search_colors = ()
+        self.content_hash = None
+
+    def get(self, key, default=None):
+        attr = Product.FIELDS.get(key)
+        if attr is not None:
+            return getattr(self, attr)
+        computed = Product.COMPUTED.get(key)
+        if computed is not None:
+            return computed(self)
+        return default
+
+    def __getitem__(self, key):
+        attr = Product.FIELDS.get(key)
+        if attr is not None:
+            return getattr(self, attr)
+        computed = Product.COMPUTED.get(key)
+        if computed is not None:
+            return computed(self)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        attr = Product.FIELDS.get(key)
+        if attr is None:
+            raise KeyError(key)
+        setattr(self, attr, value)
+
+def clean_product_name(name: str, ms: str) -> str:
+    """Tên hiển thị: bỏ mã sản phẩm ([MSxxxxxx] hoặc MSxxxxxx) khỏi tên"""
+    if f"[{ms}]" in name or ms in name:
+        name = name.replace(f"[{ms}]", "").replace(ms, "").strip()
+    return name
+
+def build_product_search_keywords(product: dict) -> tuple:
+    """(tên chuẩn hóa, bộ từ khóa, danh sách màu) dùng khi so khớp sản phẩm với mô tả ảnh"""
+    ten = normalize_vietnamese(product.get("Ten", "").lower())
+    mo_ta = normalize_vietnamese(product.get("MoTa", "").lower())
+    mau_sac = normalize_vietnamese(product.get("màu (Thuộc tính)", "").lower())
+    thuoc_tinh = normalize_vietnamese(product.get("Thuộc tính", "").lower())
+
+    keywords = set()
+    for word in ten.split():
+        if len(word) > 1:
+            keywords.add(word)
+    for word in mo_ta.split()[:50]:
+        word = word.strip('.,!?;:()[]{}"\'').lower()
+        if len(word) > 1:
+            keywords.add(word)
+
+    colors = []
+    if mau_sac:
+        for color in mau_sac.split(','):
+            color_clean = color.strip().lower()
+            if color_clean:
+                keywords.add(color_clean)
+            colors.append(color_clean)
+    if thuoc_tinh:
+        for attr in thuoc_tinh.split(','):
+            attr_clean = attr.strip().lower()
+            if attr_clean:
+                keywords.add(attr_clean)
+
+    return ten, frozenset(keywords), tuple(colors)
+
+def normalize_variant_key(value) -> str:
+    """Màu/size -> key so khớp: bỏ khoảng trắng, chữ thường, 'Mặc định' = không có"""
+    key = (value or "").strip().lower()
+    return "" if key == "mặc định" else key
+
+def build_variant_index(variants: list) -> dict:
+    """
+    Index biến thể theo key đã chuẩn hóa (giữ biến thể xuất hiện đầu tiên như vòng lặp cũ):
+    exact[(màu, size)], by_color[màu], by_size[size]; with_image: cùng các bảng đó nhưng chỉ
+    tính biến thể có ảnh riêng (first = biến thể có ảnh đầu tiên khi không lọc)
+    """
+    index = {'exact': {}, 'by_color': {}, 'by_size': {},
+             'with_image': {'exact': {}, 'by_color': {}, 'by_size': {}, 'first': None}}
+    with_image = index['with_image']
+    for variant in variants:
+        color = normalize_variant_key(variant.get("mau"))
+        size = normalize_variant_key(variant.get("size"))
+        index['exact'].setdefault((color, size), variant)
+        index['by_color'].setdefault(color, variant)
+        index['by_size'].setdefault(size, variant)
+        if variant.get("variant_image"):
+            with_image['exact'].setdefault((color, size), variant)
+            with_image['by_color'].setdefault(color, variant)
+            with_image['by_size'].setdefault(size, variant)
+            if with_image['first'] is None:
+                with_image['first'] = variant
+    return index
+
+def find_variant(product: dict, color: str = "", size: str = "", with_image: bool = False) -> Optional[dict]:
+    """
+    Biến thể khớp màu + size bằng 1 lần tra dict; màu/size để trống = không lọc theo tiêu chí đó.
+    with_image=True: biến thể khớp đầu tiên CÓ ảnh riêng (bỏ qua biến thể khớp nhưng không có ảnh)
+    """
+    index = product.get("variant_index")
+    if index is None:
+        index = product["variant_index"] = build_variant_index(product.get("variants", []))
+    if with_image:
+        index = index['with_image']
+
+    has_color = bool((color or "").strip())
+    has_size = bool((size or "").strip())
+    if has_color and has_size:
+        return index['exact'].get((normalize_variant_key(color), normalize_variant_key(size)))
+    if has_color:
+        return index['by_color'].get(normalize_variant_key(color))
+    if has_size:
+        return index['by_size'].get(normalize_variant_key(size))
+    if with_image:
+        return index['first']
+    variants = product.get("variants")
+    return variants[0] if variants else None
+
+def precompute_product_fields(ms: str, product: Product):
+    """Tính 1 lần lúc load catalog các trường mà handler dùng liên tục (giá, tên, index biến thể, từ khóa)"""
+    product.gia_int = extract_price_int(product.gia)
+    product.display_name = clean_product_name(product.ten, ms)
+    product.variant_index = build_variant_index(product.variants)
+    product.search_text, product.search_keywords, product.search_colors = build_product_search_keywords(product)
+
+# ============================================
+# LÀM MỚI CATALOG Ở NỀN (stale-while-revalidate + conditional GET)
+# ============================================
+
+CATALOG_REFRESH = {
+    'lock': threading.Lock(),          # bảo vệ các cờ bên dưới
+    'refresh_lock': threading.Lock(),  # chỉ 1 lần tải/parse tại một thời điểm
+    'inflight': None,                  # Event của lần làm mới đang chạy ở nền
+    'etag': None,
+    'last_modified': None,
+    'content_hash': None,
+    'version': 0,                      # tăng mỗi khi snapshot catalog đổi
+    'last_diff': None,                 # số sản phẩm thêm/xóa/đổi ở lần đổi snapshot gần nhất
+    'cold_wait': float(os.getenv("CATALOG_COLD_WAIT", "3")),  # giây tối đa 1 request chờ khi chưa có dữ liệu nào
+    'last_error_at': 0,                # lần tải lỗi gần nhất
+    'consecutive_errors': 0,           # số lần lỗi kể từ lần tải thành công cuối -> backoff mũ
+    'backoff_base': 5,                 # giây sau lần lỗi đầu, nhân đôi mỗi lần lỗi tiếp
+    'backoff_max': 300,
+    'stats': {
+        'refreshes': 0,
+        'downloads': 0,
+        'not_modified': 0,    # server trả 304
+        'unchanged': 0,       # tải về nhưng nội dung giống hệt -> không đổi snapshot
+        'swaps': 0,
+        'errors': 0,
+        'backoff_skips': 0,   # catalog cũ nhưng đang backoff sau lỗi -> không tải lại
+        'cold_waits': 0,
+        'last_refresh_ms': 0,
+        'last_success': 0
+    }
+}
+
+# ============================================
+# DIFF CATALOG + INVALIDATE CACHE THEO SẢN PHẨM
+# Mỗi sản phẩm có content_hash; sản phẩm không đổi giữ nguyên dict cũ (kèm trường đã tính sẵn),
+# cache phụ thuộc chỉ bỏ kết quả của sản phẩm thêm/xóa/đổi
+# ============================================
+
+# Trường gốc từ sheet dùng để so sánh sản phẩm giữa 2 lần tải
+CATALOG_PRODUCT_FIELDS = ("Ten", "Gia", "MoTa", "Images", "Videos", "Tồn kho",
+                          "màu (Thuộc tính)", "size (Thuộc tính)", "Thuộc tính", "Website")
+CATALOG_VARIANT_FIELDS = ("mau", "size", "gia_raw", "tonkho", "images")
+
+CATALOG_LISTENERS = {}  # tên -> hàm(diff), gọi sau mỗi lần đổi snapshot
+
+def _variant_rows(product: dict) -> list:
+    return [tuple(v.get(field) for field in CATALOG_VARIANT_FIELDS) for v in product.get("variants", [])]
+
+def product_content_hash(product: dict) -> str:
+    """Hash nội dung gốc của 1 sản phẩm (trường sheet + các dòng variant)"""
+    h = hashlib.blake2b(digest_size=16)
+    for field in CATALOG_PRODUCT_FIELDS:
+        h.update(str(product.get(field, "")).encode("utf-8"))
+        h.update(b"\x1f")
+    for row in _variant_rows(product):
+        h.update(repr(row).encode("utf-8"))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+def diff_catalogs(old: dict, new: dict) -> dict:
+    """So 2 snapshot catalog -> {'added': [ms], 'removed': [ms], 'changed': {ms: [trường đổi]}}"""
+    added = [ms for ms in new if ms not in old]
+    removed = [ms for ms in old if ms not in new]
+    changed = {}
+    for ms in new:
+        if ms not in old:
+            continue
+        # So hash trước: catalog mmap không phải giải mã sản phẩm không đổi
+        old_hash = catalog_product_hash(old, ms)
+        if old_hash and old_hash == catalog_product_hash(new, ms):
+            continue
+        previous, product = old[ms], new[ms]
+        if previous is product:
+            continue
+        fields = [field for field in CATALOG_PRODUCT_FIELDS if previous.get(field) != product.get(field)]
+        if _variant_rows(previous) != _variant_rows(product):
+            fields.append("variants")
+        if fields:
+            changed[ms] = fields
+        elif old_hash:
+            # Hash chỉ phủ đúng các trường vừa so -> chỉ xảy ra khi cách tính hash đổi giữa 2 bản
+            changed[ms] = ["content_hash"]
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+def register_catalog_listener(name: str, callback):
+    """Đăng ký cache/index phụ thuộc catalog: callback(diff) sau mỗi lần catalog đổi"""
+    CATALOG_LISTENERS[name] = callback
+
+def notify_catalog_listeners(diff: dict):
+    for name, callback in list(CATALOG_LISTENERS.items()):
+        try:
+            callback(diff)
+        except Exception as e:
+            print(f"[CATALOG DIFF ERROR] Listener {name} lỗi: {e}")
+
+# Cột CSV catalog -> các tên header chấp nhận (theo thứ tự ưu tiên khi ô trống)
+CATALOG_CSV_COLUMNS = {
+    'ms': ("Mã sản phẩm",),
+    'ten': ("Tên sản phẩm",),
+    'gia': ("Giá bán",),
+    'images': ("Images",),
+    'videos': ("Videos",),
+    'tonkho': ("Tồn kho", "Có thể bán"),
+    'mota': ("Mô tả",),
+    'mau': ("màu (Thuộc tính)",),
+    'size': ("size (Thuộc tính)",),
+    'thuoc_tinh': ("Thuộc tính",),
+    'website': ("Website",),
+}
+
+class _HashingReader(RawIOBase):
+    """Bọc stream bytes của response: cập nhật sha1 trong lúc đọc, không giữ toàn bộ nội dung"""
+
+    def __init__(self, raw, hasher):
+        self.raw = raw
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        if not data:
+            return 0
+        self.hasher.update(data)
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+def open_catalog_stream(raw, hasher=None) -> TextIOWrapper:
+    """Stream bytes (response.raw, file nhị phân) -> stream text UTF-8 giải mã dần từng khối"""
+    if hasher is not None:
+        raw = _HashingReader(raw, hasher)
+    return TextIOWrapper(BufferedReader(raw), encoding="utf-8-sig", newline="")
+
+def _catalog_column_indexes(header: list) -> dict:
+    """Map cột -> danh sách index trong header, tính 1 lần cho cả file"""
+    positions = {}
+    for i, name in enumerate(header):
+        # Trùng tên cột: giữ cột cuối như DictReader
+        positions[name.strip()] = i
+    return {
+        key: tuple(positions[name] for name in names if name in positions)
+        for key, names in CATALOG_CSV_COLUMNS.items()
+    }
+
+def parse_products_csv(source, previous: dict = None):
+    """
+    Parse CSV catalog -> (products, products_by_number).
+    source: chuỗi CSV hoặc stream text (đọc từng dòng, không giữ cả file/list dòng trong RAM).
+    previous: catalog hiện tại; sản phẩm có content_hash không đổi dùng lại object cũ, không tính lại.
+    """
+    if isinstance(source, str):
+        source = StringIO(source.lstrip("\ufeff"))
+    reader = csv.reader(source)
+    header = next(reader, None)
+    if not header:
+        return {}, {}
+
+    columns = _catalog_column_indexes(header)
+
+    def cell(row, key):
+        # Ô thiếu (dòng ngắn hơn header) hoặc trống -> thử cột dự phòng tiếp theo
+        for i in columns[key]:
+            if i < len(row):
+                value = row[i].strip()
+                if value:
+                    return value
+        return ""
+
+    products = {}
+    products_by_number = {}
+    # Chuỗi/list ảnh lặp lại giữa các dòng variant -> dùng chung 1 object
+    shared_strings = {}
+    url_lists = {}
+
+    def urls_of(raw):
+        urls = url_lists.get(raw)
+        if urls is None:
+            urls = url_lists[raw] = tuple(parse_image_urls(raw))
+        return urls
+
+    for row in reader:
+        ms = cell(row, 'ms')
+        if not ms:
+            continue
+
+        ten = cell(row, 'ten')
+        if not ten:
+            continue
+
+        gia_raw = cell(row, 'gia')
+        gia_raw = shared_strings.setdefault(gia_raw, gia_raw)
+        images = cell(row, 'images')
+        images = shared_strings.setdefault(images, images)
+        tonkho_raw = cell(row, 'tonkho')
+        mau = sys.intern(cell(row, 'mau'))
+        size = sys.intern(cell(row, 'size'))
+
+        try:
+            tonkho_int = int(tonkho_raw) if tonkho_raw else None
+        except Exception:
+            tonkho_int = None
+
+        variant_images = urls_of(images)
+
+        p = products.get(ms)
+        if p is None:
+            p = products[ms] = Product(
+                ms, ten, gia_raw, cell(row, 'mota'), tonkho_raw,
+                cell(row, 'thuoc_tinh'), cell(row, 'website'),
+                variant_images, urls_of(cell(row, 'videos'))
+            )
+
+        p.variants.append(Variant(
+            mau, size, extract_price_int(gia_raw), gia_raw,
+            tonkho_int if tonkho_int is not None else tonkho_raw,
+            images, variant_images[0] if variant_images else ""
+        ))
+
+        if mau and mau not in p.colors:
+            p.colors.append(mau)
+        if size and size not in p.sizes:
+            p.sizes.append(size)
+
+    for ms, p in products.items():
+        p.variants = tuple(p.variants)
+        p.colors = tuple(p.colors)
+        p.sizes = tuple(p.sizes)
+        p.content_hash = product_content_hash(p)
+        if previous and catalog_product_hash(previous, ms) == p.content_hash:
+            products[ms] = previous[ms]
+        else:
+            precompute_product_fields(ms, p)
+        
+        if ms.startswith("MS"):
+            num_part = ms[2:]
+            num_without_leading_zeros = num_part.lstrip('0')
+            if num_without_leading_zeros:
+                products_by_number[num_without_leading_zeros] = ms
+
+    return products, products_by_number
+
+def refresh_products(force_download: bool = False) -> bool:
+    """
+    Tải catalog và đổi snapshot (chạy ở thread nền hoặc lúc warm-up).
+    Gửi If-None-Match/If-Modified-Since: sheet không đổi -> 304, không tải/parse lại.
+    """
+    global PRODUCTS, LAST_LOAD, PRODUCTS_BY_NUMBER
+
+    if not GOOGLE_SHEET_CSV_URL:
+        print("❌ GOOGLE_SHEET_CSV_URL chưa được cấu hình!")
+        return False
+
+    state = CATALOG_REFRESH
+    stats = state['stats']
+    with state['refresh_lock']:
+        started = time.time()
+        stats['refreshes'] += 1
+        try:
+            headers = {}
+            if not force_download and PRODUCTS:
+                if state['etag']:
+                    headers['If-None-Match'] = state['etag']
+                if state['last_modified']:
+                    headers['If-Modified-Since'] = state['last_modified']
+
+            print(f"🟦 Loading sheet: {GOOGLE_SHEET_CSV_URL}")
+            # stream=True: parse trong lúc tải, không giữ r.text + list dòng trong RAM
+            with requests.get(GOOGLE_SHEET_CSV_URL, timeout=20, headers=headers, stream=True) as r:
+                if r.status_code == 304:
+                    stats['not_modified'] += 1
+                    LAST_LOAD = time.time()
+                    touch_catalog_snapshot()
+                    print("📦 Catalog không đổi (304), giữ snapshot hiện tại")
+                    return True
+                r.raise_for_status()
+                r.raw.decode_content = True  # giải nén gzip nếu server nén
+                hasher = hashlib.sha1()
+                products, products_by_number = parse_products_csv(open_catalog_stream(r.raw, hasher), previous=PRODUCTS)
+                stats['downloads'] += 1
+                state['etag'] = r.headers.get('ETag')
+                state['last_modified'] = r.headers.get('Last-Modified')
+
+            # Server không hỗ trợ ETag: nội dung y hệt thì bỏ kết quả, giữ snapshot (và version) cũ
+            content_hash = hasher.hexdigest()
+            if PRODUCTS and content_hash == state['content_hash']:
+                stats['unchanged'] += 1
+                LAST_LOAD = time.time()
+                touch_catalog_snapshot()
+                print("📦 Catalog không đổi (cùng nội dung), giữ snapshot hiện tại")
+                return True
+
+            diff = diff_catalogs(PRODUCTS, products)
+            total_variants = sum(len(p['variants']) for p in products.values())
+            state['content_hash'] = content_hash
+
+            # Publish file cho các worker; chế độ dùng chung thì chính process này cũng đọc qua mmap
+            snapshot = CATALOG_SNAPSHOT
+            if save_catalog_snapshot(products, products_by_number) and snapshot['shared']:
+                try:
+                    products = MappedCatalog(snapshot['path'], snapshot['decoded_cache_size'])
+                    snapshot['file_stat'] = _catalog_file_stat(snapshot['path'])
+                except Exception as e:
+                    print(f"[CATALOG SHARED ERROR] Không map được file vừa ghi, giữ catalog trong RAM: {e}")
+
+            # Đổi snapshot: request đang chạy vẫn dùng dict cũ cho đến khi xong
+            PRODUCTS = products
+            PRODUCTS_BY_NUMBER = products_by_number
+            LAST_LOAD = time.time()
+            state['version'] += 1
+            stats['swaps'] += 1
+            stats['last_success'] = LAST_LOAD
+            state['last_diff'] = {
+                'added': len(diff['added']),
+                'removed': len(diff['removed']),
+                'changed': len(diff['changed']),
+                'unchanged': len(products) - len(diff['added']) - len(diff['changed'])
+            }
+            notify_catalog_listeners(diff)
+            mark_catalog_ready('sheet')
+
+            print(f"📦 Loaded {len(PRODUCTS)} products với {total_variants} variants.")
+            print(f"🔢 Created mapping for {len(PRODUCTS_BY_NUMBER)} product numbers")
+            return True
+
+        except Exception as e:
+            stats['errors'] += 1
+            # Mọi lần thành công đều cập nhật LAST_LOAD -> chỉ đếm lỗi kể từ lần thành công cuối
+            if state['last_error_at'] < LAST_LOAD:
+                state['consecutive_errors'] = 0
+            state['consecutive_errors'] += 1
+            state['last_error_at'] = time.time()
+            print(f"❌ load_products ERROR: {e} (thử lại sau {catalog_refresh_backoff():.0f}s)")
+            return False
+        finally:
+            stats['last_refresh_ms'] = round((time.time() - started) * 1000, 1)
+
+def catalog_refresh_backoff() -> float:
+    """Số giây còn phải chờ trước lần tải kế tiếp sau chuỗi lỗi (0 = tải được ngay)"""
+    state = CATALOG_REFRESH
+    if state['last_error_at'] <= LAST_LOAD:
+        return 0
+    delay = min(state['backoff_base'] * 2 ** (state['consecutive_errors'] - 1), state['backoff_max'])
+    return max(0, state['last_error_at'] + delay - time.time())
+
+def _refresh_products_in_background(done: threading.Event):
+    try:
+        refresh_products()
+    finally:
+        with CATALOG_REFRESH['lock']:
+            CATALOG_REFRESH['inflight'] = None
+        done.set()
+
+def load_products(force=False):
+    """
+    Đảm bảo có catalog mà không chờ mạng (stale-while-revalidate):
+    - Đã có dữ liệu: trả về ngay; nếu đã cũ (hoặc force) thì làm mới ở thread nền
+    - Chưa có dữ liệu nào (cold start): chờ lần tải đang chạy, tối đa cold_wait giây (vài giây,
+      không giữ thread webhook; hết giờ thì handler trả lời "đang tải catalog")
+    - Vừa tải lỗi: không tải lại cho tới hết backoff (sheet sập không thành bão request tải)
+    """
+    state = CATALOG_REFRESH
+    if not PRODUCTS:
+        # Cold start: snapshot trên đĩa (nếu có) trả lời được ngay, sheet làm mới ở nền
+        load_catalog_snapshot()
+
+    # Catalog dùng chung: theo version file do leader publish, worker thường không tự tải sheet
+    ttl = LOAD_TTL
+    if CATALOG_SNAPSHOT['shared'] and CATALOG_SNAPSHOT['path']:
+        start_shared_catalog_worker()
+        sync_shared_catalog(force=not PRODUCTS)
+        if not catalog_download_allowed():
+            if not PRODUCTS:
+                return  # chờ leader publish, worker đồng bộ sẽ map file mới
+            # force không vượt qua leader; chỉ tự tải khi leader ngừng publish
+            force = False
+            ttl = LOAD_TTL * 2
+    stale = force or not PRODUCTS or (time.time() - LAST_LOAD) >= ttl
+    if not stale:
+        return
+    if not force and catalog_refresh_backoff() > 0:
+        state['stats']['backoff_skips'] += 1
+        return
+
+    with state['lock']:
+        done = state['inflight']
+        if done is None:
+            done = state['inflight'] = threading.Event()
+            threading.Thread(target=_refresh_products_in_background, args=(done,), daemon=True).start()
+
+    if not PRODUCTS:
+        state['stats']['cold_waits'] += 1
+        done.wait(state['cold_wait'])
+
+def get_catalog_refresh_stats() -> dict:
+    state = CATALOG_REFRESH
+    stats = dict(state['stats'])
+    stats['version'] = state['version']
+    stats['last_diff'] = state['last_diff']
+    stats['etag'] = state['etag']
+    stats['last_modified'] = state['last_modified']
+    stats['refreshing'] = state['inflight'] is not None
+    stats['consecutive_errors'] = state['consecutive_errors'] if state['last_error_at'] > LAST_LOAD else 0
+    stats['backoff_seconds'] = round(catalog_refresh_backoff(), 1)
+    stats['age_seconds'] = round(time.time() - LAST_LOAD, 1) if LAST_LOAD else None
+    return stats
+
+def _reset_catalog_refresh_after_fork():
+    """
+    Worker vừa fork (preload_app): master có thể đang tải sheet lúc fork -> lock kế thừa ở trạng thái
+    đang giữ mà thread nhả lock không tồn tại trong worker. Lấy lock mới, bỏ lần làm mới dở dang.
+    """
+    state = CATALOG_REFRESH
+    state['lock'] = threading.Lock()
+    state['refresh_lock'] = threading.Lock()
+    state['inflight'] = None
+
+os.register_at_fork(after_in_child=_reset_catalog_refresh_after_fork)
+# ============================================
+# SNAPSHOT CATALOG TRÊN ĐĨA + CATALOG DÙNG CHUNG GIỮA CÁC WORKER (mmap)
+# File bất biến: header cố định + meta (index ms -> vị trí) + mỗi sản phẩm 1 pickle riêng.
+# Mọi worker mmap read-only cùng 1 file (page cache chung, RAM trả 1 lần mỗi host),
+# chỉ giải mã sản phẩm khi được truy cập. Loader ghi file mới rồi os.replace -> đổi version nguyên tử.
+# ============================================
+
+CATALOG_SNAPSHOT_MAGIC = b"FBCATSNP"
+CATALOG_SNAPSHOT_FORMAT = 5  # tăng khi cấu trúc file/product/variant thay đổi
+# magic, format, thời điểm lưu, độ dài payload, crc32 payload, id catalog (version), độ dài meta
+CATALOG_SNAPSHOT_HEADER = struct.Struct("<8sHdQI16sQ")
+
+CATALOG_SNAPSHOT = {
+    'path': os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.bin"),
+    'shared': os.getenv("CATALOG_SHARED_MMAP", "true").lower() == "true",
+    'decoded_cache_size': int(os.getenv("CATALOG_DECODED_CACHE_SIZE", "512")),  # sản phẩm đã giải mã giữ trong RAM mỗi worker
+    'check_interval': 5,       # giây giữa 2 lần kiểm tra file có version mới
+    'lock': threading.Lock(),
+    'attempted': False,        # mỗi process chỉ thử nạp snapshot 1 lần
+    'file_stat': None,         # (inode, mtime_ns, size) lần kiểm tra trước
+    'last_check': 0,
+    'pid': None,               # process đang chạy worker đồng bộ catalog
+    'boot_time': time.time(),  # mốc đo thời gian tới câu trả lời đúng đầu tiên
+    'stats': {
+        'loads': 0,
+        'load_errors': 0,
+        'saves': 0,
+        'save_errors': 0,
+        'remaps': 0,                   # worker chuyển sang version file mới
+        'last_load_ms': 0,
+        'last_save_ms': 0,
+        'bytes': 0,
+        'snapshot_age_seconds': None,  # tuổi snapshot lúc nạp
+        'first_ready_ms': None,        # từ lúc boot tới khi PRODUCTS có dữ liệu
+        'first_ready_source': None     # 'snapshot' hoặc 'sheet'
+    }
+}
+
+class ProductScanFields:
+    """
+    Các field mà vòng quét toàn catalog cần (tìm theo mô tả ảnh, gợi ý có ảnh).
+    Giữ trong RAM cạnh file mmap: quét không phải giải mã từng sản phẩm và không đẩy sản phẩm nóng khỏi LRU.
+    """
+    __slots__ = ("search_text", "search_keywords", "search_colors", "image_urls", "gia_int")
+
+    def __init__(self, search_text, search_keywords, search_colors, image_urls, gia_int):
+        self.search_text = search_text
+        self.search_keywords = search_keywords
+        self.search_colors = search_colors
+        self.image_urls = image_urls
+        self.gia_int = gia_int
+
+    @staticmethod
+    def values_of(product, strings: dict) -> tuple:
+        """
+        Giá trị để ghi vào file: từ khóa/màu là tuple (intersection/duyệt như frozenset, nhẹ hơn nhiều),
+        chuỗi lặp lại giữa các sản phẩm dùng chung 1 object -> pickle chỉ ghi (và giải mã) 1 lần
+        """
+        return (
+            product.get("search_text", ""),
+            tuple(strings.setdefault(word, word) for word in sorted(product.get("search_keywords", ()))),
+            tuple(strings.setdefault(color, color) for color in product.get("search_colors", ())),
+            tuple(product.get("image_urls", ())),
+            product.get("gia_int"),
+        )
+
+    def get(self, key, default=None):
+        if key in ProductScanFields.__slots__:
+            return getattr(self, key)
+        return default
+
+class MappedCatalog(Mapping):
+    """
+    PRODUCTS chỉ đọc trên file mmap: ms -> product dict.
+    Sản phẩm được giải mã khi truy cập và giữ trong LRU nhỏ; phần còn lại nằm ở page cache dùng chung.
+    """
+
+    def __init__(self, path: str, decoded_cache_size: int = 512):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = CATALOG_SNAPSHOT_HEADER
+        if len(self._mm) < header.size:
+            raise ValueError("snapshot quá ngắn")
+        magic, fmt, saved_at, length, crc, catalog_id, meta_length = header.unpack_from(self._mm, 0)
+        if magic != CATALOG_SNAPSHOT_MAGIC or fmt != CATALOG_SNAPSHOT_FORMAT:
+            raise ValueError(f"snapshot format {fmt}, cần {CATALOG_SNAPSHOT_FORMAT}")
+        if len(self._mm) != header.size + length:
+            raise ValueError("snapshot bị hỏng (sai độ dài)")
+        # crc theo từng khối, không copy cả file ra bytes
+        checksum = 0
+        for start in range(header.size, len(self._mm), 1 << 20):
+            checksum = zlib.crc32(self._mm[start:min(start + (1 << 20), len(self._mm))], checksum)
+        if checksum != crc:
+            raise ValueError("snapshot bị hỏng (sai crc32)")
+
+        meta = pickle.loads(self._mm[header.size:header.size + meta_length])
+        self.path = path
+        self.saved_at = saved_at
+        self.catalog_id = catalog_id.hex()
+        self.products_by_number = meta['products_by_number']
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        self.content_hash = meta.get('content_hash')
+        self.size = len(self._mm)
+        self._base = header.size + meta_length
+        self._index = meta['index']  # ms -> (offset, length, content_hash), theo thứ tự trong sheet
+        self._scan_blob = meta['scan']  # (offset, length) của bảng field quét, chỉ giải mã khi có vòng quét đầu tiên
+        self._scan = None
+        self._decoded = OrderedDict()
+        self._decoded_max = decoded_cache_size
+        self._lock = threading.Lock()
+
+    def __getitem__(self, ms):
+        with self._lock:
+            product = self._decoded.get(ms)
+            if product is not None:
+                self._decoded.move_to_end(ms)
+                return product
+        offset, length, _ = self._index[ms]
+        start = self._base + offset
+        product = pickle.loads(self._mm[start:start + length])
+        with self._lock:
+            # 2 thread cùng giải mã 1 sản phẩm -> dùng chung 1 object
+            product = self._decoded.setdefault(ms, product)
+            self._decoded.move_to_end(ms)
+            while len(self._decoded) > self._decoded_max:
+                self._decoded.popitem(last=False)
+        return product
+
+    def __contains__(self, ms):
+        return ms in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def product_hash(self, ms) -> Optional[str]:
+        entry = self._index.get(ms)
+        return entry[2] if entry else None
+
+    def scan_items(self):
+        """(ms, ProductScanFields) theo thứ tự sheet, không đụng tới LRU sản phẩm đã giải mã"""
+        scan = self._scan
+        if scan is None:
+            offset, length = self._scan_blob
+            start = self._base + offset
+            rows = pickle.loads(self._mm[start:start + length])
+            scan = {ms: ProductScanFields(*values) for ms, values in rows.items()}
+            self._scan = scan
+        return scan.items()
+
+    def decoded_count(self) -> int:
+        return len(self._decoded)
+
+    def reset_after_fork(self):
+        """Process con sau fork: lock kế thừa có thể đang bị giữ bởi thread không tồn tại ở process này"""
+        self._lock = threading.Lock()
+
+def catalog_scan_items(catalog):
+    """
+    Duyệt toàn catalog cho các vòng quét chỉ cần field tìm kiếm/ảnh/giá:
+    catalog mmap trả bảng field giữ trong RAM, catalog dict trả chính sản phẩm
+    """
+    if isinstance(catalog, MappedCatalog):
+        return catalog.scan_items()
+    return catalog.items()
+
+def catalog_product_hash(catalog, ms) -> Optional[str]:
+    """content_hash của 1 sản phẩm mà không cần giải mã (nếu catalog là file mmap)"""
+    if isinstance(catalog, MappedCatalog):
+        return catalog.product_hash(ms)
+    product = catalog.get(ms)
+    return product.get("content_hash") if product else None
+
+def mark_catalog_ready(source: str):
+    """Ghi lại lần đầu catalog dùng được (trả lời đúng mã sản phẩm) kể từ lúc boot"""
+    stats = CATALOG_SNAPSHOT['stats']
+    if stats['first_ready_ms'] is None:
+        stats['first_ready_ms'] = round((time.time() - CATALOG_SNAPSHOT['boot_time']) * 1000, 1)
+        stats['first_ready_source'] = source
+        print(f"[CATALOG SNAPSHOT] Catalog sẵn sàng sau {stats['first_ready_ms']}ms kể từ boot (nguồn: {source})")
+
+def save_catalog_snapshot(products, products_by_number: dict) -> bool:
+    """Ghi snapshot catalog ra đĩa (file tạm + os.replace: worker khác không bao giờ thấy file ghi dở)"""
+    snapshot = CATALOG_SNAPSHOT
+    if not snapshot['path']:
+        return False
+
+    stats = snapshot['stats']
+    started = time.time()
+    state = CATALOG_REFRESH
+    tmp_path = f"{snapshot['path']}.{os.getpid()}.tmp"
+    try:
+        index = {}
+        blobs = []
+        offset = 0
+        scan = {}
+        scan_strings = {}
+        for ms, product in products.items():
+            blob = pickle.dumps(product, protocol=pickle.HIGHEST_PROTOCOL)
+            index[ms] = (offset, len(blob), product.get("content_hash"))
+            blobs.append(blob)
+            offset += len(blob)
+            scan[ms] = ProductScanFields.values_of(product, scan_strings)
+        # Bảng field quét đặt sau các sản phẩm
+        blob = pickle.dumps(scan, protocol=pickle.HIGHEST_PROTOCOL)
+        scan_blob = (offset, len(blob))
+        blobs.append(blob)
+        offset += len(blob)
+        meta = pickle.dumps({
+            'products_by_number': products_by_number,
+            'etag': state['etag'],
+            'last_modified': state['last_modified'],
+            'content_hash': state['content_hash'],
+            'index': index,
+            'scan': scan_blob
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+        crc = zlib.crc32(meta)
+        for blob in blobs:
+            crc = zlib.crc32(blob, crc)
+        catalog_id = hashlib.blake2b(f"{state['content_hash']}:{time.time()}".encode(), digest_size=16).digest()
+        header = CATALOG_SNAPSHOT_HEADER.pack(
+            CATALOG_SNAPSHOT_MAGIC, CATALOG_SNAPSHOT_FORMAT, time.time(), len(meta) + offset, crc, catalog_id, len(meta)
+        )
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(meta)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp_path, snapshot['path'])
+        stats['saves'] += 1
+        stats['bytes'] = len(header) + len(meta) + offset
+        stats['last_save_ms'] = round((time.time() - started) * 1000, 1)
+        return True
+    except Exception as e:
+        stats['save_errors'] += 1
+        print(f"[CATALOG SNAPSHOT ERROR] Lỗi khi lưu snapshot: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+def touch_catalog_snapshot():
+    """Sheet không đổi (304): cập nhật mtime để các worker biết snapshot vẫn mới"""
+    if CATALOG_SNAPSHOT['path'] and os.path.exists(CATALOG_SNAPSHOT['path']):
+        try:
+            os.utime(CATALOG_SNAPSHOT['path'])
+        except OSError as e:
+            print(f"[CATALOG SNAPSHOT ERROR] Không cập nhật được mtime: {e}")
 
-def extract_price_int(price_str: str):
-    if not price_str:
+def read_catalog_snapshot_id(path: str) -> Optional[str]:
+    """Chỉ đọc header: id catalog của file (None nếu không có/khác format)"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(CATALOG_SNAPSHOT_HEADER.size)
+    except FileNotFoundError:
         return None
-    
-    # Loại bỏ ký tự không phải số, dấu chấm, dấu phẩy
-    cleaned = re.sub(r'[^\d.,]', '', str(price_str))
-    
-    if not cleaned:
+    if len(header) < CATALOG_SNAPSHOT_HEADER.size:
         return None
-    
-    # Xử lý các định dạng giá phổ biến
-    # 1. Định dạng Việt Nam: 1.000.000
-    if cleaned.count('.') > 1 and cleaned.count(',') <= 1:
-        # Giả sử dấu chấm là phân cách nghìn, dấu phẩy là thập phân
-        cleaned = cleaned.replace('.', '')
-        if ',' in cleaned:
-            cleaned = cleaned.replace(',', '.')
-    
-    # 2. Định dạng quốc tế: 1,000,000.00
-    elif cleaned.count(',') > 1 and cleaned.count('.') <= 1:
-        # Giả sử dấu phẩy là phân cách nghìn, dấu chấm là thập phân
-        cleaned = cleaned.replace(',', '')
-    
-    # 3. Định dạng hỗn hợp
-    else:
-        # Giữ lại số cuối cùng trước dấu phẩy hoặc chấm
-        cleaned = cleaned.replace(',', '').replace('.', '')
-    
-    try:
-        # Lấy phần nguyên nếu có dấu thập phân
-        if '.' in cleaned:
-            cleaned = cleaned.split('.')[0]
-        
-        return int(float(cleaned)) if cleaned else None
-    except Exception:
+    magic, fmt, _, _, _, catalog_id, _ = CATALOG_SNAPSHOT_HEADER.unpack(header)
+    if magic != CATALOG_SNAPSHOT_MAGIC or fmt != CATALOG_SNAPSHOT_FORMAT:
         return None
+    return catalog_id.hex()
 
-def load_products(force=False):
+def install_catalog_snapshot(catalog, source: str) -> bool:
+    """Đổi PRODUCTS sang catalog từ file (giữ refresh_lock); False nếu đang dùng đúng version đó"""
     global PRODUCTS, LAST_LOAD, PRODUCTS_BY_NUMBER
-    now = time.time()
-    if not force and PRODUCTS and (now - LAST_LOAD) < LOAD_TTL:
-        return
 
-    if not GOOGLE_SHEET_CSV_URL:
-        print("❌ GOOGLE_SHEET_CSV_URL chưa được cấu hình!")
-        return
+    mapped = catalog if isinstance(catalog, MappedCatalog) else None
+    if mapped is not None and isinstance(PRODUCTS, MappedCatalog) and PRODUCTS.catalog_id == mapped.catalog_id:
+        return False
 
-    try:
-        print(f"🟦 Loading sheet: {GOOGLE_SHEET_CSV_URL}")
-        r = requests.get(GOOGLE_SHEET_CSV_URL, timeout=20)
-        r.raise_for_status()
-        r.encoding = "utf-8"
-        content = r.text
+    previous = PRODUCTS
+    diff = diff_catalogs(previous, catalog) if previous else None
+    PRODUCTS = catalog
+    if mapped is not None:
+        PRODUCTS_BY_NUMBER = mapped.products_by_number
+    state = CATALOG_REFRESH
+    state['version'] += 1
+    if diff is not None:
+        notify_catalog_listeners(diff)
+    mark_catalog_ready(source)
+    return True
 
-        reader = csv.DictReader(content.splitlines())
-        products = {}
-        products_by_number = {}
+def load_catalog_snapshot() -> bool:
+    """
+    Nạp catalog từ snapshot trên đĩa khi process chưa có dữ liệu (vài ms thay vì chờ tải sheet).
+    LAST_LOAD = mtime của file: snapshot cũ -> load_products làm mới lại ở nền (conditional GET -> thường chỉ 304).
+    """
+    global LAST_LOAD, PRODUCTS_BY_NUMBER
 
-        for raw_row in reader:
-            row = dict(raw_row)
+    snapshot = CATALOG_SNAPSHOT
+    with snapshot['lock']:
+        if snapshot['attempted'] or PRODUCTS or not snapshot['path']:
+            return False
+        snapshot['attempted'] = True
 
-            ms = (row.get("Mã sản phẩm") or "").strip()
-            if not ms:
-                continue
+    stats = snapshot['stats']
+    started = time.time()
+    try:
+        if not os.path.exists(snapshot['path']):
+            return False
+        mapped = MappedCatalog(snapshot['path'], snapshot['decoded_cache_size'])
+        catalog = mapped if snapshot['shared'] else {ms: mapped[ms] for ms in mapped}
 
-            ten = (row.get("Tên sản phẩm") or "").strip()
-            if not ten:
-                continue
+        state = CATALOG_REFRESH
+        with state['refresh_lock']:
+            # Lần tải từ sheet đã xong trước -> dữ liệu đó mới hơn snapshot
+            if PRODUCTS:
+                return False
+            install_catalog_snapshot(catalog, 'snapshot')
+            PRODUCTS_BY_NUMBER = mapped.products_by_number
+            LAST_LOAD = os.path.getmtime(snapshot['path'])
+            state['etag'] = mapped.etag
+            state['last_modified'] = mapped.last_modified
+            state['content_hash'] = mapped.content_hash
+            snapshot['file_stat'] = _catalog_file_stat(snapshot['path'])
+
+        stats['loads'] += 1
+        stats['last_load_ms'] = round((time.time() - started) * 1000, 1)
+        stats['snapshot_age_seconds'] = round(time.time() - mapped.saved_at, 1)
+        print(f"[CATALOG SNAPSHOT] Đã nạp {len(PRODUCTS)} products từ snapshot trong {stats['last_load_ms']}ms "
+              f"(snapshot {stats['snapshot_age_seconds']}s tuổi, mmap dùng chung: {snapshot['shared']})")
+        return True
+    except Exception as e:
+        stats['load_errors'] += 1
+        print(f"[CATALOG SNAPSHOT ERROR] Lỗi khi nạp snapshot: {e}")
+        return False
 
-            gia_raw = (row.get("Giá bán") or "").strip()
-            images = (row.get("Images") or "").strip()
-            videos = (row.get("Videos") or "").strip()
-            tonkho_raw = (row.get("Tồn kho") or row.get("Có thể bán") or "").strip()
-            mota = (row.get("Mô tả") or "").strip()
-            mau = (row.get("màu (Thuộc tính)") or "").strip()
-            size = (row.get("size (Thuộc tính)") or "").strip()
-            thuoc_tinh = (row.get("Thuộc tính") or "").strip()
-            website = (row.get("Website") or "").strip()  # <--- THÊM CỘT WEBSITE
-
-            gia_int = extract_price_int(gia_raw)
-            try:
-                tonkho_int = int(str(tonkho_raw)) if str(tonkho_raw).strip() else None
-            except Exception:
-                tonkho_int = None
-
-            variant_images = parse_image_urls(images)
-            variant_image = variant_images[0] if variant_images else ""
-
-            if ms not in products:
-                base = {
-                    "MS": ms,
-                    "Ten": ten,
-                    "Gia": gia_raw,
-                    "MoTa": mota,
-                    "Images": images,
-                    "Videos": videos,
-                    "Tồn kho": tonkho_raw,
-                    "màu (Thuộc tính)": mau,
-                    "size (Thuộc tính)": size,
-                    "Thuộc tính": thuoc_tinh,
-                    "Website": website,  # <--- THÊM VÀO DICTIONARY
-                    "FullRow": row,
-                }
-                base["variants"] = []
-                base["all_colors"] = set()
-                base["all_sizes"] = set()
-                products[ms] = base
+def _catalog_file_stat(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
-            p = products[ms]
+def sync_shared_catalog(force: bool = False) -> bool:
+    """
+    Worker chuyển sang file catalog mới nếu loader vừa publish version khác.
+    Chỉ stat file (và đọc header khi file đổi), tối đa 1 lần mỗi check_interval giây.
+    """
+    global LAST_LOAD
 
-            variant = {
-                "mau": mau,
-                "size": size,
-                "gia": gia_int,
-                "gia_raw": gia_raw,
-                "tonkho": tonkho_int if tonkho_int is not None else tonkho_raw,
-                "images": images,
-                "variant_image": variant_image,
-            }
-            p["variants"].append(variant)
+    snapshot = CATALOG_SNAPSHOT
+    if not snapshot['shared'] or not snapshot['path']:
+        return False
+    now = time.time()
+    if not force and now - snapshot['last_check'] < snapshot['check_interval']:
+        return False
+    snapshot['last_check'] = now
 
-            if mau:
-                p["all_colors"].add(mau)
-            if size:
-                p["all_sizes"].add(size)
+    file_stat = _catalog_file_stat(snapshot['path'])
+    if file_stat is None or file_stat == snapshot['file_stat']:
+        return False
 
-        for ms, p in products.items():
-            colors = sorted(list(p.get("all_colors") or []))
-            sizes = sorted(list(p.get("all_sizes") or []))
-            p["màu (Thuộc tính)"] = ", ".join(colors) if colors else p.get("màu (Thuộc tính)", "")
-            p["size (Thuộc tính)"] = ", ".join(sizes) if sizes else p.get("size (Thuộc tính)", "")
-            
-            if ms.startswith("MS"):
-                num_part = ms[2:]
-                num_without_leading_zeros = num_part.lstrip('0')
-                if num_without_leading_zeros:
-                    products_by_number[num_without_leading_zeros] = ms
+    state = CATALOG_REFRESH
+    # Đang tải/parse ở process này -> lần sau kiểm tra lại
+    if not state['refresh_lock'].acquire(blocking=False):
+        return False
+    try:
+        snapshot['file_stat'] = file_stat
+        mtime = file_stat[1] / 1e9
+        catalog_id = read_catalog_snapshot_id(snapshot['path'])
+        if catalog_id is None:
+            return False
+        if isinstance(PRODUCTS, MappedCatalog) and PRODUCTS.catalog_id == catalog_id:
+            # Cùng version, loader chỉ xác nhận sheet chưa đổi (touch)
+            LAST_LOAD = max(LAST_LOAD, mtime)
+            return False
 
-        PRODUCTS = products
-        PRODUCTS_BY_NUMBER = products_by_number
-        LAST_LOAD = now
-        
-        total_variants = sum(len(p['variants']) for p in products.values())
-        
-        print(f"📦 Loaded {len(PRODUCTS)} products với {total_variants} variants.")
-        print(f"🔢 Created mapping for {len(PRODUCTS_BY_NUMBER)} product numbers")
-                
+        mapped = MappedCatalog(snapshot['path'], snapshot['decoded_cache_size'])
+        if not install_catalog_snapshot(mapped, 'snapshot'):
+            return False
+        LAST_LOAD = max(LAST_LOAD, mtime)
+        state['etag'] = mapped.etag
+        state['last_modified'] = mapped.last_modified
+        state['content_hash'] = mapped.content_hash
+        snapshot['stats']['remaps'] += 1
+        print(f"[CATALOG SHARED] Worker {os.getpid()} chuyển sang catalog {mapped.catalog_id[:8]} ({len(mapped)} products)")
+        return True
     except Exception as e:
-        print("❌ load_products ERROR:", e)
+        snapshot['stats']['load_errors'] += 1
+        print(f"[CATALOG SHARED ERROR] Lỗi khi map catalog mới: {e}")
+        return False
+    finally:
+        state['refresh_lock'].release()
+
+def catalog_download_allowed() -> bool:
+    """
+    Process này có tự tải sheet không: chế độ dùng chung chỉ leader tải và publish file,
+    worker khác đọc file qua sync_shared_catalog (trừ khi chưa có file nào để đọc)
+    """
+    snapshot = CATALOG_SNAPSHOT
+    if not snapshot['shared'] or not snapshot['path']:
+        return True
+    return is_leader() or not os.path.exists(snapshot['path'])
+
+def shared_catalog_worker():
+    """Mỗi worker: theo dõi file catalog; chỉ leader tải sheet + publish định kỳ"""
+    last_publish = 0
+    while CATALOG_SNAPSHOT['pid'] == os.getpid():
+        time.sleep(CATALOG_SNAPSHOT['check_interval'])
+        try:
+            sync_shared_catalog()
+            if is_leader() and time.time() - max(LAST_LOAD, last_publish) >= LOAD_TTL:
+                last_publish = time.time()
+                refresh_products()
+        except Exception as e:
+            print(f"[CATALOG SHARED WORKER ERROR] {e}")
+
+def start_shared_catalog_worker():
+    """Khởi động worker đồng bộ catalog cho process hiện tại (cả sau khi gunicorn fork)"""
+    snapshot = CATALOG_SNAPSHOT
+    if not snapshot['shared'] or not snapshot['path']:
+        return None
+    with snapshot['lock']:
+        if snapshot['pid'] == os.getpid():
+            return None
+        snapshot['pid'] = os.getpid()
+
+    worker_thread = threading.Thread(target=shared_catalog_worker, daemon=True)
+    worker_thread.start()
+    return worker_thread
+
+def _reset_catalog_snapshot_after_fork():
+    # refresh_lock/inflight đã được _reset_catalog_refresh_after_fork làm mới (đăng ký trước, chạy trước)
+    CATALOG_SNAPSHOT['lock'] = threading.Lock()
+    CATALOG_SNAPSHOT['pid'] = None
+    catalog = PRODUCTS
+    if isinstance(catalog, MappedCatalog):
+        catalog.reset_after_fork()
+
+os.register_at_fork(after_in_child=_reset_catalog_snapshot_after_fork)
+
+def get_catalog_snapshot_stats() -> dict:
+    stats = dict(CATALOG_SNAPSHOT['stats'])
+    stats['path'] = CATALOG_SNAPSHOT['path']
+    stats['shared_mmap'] = CATALOG_SNAPSHOT['shared']
+    catalog = PRODUCTS
+    if isinstance(catalog, MappedCatalog):
+        stats['catalog_id'] = catalog.catalog_id
+        stats['mapped_bytes'] = catalog.size
+        stats['decoded_products'] = catalog.decoded_count()
+    return stats
+
 def get_variant_image(ms: str, color: str, size: str) -> str:
     if ms not in PRODUCTS:
         return ""
     
     product = PRODUCTS[ms]
-    variants = product.get("variants", [])
-    
-    for variant in variants:
-        variant_color = variant.get("mau", "").strip().lower()
-        variant_size = variant.get("size", "").strip().lower()
-        
-        input_color = color.strip().lower()
-        input_size = size.strip().lower()
-        
-        color_match = (not input_color) or (variant_color == input_color) or (input_color == "mặc định" and not variant_color)
-        size_match = (not input_size) or (variant_size == input_size) or (input_size == "mặc định" and not variant_size)
-        
-        if color_match and size_match:
-            variant_image = variant.get("variant_image", "")
-            if variant_image:
-                return variant_image
+    # Như vòng lặp cũ: lấy biến thể khớp đầu tiên có ảnh, không dừng ở biến thể khớp không có ảnh
+    variant = find_variant(product, color, size, with_image=True)
+    if variant:
+        return variant["variant_image"]
     
-    images_field = product.get("Images", "")
-    urls = parse_image_urls(images_field)
+    urls = product.get("image_urls", [])
     return urls[0] if urls else ""
 
 # ============================================
 # HÀM PHÂN TÍCH GIÁ THÔNG MINH
 # ============================================
 
+PRICE_ANALYSIS_CACHE = {
+    'lock': threading.Lock(),
+    'results': {},     # ms -> kết quả phân tích
+    'stats': {
+        'hits': 0,
+        'misses': 0,
+        'invalidated': 0
+    }
+}
+
 def analyze_product_price_patterns(ms: str) -> dict:
     """
-    Phân tích mẫu giá của sản phẩm và trả về cấu trúc dữ liệu rõ ràng
+    Phân tích mẫu giá của sản phẩm và trả về cấu trúc dữ liệu rõ ràng.
+    Tính 1 lần mỗi sản phẩm, giữ trong cache tới khi catalog báo sản phẩm đó đổi/bị xóa.
     """
-    if ms not in PRODUCTS:
+    product = PRODUCTS.get(ms)
+    if product is None:
         return {"error": "Product not found"}
     
-    product = PRODUCTS[ms]
+    cache = PRICE_ANALYSIS_CACHE
+    with cache['lock']:
+        result = cache['results'].get(ms)
+        if result is not None:
+            cache['stats']['hits'] += 1
+            return result
+    
+    result = compute_product_price_patterns(ms, product)
+    with cache['lock']:
+        cache['stats']['misses'] += 1
+        # Catalog vừa đổi sản phẩm này trong lúc tính -> không cache kết quả cũ
+        if catalog_product_hash(PRODUCTS, ms) == product.get("content_hash"):
+            cache['results'][ms] = result
+    return result
+
+def invalidate_price_analysis(diff: dict):
+    """Listener catalog: chỉ bỏ kết quả của sản phẩm bị xóa hoặc thay đổi"""
+    cache = PRICE_ANALYSIS_CACHE
+    with cache['lock']:
+        for ms in list(diff['removed']) + list(diff['changed']):
+            if cache['results'].pop(ms, None) is not None:
+                cache['stats']['invalidated'] += 1
+
+register_catalog_listener('price_analysis', invalidate_price_analysis)
+
+def get_price_analysis_cache_stats() -> dict:
+    cache = PRICE_ANALYSIS_CACHE
+    with cache['lock']:
+        stats = dict(cache['stats'])
+        stats['cached_products'] = len(cache['results'])
+    return stats
+
+def compute_product_price_patterns(ms: str, product: dict) -> dict:
+    """Phân tích mẫu giá của 1 sản phẩm, tuyến tính theo số biến thể"""
     variants = product.get("variants", [])
     
     price_by_color = {}
@@ -3651,19 +6801,23 @@ def analyze_product_price_patterns(ms: str) -> dict:
                 price_groups[price] = []
             price_groups[price].append({"color": color, "size": size})
     
-    # 2. Kiểm tra xem giá có thay đổi theo màu không
-    color_based = True
-    for color, data in price_by_color.items():
-        if len(data["sizes"]) > 1 and any(v.get("mau", "").strip() == color and v.get("gia", 0) != data["price"] for v in variants):
-            color_based = False
-            break
+    # 2+3. Màu/size nào có biến thể khác giá nhóm: 1 lượt duyệt thay vì any() lồng cho từng màu/size
+    mixed_colors = set()
+    mixed_sizes = set()
+    for v in variants:
+        price = v.get("gia", 0)
+        color_data = price_by_color.get(v.get("mau", "").strip())
+        if color_data is not None and price != color_data["price"]:
+            mixed_colors.add(v.get("mau", "").strip())
+        size_data = price_by_size.get(v.get("size", "").strip())
+        if size_data is not None and price != size_data["price"]:
+            mixed_sizes.add(v.get("size", "").strip())
     
-    # 3. Kiểm tra xem giá có thay đổi theo size không
-    size_based = True
-    for size, data in price_by_size.items():
-        if len(data["colors"]) > 1 and any(v.get("size", "").strip() == size and v.get("gia", 0) != data["price"] for v in variants):
-            size_based = False
-            break
+    # Giá có thay đổi theo màu không
+    color_based = not any(len(price_by_color[color]["sizes"]) > 1 for color in mixed_colors)
+    
+    # Giá có thay đổi theo size không
+    size_based = not any(len(price_by_size[size]["colors"]) > 1 for size in mixed_sizes)
     
     # 4. Phân tích mẫu giá phức tạp
     complex_pattern = not (color_based or size_based)
@@ -3674,7 +6828,7 @@ def analyze_product_price_patterns(ms: str) -> dict:
         "product_name": product.get("Ten", ""),
         "total_variants": len(variants),
         "price_pattern": "unknown",
-        "base_price": extract_price_int(product.get("Gia", "")) or 0,
+        "base_price": product.get("gia_int") or 0,
         "detailed_analysis": {}
     }
     
@@ -3740,26 +6894,19 @@ def get_product_data_for_gpt(ms: str) -> dict:
     
     product = PRODUCTS[ms]
     
-    images_field = product.get("Images", "")
-    image_urls = parse_image_urls(images_field)
-    unique_images = list(dict.fromkeys(image_urls))[:10]
-    
-    videos_field = product.get("Videos", "")
-    video_urls = parse_image_urls(videos_field)
-    
     return {
         "ms": ms,
         "ten": product.get("Ten", ""),
         "mo_ta": product.get("MoTa", ""),
         "gia": product.get("Gia", ""),
-        "gia_int": extract_price_int(product.get("Gia", "")),
+        "gia_int": product.get("gia_int"),
         "mau_sac": product.get("màu (Thuộc tính)", ""),
         "size": product.get("size (Thuộc tính)", ""),
         "thuoc_tinh": product.get("Thuộc tính", ""),
         "ton_kho": product.get("Tồn kho", ""),
-        "images": unique_images,
-        "videos": video_urls,
-        "variants": product.get("variants", [])[:5],
+        "images": list(product.get("image_urls", [])[:10]),
+        "videos": list(product.get("video_urls", [])),
+        "variants": [variant.to_dict() for variant in product.get("variants", [])[:5]],
         "all_colors": list(product.get("all_colors", set())),
         "all_sizes": list(product.get("all_sizes", set()))
     }
@@ -3878,8 +7025,7 @@ def execute_tool(uid, name, args):
             return "Sản phẩm không có ảnh."
         
         product = PRODUCTS[ms]
-        images_field = product.get("Images", "")
-        urls = parse_image_urls(images_field)
+        urls = product.get("image_urls", [])
         
         if not urls:
             return "Sản phẩm không có ảnh."
@@ -3900,8 +7046,7 @@ def execute_tool(uid, name, args):
             return "Sản phẩm không có video."
         
         product = PRODUCTS[ms]
-        videos_field = product.get("Videos", "")
-        urls = parse_image_urls(videos_field)
+        urls = product.get("video_urls", [])
         
         if not urls:
             return "Sản phẩm không có video."
@@ -3916,10 +7061,7 @@ def execute_tool(uid, name, args):
         if ms in PRODUCTS:
             # Gửi template với nút đặt hàng đẹp THAY VÌ link thô
             product = PRODUCTS[ms]
-            product_name = product.get('Ten', '')
-            
-            if f"[{ms}]" in product_name or ms in product_name:
-                product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+            product_name = product.get('display_name', '')
             
             # Gửi template đẹp
             send_order_button_template(uid, ms, product_name)
@@ -3942,21 +7084,12 @@ def update_product_context(uid: str, ms: str):
     ctx = USER_CONTEXT[uid]
     ctx["last_ms"] = ms
     
-    if "product_history" not in ctx:
-        ctx["product_history"] = []
-    
-    if not ctx["product_history"] or ctx["product_history"][0] != ms:
-        if ms in ctx["product_history"]:
-            ctx["product_history"].remove(ms)
-        ctx["product_history"].insert(0, ms)
-    
-    if len(ctx["product_history"]) > 5:
-        ctx["product_history"] = ctx["product_history"][:5]
+    push_product_history(ctx, ms)
     
     ctx["dirty"] = True  # ← THÊM DÒNG NÀY
     ctx["last_updated"] = time.time()
     
-    print(f"[CONTEXT UPDATE] User {uid}: last_ms={ms}, history={ctx['product_history']}")
+    print(f"[CONTEXT UPDATE] User {uid}: last_ms={ms}, history={list(ctx['product_history'])}")
     
 def detect_ms_from_text(text: str) -> Optional[str]:
     """Phát hiện mã sản phẩm từ nhiều dạng text khác nhau - CHỈ khi có tiền tố"""
@@ -4237,14 +7370,10 @@ Khi khách hỏi về bất kỳ thông tin chi tiết nào của sản phẩm,
                 send_message(uid, final_reply)
                 
                 # Lưu lịch sử hội thoại
-                ctx["conversation_history"].append({"role": "user", "content": text})
-                ctx["conversation_history"].append({"role": "assistant", "content": final_reply})
-                ctx["conversation_history"] = ctx["conversation_history"][-10:]
+                push_conversation_turn(ctx, text, final_reply)
         else:
             send_message(uid, msg.content)
-            ctx["conversation_history"].append({"role": "user", "content": text})
-            ctx["conversation_history"].append({"role": "assistant", "content": msg.content})
-            ctx["conversation_history"] = ctx["conversation_history"][-10:]
+            push_conversation_turn(ctx, text, msg.content)
             
     except Exception as e:
         print(f"GPT Error: {e}")
@@ -4681,20 +7810,13 @@ def send_single_product_carousel(uid: str, ms: str):
     load_products()
     product = PRODUCTS[ms]
     
-    images_field = product.get("Images", "")
-    urls = parse_image_urls(images_field)
+    urls = product.get("image_urls", [])
     image_url = urls[0] if urls else ""
     
-    gia_raw = product.get("Gia", "")
-    gia_int = extract_price_int(gia_raw) or 0
+    gia_int = product.get("gia_int") or 0
     
     # LẤY TÊN SẢN PHẨM (KHÔNG BAO GỒM MÃ SẢN PHẨM)
-    product_name = product.get('Ten', '')
-    
-    # KIỂM TRA NẾU TÊN ĐÃ CHỨA MÃ SẢN PHẨM, CHỈ GIỮ TÊN
-    if f"[{ms}]" in product_name or ms in product_name:
-        # Xóa mã sản phẩm khỏi tên
-        product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+    product_name = product.get('display_name', '')
     
     element = {
         "title": product_name,  # CHỈ HIỂN THỊ TÊN SẢN PHẨM
@@ -4728,16 +7850,7 @@ def send_single_product_carousel(uid: str, ms: str):
     ctx["last_ms"] = ms
     
     # Gọi hàm update_product_context cũ để duy trì tính năng cũ
-    if "product_history" not in ctx:
-        ctx["product_history"] = []
-    
-    if not ctx["product_history"] or ctx["product_history"][0] != ms:
-        if ms in ctx["product_history"]:
-            ctx["product_history"].remove(ms)
-        ctx["product_history"].insert(0, ms)
-    
-    if len(ctx["product_history"]) > 5:
-        ctx["product_history"] = ctx["product_history"][:5]
+    push_product_history(ctx, ms)
     
     ctx["has_sent_first_carousel"] = True
     
@@ -4781,6 +7894,7 @@ def handle_order_form_step(uid: str, text: str) -> bool:
 
     if state == "ask_name":
         data["customerName"] = text.strip()
+        ctx["order_data"] = data
         ctx["order_state"] = "ask_phone"
         send_message(uid, "Dạ em cảm ơn anh/chị. Anh/chị cho em xin số điện thoại ạ?")
         ctx["dirty"] = True  # ← THÊM DÒNG NÀY
@@ -4792,6 +7906,8 @@ def handle_order_form_step(uid: str, text: str) -> bool:
             send_message(uid, "Số điện thoại chưa đúng lắm, anh/chị nhập lại giúp em (tối thiểu 9 số) ạ?")
             return True
         data["phone"] = phone
+        ctx["order_data"] = data
+        index_user_contact(uid, data)
         ctx["order_state"] = "ask_address"
         send_message(uid, "Dạ vâng. Anh/chị cho em xin địa chỉ nhận hàng ạ?")
         ctx["dirty"] = True
@@ -4837,23 +7953,12 @@ def handle_postback_with_recovery(uid: str, payload: str, postback_id: str = Non
     else:
         idempotency_key = f"{uid}_{payload}_{int(now)}"
     
-    ctx = USER_CONTEXT[uid]
-    
-    if "idempotent_postbacks" not in ctx:
-        ctx["idempotent_postbacks"] = {}
-    
-    if idempotency_key in ctx["idempotent_postbacks"]:
-        processed_time = ctx["idempotent_postbacks"][idempotency_key]
-        if now - processed_time < 300:
+    with IDEMPOTENT_POSTBACKS_LOCK:
+        if ttl_seen_before(IDEMPOTENT_POSTBACKS, idempotency_key, IDEMPOTENT_POSTBACKS_TTL, now):
             print(f"[IDEMPOTENCY BLOCK] Bỏ qua postback đã xử lý: {idempotency_key}")
             return True
     
-    ctx["idempotent_postbacks"][idempotency_key] = now
-    
-    if len(ctx["idempotent_postbacks"]) > 50:
-        sorted_items = sorted(ctx["idempotent_postbacks"].items(), 
-                            key=lambda x: x[1], reverse=True)[:30]
-        ctx["idempotent_postbacks"] = dict(sorted_items)
+    ctx = USER_CONTEXT[uid]
     
     load_products()
     
@@ -4865,31 +7970,14 @@ def handle_postback_with_recovery(uid: str, payload: str, postback_id: str = Non
             ctx["dirty"] = True
             
             # ============================================
-            # QUAN TRỌNG: LƯU NGAY VÀO GOOGLE SHEETS KHI CLICK NÚT
+            # QUAN TRỌNG: LƯU VÀO GOOGLE SHEETS KHI CLICK NÚT
+            # (qua write-behind buffer, không tạo thread mới mỗi lần)
             # ============================================
-            def save_immediately_postback():
-                try:
-                    print(f"[POSTBACK IMMEDIATE SAVE] Đang lưu ngay MS {ms} cho user {uid}...")
-                    save_single_user_to_sheets(uid, ctx)
-                    print(f"[POSTBACK IMMEDIATE SAVE COMPLETE] Đã lưu xong user {uid} vào Google Sheets")
-                except Exception as e:
-                    print(f"[POSTBACK IMMEDIATE SAVE ERROR] Lỗi khi lưu user {uid}: {e}")
-            
-            # Chạy trong thread riêng để không block bot
-            threading.Thread(target=save_immediately_postback, daemon=True).start()
+            queue_context_save(uid, ctx)
             # ============================================
             
             # Gọi hàm update_product_context cũ
-            if "product_history" not in ctx:
-                ctx["product_history"] = []
-            
-            if not ctx["product_history"] or ctx["product_history"][0] != ms:
-                if ms in ctx["product_history"]:
-                    ctx["product_history"].remove(ms)
-                ctx["product_history"].insert(0, ms)
-            
-            if len(ctx["product_history"]) > 5:
-                ctx["product_history"] = ctx["product_history"][:5]
+            push_product_history(ctx, ms)
             
             # Lấy thông tin sản phẩm
             product = PRODUCTS[ms]
@@ -4977,31 +8065,14 @@ Hãy liệt kê 5 ưu điểm nổi bật nhất của sản phẩm này theo đ
             ctx["dirty"] = True
             
             # ============================================
-            # QUAN TRỌNG: LƯU NGAY VÀO GOOGLE SHEETS KHI CLICK NÚT
+            # QUAN TRỌNG: LƯU VÀO GOOGLE SHEETS KHI CLICK NÚT
+            # (qua write-behind buffer, không tạo thread mới mỗi lần)
             # ============================================
-            def save_immediately_postback():
-                try:
-                    print(f"[POSTBACK IMMEDIATE SAVE] Đang lưu ngay MS {ms} cho user {uid}...")
-                    save_single_user_to_sheets(uid, ctx)
-                    print(f"[POSTBACK IMMEDIATE SAVE COMPLETE] Đã lưu xong user {uid} vào Google Sheets")
-                except Exception as e:
-                    print(f"[POSTBACK IMMEDIATE SAVE ERROR] Lỗi khi lưu user {uid}: {e}")
-            
-            # Chạy trong thread riêng để không block bot
-            threading.Thread(target=save_immediately_postback, daemon=True).start()
+            queue_context_save(uid, ctx)
             # ============================================
             
             # Gọi hàm update_product_context cũ
-            if "product_history" not in ctx:
-                ctx["product_history"] = []
-            
-            if not ctx["product_history"] or ctx["product_history"][0] != ms:
-                if ms in ctx["product_history"]:
-                    ctx["product_history"].remove(ms)
-                ctx["product_history"].insert(0, ms)
-            
-            if len(ctx["product_history"]) > 5:
-                ctx["product_history"] = ctx["product_history"][:5]
+            push_product_history(ctx, ms)
             
             # Gọi GPT để xử lý việc gửi ảnh
             handle_text_with_function_calling(uid, "gửi ảnh sản phẩm cho tôi xem")
@@ -5015,41 +8086,21 @@ Hãy liệt kê 5 ưu điểm nổi bật nhất của sản phẩm này theo đ
             ctx["dirty"] = True
             
             # ============================================
-            # QUAN TRỌNG: LƯU NGAY VÀO GOOGLE SHEETS KHI CLICK NÚT ĐẶT HÀNG
+            # QUAN TRỌNG: LƯU VÀO GOOGLE SHEETS KHI CLICK NÚT ĐẶT HÀNG
+            # (qua write-behind buffer, không tạo thread mới mỗi lần)
             # ============================================
-            def save_immediately_postback():
-                try:
-                    print(f"[POSTBACK IMMEDIATE SAVE] Đang lưu ngay MS {ms} cho user {uid} (ORDER_BUTTON)...")
-                    save_single_user_to_sheets(uid, ctx)
-                    print(f"[POSTBACK IMMEDIATE SAVE COMPLETE] Đã lưu xong user {uid} vào Google Sheets")
-                except Exception as e:
-                    print(f"[POSTBACK IMMEDIATE SAVE ERROR] Lỗi khi lưu user {uid}: {e}")
-            
-            # Chạy trong thread riêng để không block bot
-            threading.Thread(target=save_immediately_postback, daemon=True).start()
+            queue_context_save(uid, ctx)
             # ============================================
             
             # Cập nhật product_history
-            if "product_history" not in ctx:
-                ctx["product_history"] = []
-            
-            if not ctx["product_history"] or ctx["product_history"][0] != ms:
-                if ms in ctx["product_history"]:
-                    ctx["product_history"].remove(ms)
-                ctx["product_history"].insert(0, ms)
-            
-            if len(ctx["product_history"]) > 5:
-                ctx["product_history"] = ctx["product_history"][:5]
+            push_product_history(ctx, ms)
             
             # Gửi sự kiện AddToCart khi click nút đặt hàng
             try:
                 product = PRODUCTS[ms]
-                product_name = product.get('Ten', '')
+                product_name = product.get('display_name', '')
                 
-                if f"[{ms}]" in product_name or ms in product_name:
-                    product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
-                
-                gia_int = extract_price_int(product.get("Gia", "")) or 0
+                gia_int = product.get("gia_int") or 0
                 
                 send_add_to_cart_smart(
                     uid=uid,
@@ -5105,12 +8156,12 @@ def handle_text(uid: str, text: str, referral_data: dict = None):
     
     ctx = USER_CONTEXT[uid]
 
-    if ctx.get("processing_lock"):
+    # Mỗi user chỉ xử lý 1 tin nhắn văn bản tại 1 thời điểm (lấy lease là atomic)
+    lease = try_acquire_user_lease(uid, "text")
+    if lease is None:
         print(f"[TEXT SKIP] User {uid} đang được xử lý")
         return
 
-    ctx["processing_lock"] = True
-
     try:
         now = time.time()
         last_msg_time = ctx.get("last_msg_time", 0)
@@ -5120,7 +8171,6 @@ def handle_text(uid: str, text: str, referral_data: dict = None):
             last_text = ctx.get("last_processed_text", "")
             if text.strip().lower() == last_text.lower():
                 print(f"[TEXT DEBOUNCE] Bỏ qua tin nhắn trùng lặp: {text[:50]}...")
-                ctx["processing_lock"] = False
                 return
         
         ctx["last_msg_time"] = now
@@ -5169,13 +8219,10 @@ def handle_text(uid: str, text: str, referral_data: dict = None):
                 else:
                     # Gửi tin nhắn chào mừng
                     product = PRODUCTS[detected_ms]
-                    product_name = product.get('Ten', '')
-                    if f"[{detected_ms}]" in product_name or detected_ms in product_name:
-                        product_name = product_name.replace(f"[{detected_ms}]", "").replace(detected_ms, "").strip()
+                    product_name = product.get('display_name', '')
                     
                     send_message(uid, f"Chào anh/chị! 👋\n\nCảm ơn đã quan tâm đến sản phẩm **{product_name}** từ catalog. Em đã gửi thông tin chi tiết bên trên ạ!")
                 
-                ctx["processing_lock"] = False
                 return
         
         # ============================================
@@ -5243,7 +8290,6 @@ def handle_text(uid: str, text: str, referral_data: dict = None):
         
         # Xử lý order state nếu có
         if handle_order_form_step(uid, text):
-            ctx["processing_lock"] = False
             return
         
         # ============================================
@@ -5262,7 +8308,6 @@ def handle_text(uid: str, text: str, referral_data: dict = None):
                 # Gợi ý khách gửi MS hoặc ảnh
                 send_message(uid, "Dạ em chưa biết anh/chị đang hỏi về sản phẩm nào. Vui lòng cho em biết mã sản phẩm hoặc gửi ảnh sản phẩm ạ! 🤗")
             
-            ctx["processing_lock"] = False
             return
         
         # ============================================
@@ -5288,7 +8333,7 @@ def handle_text(uid: str, text: str, referral_data: dict = None):
         except:
             pass
     finally:
-        ctx["processing_lock"] = False
+        lease.release()
         
 # ============================================
 # HANDLE IMAGE - CẢI TIẾN VỚI CAROUSEL GỢI Ý
@@ -5358,9 +8403,7 @@ def handle_image(uid: str, image_url: str):
                 for ms in popular_products:
                     product = PRODUCTS[ms]
                     # Lấy tên sản phẩm (không bao gồm mã sản phẩm)
-                    product_name = product.get('Ten', '')
-                    if f"[{ms}]" in product_name or ms in product_name:
-                        product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+                    product_name = product.get('display_name', '')
                     send_message(uid, f"📦 {product_name}")
         
         send_message(uid, "Vui lòng gửi mã sản phẩm chính xác (ví dụ: MS000004) để em tư vấn chi tiết ạ!")
@@ -5446,30 +8489,286 @@ def handle_catalog_template(uid: str, template_payload: dict):
 # GOOGLE SHEETS API FUNCTIONS
 # ============================================
 
+# Pool client Google Sheets: credentials parse 1 lần, mỗi thread 1 transport riêng
+# (httplib2 không thread-safe nên không thể dùng chung 1 service object)
+SHEETS_CLIENT_POOL = {
+    'credentials': None,
+    'lock': threading.Lock(),
+    'local': threading.local(),
+    'refresh_margin': int(os.getenv("SHEETS_TOKEN_REFRESH_MARGIN", "300")),  # giây trước khi token hết hạn
+    'http_timeout': int(os.getenv("SHEETS_HTTP_TIMEOUT", "30")),
+    'stats': {
+        'clients_built': 0,
+        'client_reuses': 0,
+        'token_refreshes': 0,
+        'errors': 0
+    }
+}
+
+def _get_sheets_credentials():
+    """Parse service account JSON đúng 1 lần và refresh token chủ động trước khi hết hạn"""
+    pool = SHEETS_CLIENT_POOL
+    with pool['lock']:
+        credentials = pool['credentials']
+        if credentials is None:
+            from google.oauth2 import service_account
+            creds_dict = json.loads(GOOGLE_SHEETS_CREDENTIALS_JSON)
+            credentials = service_account.Credentials.from_service_account_info(
+                creds_dict,
+                scopes=['https://www.googleapis.com/auth/spreadsheets']
+            )
+            pool['credentials'] = credentials
+        
+        # Refresh khi chưa có token hoặc sắp hết hạn, để request thật không phải chờ 401 rồi mới refresh
+        expiry = credentials.expiry
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        if not credentials.token or expiry is None or (expiry - now_utc).total_seconds() < pool['refresh_margin']:
+            from google.auth.transport.requests import Request as GoogleAuthRequest
+            credentials.refresh(GoogleAuthRequest())
+            pool['stats']['token_refreshes'] += 1
+        
+        return credentials
+
 def get_google_sheets_service():
+    """
+    Trả về Sheets service của thread hiện tại (tạo 1 lần/thread/process).
+    Discovery document lấy từ bản static đóng gói sẵn, không fetch qua mạng.
+    """
     if not GOOGLE_SHEETS_CREDENTIALS_JSON or not GOOGLE_SHEET_ID:
         return None
 
+    pool = SHEETS_CLIENT_POOL
+    local = pool['local']
+    
     try:
-        import google.auth
-        from google.oauth2 import service_account
+        credentials = _get_sheets_credentials()
+        
+        # Sau khi gunicorn fork, không dùng lại transport của process cha
+        service = getattr(local, 'service', None)
+        if service is not None and getattr(local, 'pid', None) == os.getpid():
+            pool['stats']['client_reuses'] += 1
+            return service
+        
+        import httplib2
+        import google_auth_httplib2
         from googleapiclient.discovery import build
         
-        creds_dict = json.loads(GOOGLE_SHEETS_CREDENTIALS_JSON)
-        credentials = service_account.Credentials.from_service_account_info(
-            creds_dict,
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
+        authed_http = google_auth_httplib2.AuthorizedHttp(
+            credentials,
+            http=httplib2.Http(timeout=pool['http_timeout'])
         )
-        service = build('sheets', 'v4', credentials=credentials)
-        print("✅ Đã khởi tạo Google Sheets service thành công.")
+        service = build('sheets', 'v4', http=authed_http,
+                        static_discovery=True, cache_discovery=False)
+        local.service = service
+        local.pid = os.getpid()
+        pool['stats']['clients_built'] += 1
+        print(f"✅ Đã khởi tạo Google Sheets service cho thread {threading.current_thread().name}.")
         return service
     except ImportError:
         print("⚠️ Google API libraries chưa được cài đặt.")
         return None
     except Exception as e:
+        pool['stats']['errors'] += 1
         print(f"❌ Lỗi khi khởi tạo Google Sheets service: {e}")
         return None
 
+def get_sheets_client_stats() -> dict:
+    """Thống kê pool client Sheets cho /stats"""
+    stats = dict(SHEETS_CLIENT_POOL['stats'])
+    credentials = SHEETS_CLIENT_POOL['credentials']
+    stats['token_expiry'] = credentials.expiry.isoformat() if credentials is not None and credentials.expiry else None
+    return stats
+
+# ============================================
+# BỘ ĐIỀU PHỐI QUOTA GOOGLE SHEETS
+# Mọi request Sheets đi qua sheets_execute(): token bucket theo quota/phút,
+# ưu tiên ghi đơn hàng > tra cứu khi chat > lưu/đồng bộ nền, gộp các lần đọc trùng
+# ============================================
+
+SHEETS_PRIORITY_ORDER = 0       # Ghi đơn hàng
+SHEETS_PRIORITY_LOOKUP = 1      # Tra cứu khi đang trả lời khách
+SHEETS_PRIORITY_BACKGROUND = 2  # Lưu context, đồng bộ định kỳ, dọn dẹp
+SHEETS_PRIORITY_NAMES = ("orders", "lookups", "background")
+
+class SheetsQuotaTimeout(Exception):
+    """Chờ quota Sheets quá lâu (chỉ với mức ưu tiên có giới hạn thời gian chờ)"""
+
+def _sheets_bucket(quota_per_minute: int) -> dict:
+    # Quota Sheets tính theo service account, chia đều cho các worker gunicorn
+    workers = max(1, int(os.getenv("GUNICORN_WORKERS", "2")))
+    capacity = max(1.0, quota_per_minute / workers)
+    return {
+        'capacity': capacity,
+        'tokens': capacity,
+        'rate': capacity / 60.0,  # token/giây
+        'updated': time.time(),
+        'used': deque(),          # thời điểm các request trong 60 giây gần nhất
+        'waiting': [0, 0, 0]      # số thread đang chờ theo mức ưu tiên
+    }
+
+SHEETS_SCHEDULER = {
+    'buckets': {
+        'read': _sheets_bucket(int(os.getenv("SHEETS_READ_QUOTA_PER_MINUTE", "60"))),
+        'write': _sheets_bucket(int(os.getenv("SHEETS_WRITE_QUOTA_PER_MINUTE", "60")))
+    },
+    'reserve': (0.0, 0.1, 0.3),    # phần bucket mỗi mức phải chừa lại cho mức cao hơn
+    'timeouts': (None, 10, None),  # giây chờ tối đa (None = chờ đến khi có quota)
+    'max_retries': 3,              # số lần thử lại khi Google trả 429
+    'cond': threading.Condition(),
+    'inflight': {},                # request đọc đang chạy -> _SheetsCall (gộp đọc trùng)
+    'inflight_lock': threading.Lock(),
+    'stats': {name: {
+        'requests': 0,
+        'merged': 0,
+        'throttled': 0,
+        'retries': 0,
+        'timeouts': 0,
+        'errors': 0,
+        'wait_ms': 0.0
+    } for name in SHEETS_PRIORITY_NAMES}
+}
+
+class _SheetsCall:
+    """
+    1 request đọc đang chạy, các thread đọc cùng range chờ chung kết quả.
+    result không ai được sửa: mỗi thread (kể cả thread gọi API) nhận bản sao riêng khi có thread chờ chung
+    """
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0  # tăng dưới inflight_lock, chốt khi call bị bỏ khỏi inflight
+
+def _refill_sheets_bucket(bucket: dict, now: float):
+    bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+    bucket['updated'] = now
+    used = bucket['used']
+    while used and now - used[0] > 60:
+        used.popleft()
+
+def _acquire_sheets_token(kind: str, priority: int):
+    """Lấy 1 token; mức thấp chờ khi còn mức cao hơn đang chờ hoặc bucket chạm phần dự trữ"""
+    sched = SHEETS_SCHEDULER
+    bucket = sched['buckets'][kind]
+    stats = sched['stats'][SHEETS_PRIORITY_NAMES[priority]]
+    floor = bucket['capacity'] * sched['reserve'][priority]
+    timeout = sched['timeouts'][priority]
+    started = time.time()
+
+    with sched['cond']:
+        bucket['waiting'][priority] += 1
+        try:
+            while True:
+                now = time.time()
+                _refill_sheets_bucket(bucket, now)
+                if bucket['tokens'] - 1 >= floor and not any(bucket['waiting'][:priority]):
+                    bucket['tokens'] -= 1
+                    bucket['used'].append(now)
+                    break
+                waited = now - started
+                if timeout is not None and waited >= timeout:
+                    stats['timeouts'] += 1
+                    raise SheetsQuotaTimeout(f"Chờ quota Sheets ({kind}) quá {timeout}s")
+                wait = max(0.05, (floor + 1 - bucket['tokens']) / bucket['rate'])
+                if timeout is not None:
+                    wait = min(wait, timeout - waited)
+                sched['cond'].wait(wait)
+        finally:
+            bucket['waiting'][priority] -= 1
+            sched['cond'].notify_all()
+
+    stats['wait_ms'] += (time.time() - started) * 1000
+
+def _execute_with_quota(request, kind: str, priority: int):
+    sched = SHEETS_SCHEDULER
+    stats = sched['stats'][SHEETS_PRIORITY_NAMES[priority]]
+    for attempt in range(sched['max_retries'] + 1):
+        _acquire_sheets_token(kind, priority)
+        stats['requests'] += 1
+        try:
+            return request.execute()
+        except Exception as e:
+            status = getattr(getattr(e, 'resp', None), 'status', None)
+            if status != 429 or attempt == sched['max_retries']:
+                stats['errors'] += 1
+                raise
+            stats['throttled'] += 1
+            stats['retries'] += 1
+            # Google báo hết quota: xả bucket để mọi thread cùng giảm tốc
+            with sched['cond']:
+                sched['buckets'][kind]['tokens'] = 0
+            delay = min(2 ** attempt, 16)
+            print(f"[SHEETS QUOTA] 429 ({SHEETS_PRIORITY_NAMES[priority]}), thử lại sau {delay}s")
+            time.sleep(delay)
+
+def sheets_execute(request, priority: int = SHEETS_PRIORITY_BACKGROUND):
+    """
+    Thực thi 1 request Google Sheets qua bộ điều phối quota.
+    Các request đọc giống hệt nhau (cùng URI) đang chạy đồng thời được gộp làm 1.
+    """
+    sched = SHEETS_SCHEDULER
+    method = getattr(request, 'method', 'POST')
+    kind = 'read' if method == 'GET' else 'write'
+    uri = getattr(request, 'uri', None)
+
+    if kind != 'read' or not uri:
+        return _execute_with_quota(request, kind, priority)
+
+    key = (method, uri)
+    with sched['inflight_lock']:
+        call = sched['inflight'].get(key)
+        owner = call is None
+        if owner:
+            call = sched['inflight'][key] = _SheetsCall()
+        else:
+            call.waiters += 1
+
+    if not owner:
+        sched['stats'][SHEETS_PRIORITY_NAMES[priority]]['merged'] += 1
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        # Bản sao riêng: caller có thể sửa dữ liệu trả về
+        return copy.deepcopy(call.result)
+
+    try:
+        call.result = _execute_with_quota(request, kind, priority)
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with sched['inflight_lock']:
+            sched['inflight'].pop(key, None)
+        call.done.set()
+
+    # Không còn thread nào gộp được vào call này: có thread chờ thì giữ nguyên bản gốc cho chúng copy
+    if call.waiters:
+        return copy.deepcopy(call.result)
+    return call.result
+
+def get_sheets_scheduler_stats() -> dict:
+    """Mức dùng quota và thống kê theo mức ưu tiên cho /stats"""
+    sched = SHEETS_SCHEDULER
+    now = time.time()
+    stats = {'buckets': {}, 'priorities': {}}
+    with sched['cond']:
+        for kind, bucket in sched['buckets'].items():
+            _refill_sheets_bucket(bucket, now)
+            stats['buckets'][kind] = {
+                'quota_per_minute': round(bucket['capacity'], 1),
+                'tokens': round(bucket['tokens'], 1),
+                'used_last_minute': len(bucket['used']),
+                'usage_pct': round(len(bucket['used']) / bucket['capacity'] * 100, 1),
+                'waiting': dict(zip(SHEETS_PRIORITY_NAMES, bucket['waiting']))
+            }
+    for name, priority_stats in sched['stats'].items():
+        priority_stats = dict(priority_stats)
+        priority_stats['wait_ms'] = round(priority_stats['wait_ms'], 1)
+        stats['priorities'][name] = priority_stats
+    return stats
+
 def write_order_to_google_sheet_api(order_data: dict):
     """Ghi đơn hàng vào Google Sheets với thông tin giá chính xác"""
     service = get_google_sheets_service()
@@ -5505,7 +8804,7 @@ def write_order_to_google_sheet_api(order_data: dict):
             ms = order_data.get("ms", "")
             if ms and ms in PRODUCTS:
                 product = PRODUCTS[ms]
-                unit_price_float = extract_price_int(product.get("Gia", "")) or 0
+                unit_price_float = product.get("gia_int") or 0
                 quantity_int = int(quantity) if quantity else 1
                 total_price_float = unit_price_float * quantity_int
                 print(f"[GOOGLE SHEET FALLBACK] Dùng giá fallback: {unit_price_float} x {quantity_int} = {total_price_float}")
@@ -5553,7 +8852,12 @@ def write_order_to_google_sheet_api(order_data: dict):
             body={"values": [new_row]}
         )
         
-        response = request.execute()
+        response = sheets_execute(request, SHEETS_PRIORITY_ORDER)
+        
+        # Cập nhật index lịch sử đơn hàng ngay, không chờ lần đồng bộ sau
+        add_order_to_history_index(new_row)
+        remember_known_identity(order_data.get("uid"), order_data.get("phone"))
+        
         print(f"✅ ĐÃ GHI ĐƠN HÀNG VÀO GOOGLE SHEET THÀNH CÔNG!")
         print(f"   - Mã đơn: {order_id}")
         print(f"   - Sản phẩm: {order_data.get('product_name', '')}")
@@ -5715,23 +9019,8 @@ def handle_poscake_order_event(event_type: str, data: dict):
     phone = customer.get('phone', '')
     email = customer.get('email', '')
     
-    recipient_id = None
-    
-    # Tìm user_id từ số điện thoại trong context
-    for uid, ctx in USER_CONTEXT.items():
-        # Kiểm tra order_data hoặc số điện thoại trong context
-        user_phone = ctx.get("order_data", {}).get("phone", "")
-        if user_phone and user_phone == phone:
-            recipient_id = uid
-            break
-    
-    # Nếu không tìm thấy, thử tìm bằng email
-    if not recipient_id and email:
-        for uid, ctx in USER_CONTEXT.items():
-            user_email = ctx.get("order_data", {}).get("email", "")
-            if user_email and user_email == email:
-                recipient_id = uid
-                break
+    # Tìm user_id từ số điện thoại, rồi email (index, cả user đã bị evict khỏi RAM)
+    recipient_id = find_uid_by_contact(phone, email)
     
     if recipient_id:
         # Chuẩn bị dữ liệu đơn hàng
@@ -6028,8 +9317,7 @@ def messenger_order():
     row = PRODUCTS[ms]
     
     # Lấy thông tin sản phẩm với fallback nhanh
-    images_field = row.get("Images", "")
-    urls = parse_image_urls(images_field)
+    urls = row.get("image_urls", [])
     default_image = urls[0] if urls else ""
     
     # Sử dụng base64 placeholder để tăng tốc độ load ban đầu
@@ -6047,13 +9335,10 @@ def messenger_order():
     if color_field:
         colors = [c.strip() for c in color_field.split(",") if c.strip()]
     
-    price_str = row.get("Gia", "0")
-    price_int = extract_price_int(price_str) or 0
+    price_int = row.get("gia_int") or 0
     
     # Tên sản phẩm (xóa mã nếu có)
-    product_name = row.get('Ten', '')
-    if f"[{ms}]" in product_name or ms in product_name:
-        product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+    product_name = row.get('display_name', '')
     
     # GỬI SỰ KIỆN INITIATECHECKOUT THÔNG MINH (BẤT ĐỒNG BỘ)
     try:
@@ -6775,9 +10060,7 @@ def api_submit_order():
         
         # Lấy thông tin sản phẩm
         product = PRODUCTS[ms]
-        product_name = product.get('Ten', '')
-        if f"[{ms}]" in product_name or ms in product_name:
-            product_name = product_name.replace(f"[{ms}]", "").replace(ms, "").strip()
+        product_name = product.get('display_name', '')
         
         # Tạo địa chỉ đầy đủ
         full_address = f"{data.get('addressDetail', '')}, {data.get('ward', '')}, {data.get('district', '')}, {data.get('province', '')}"
@@ -6793,67 +10076,36 @@ def api_submit_order():
         color = data.get("color", "Mặc định")
         size = data.get("size", "Mặc định")
         
+        # Tra index biến thể: chính xác -> chỉ màu -> chỉ size -> biến thể đầu tiên
+        variant_index = product.get("variant_index") or build_variant_index(product.get("variants", []))
+        color_key = normalize_variant_key(color)
+        size_key = normalize_variant_key(size)
+        
         # TRƯỚC HẾT: Tìm biến thể CHÍNH XÁC theo màu và size
-        for variant in product.get("variants", []):
-            variant_color = variant.get("mau", "").strip()
-            variant_size = variant.get("size", "").strip()
-            
-            # So sánh chính xác
-            color_match = False
-            size_match = False
-            
-            # So sánh màu
-            if color == "Mặc định":
-                color_match = (variant_color == "" or variant_color is None or variant_color == "Mặc định")
-            else:
-                color_match = (variant_color.lower() == color.lower())
-            
-            # So sánh size
-            if size == "Mặc định":
-                size_match = (variant_size == "" or variant_size is None or variant_size == "Mặc định")
-            else:
-                size_match = (variant_size.lower() == size.lower())
-            
-            if color_match and size_match:
-                unit_price = variant.get("gia", 0)
-                found_exact_variant = True
-                print(f"[PRICE MATCH] Tìm thấy biến thể chính xác: màu='{variant_color}', size='{variant_size}', giá={unit_price}")
-                break
+        variant = variant_index['exact'].get((color_key, size_key))
+        if variant:
+            unit_price = variant.get("gia", 0)
+            found_exact_variant = True
+            print(f"[PRICE MATCH] Tìm thấy biến thể chính xác: màu='{variant.get('mau', '')}', size='{variant.get('size', '')}', giá={unit_price}")
         
         # NẾU KHÔNG TÌM THẤY BIẾN THỂ CHÍNH XÁC
         if not found_exact_variant:
             print(f"[PRICE WARNING] Không tìm thấy biến thể chính xác cho màu='{color}', size='{size}'")
             
             # THỬ 1: Tìm biến thể chỉ khớp màu (bỏ qua size)
-            for variant in product.get("variants", []):
-                variant_color = variant.get("mau", "").strip()
-                
-                if color == "Mặc định":
-                    color_match = (variant_color == "" or variant_color is None or variant_color == "Mặc định")
-                else:
-                    color_match = (variant_color.lower() == color.lower())
-                
-                if color_match:
-                    unit_price = variant.get("gia", 0)
-                    print(f"[PRICE FALLBACK 1] Dùng giá theo màu: {color} -> {unit_price}")
-                    found_exact_variant = True
-                    break
+            variant = variant_index['by_color'].get(color_key)
+            if variant:
+                unit_price = variant.get("gia", 0)
+                print(f"[PRICE FALLBACK 1] Dùng giá theo màu: {color} -> {unit_price}")
+                found_exact_variant = True
             
             # THỬ 2: Tìm biến thể chỉ khớp size (bỏ qua màu)
             if not found_exact_variant:
-                for variant in product.get("variants", []):
-                    variant_size = variant.get("size", "").strip()
-                    
-                    if size == "Mặc định":
-                        size_match = (variant_size == "" or variant_size is None or variant_size == "Mặc định")
-                    else:
-                        size_match = (variant_size.lower() == size.lower())
-                    
-                    if size_match:
-                        unit_price = variant.get("gia", 0)
-                        print(f"[PRICE FALLBACK 2] Dùng giá theo size: {size} -> {unit_price}")
-                        found_exact_variant = True
-                        break
+                variant = variant_index['by_size'].get(size_key)
+                if variant:
+                    unit_price = variant.get("gia", 0)
+                    print(f"[PRICE FALLBACK 2] Dùng giá theo size: {size} -> {unit_price}")
+                    found_exact_variant = True
             
             # THỬ 3: Lấy giá đầu tiên từ danh sách biến thể
             if not found_exact_variant and product.get("variants"):
@@ -6863,7 +10115,7 @@ def api_submit_order():
         
         # CUỐI CÙNG: Nếu vẫn không có giá, dùng giá chung của sản phẩm
         if unit_price == 0:
-            unit_price = extract_price_int(product.get("Gia", "")) or 0
+            unit_price = product.get("gia_int") or 0
             print(f"[PRICE FALLBACK 4] Dùng giá chung sản phẩm: {unit_price}")
         
         # Tính tổng tiền CHÍNH XÁC
@@ -6904,6 +10156,7 @@ def api_submit_order():
                     "address": full_address,
                     "last_order_time": time.time()
                 }
+                index_user_contact(uid, USER_CONTEXT[uid]["order_data"])
         
         # Tạo order ID
         order_id = f"ORD{int(time.time())}_{uid[-4:] if uid else '0000'}"
@@ -7038,21 +10291,8 @@ def api_get_variant_info():
     
     product = PRODUCTS[ms]
     
-    # Tìm biến thể phù hợp
-    target_variant = None
-    for variant in product.get("variants", []):
-        variant_color = variant.get("mau", "").strip().lower()
-        variant_size = variant.get("size", "").strip().lower()
-        
-        input_color = color.strip().lower()
-        input_size = size.strip().lower()
-        
-        color_match = (not input_color) or (variant_color == input_color) or (input_color == "mặc định" and not variant_color)
-        size_match = (not input_size) or (variant_size == input_size) or (input_size == "mặc định" and not variant_size)
-        
-        if color_match and size_match:
-            target_variant = variant
-            break
+    # Tìm biến thể phù hợp (tra index, không duyệt list)
+    target_variant = find_variant(product, color, size)
     
     # Nếu không tìm thấy biến thể phù hợp, dùng thông tin chung
     if target_variant:
@@ -7061,13 +10301,12 @@ def api_get_variant_info():
         variant_price_raw = target_variant.get("gia_raw", "")
     else:
         variant_image = ""
-        variant_price = extract_price_int(product.get("Gia", "")) or 0
+        variant_price = product.get("gia_int") or 0
         variant_price_raw = product.get("Gia", "")
     
     # Nếu không có ảnh biến thể, lấy ảnh đầu tiên của sản phẩm
     if not variant_image:
-        images_field = product.get("Images", "")
-        urls = parse_image_urls(images_field)
+        urls = product.get("image_urls", [])
         variant_image = urls[0] if urls else ""
     
     return {
@@ -7088,9 +10327,9 @@ def api_get_variant_info():
 def clear_user_context(user_id):
     """Xóa context của user khỏi cả memory và Google Sheets"""
     try:
-        # Xóa khỏi memory
-        if user_id in USER_CONTEXT:
-            del USER_CONTEXT[user_id]
+        # Xóa khỏi memory, warm tier và hàng đợi lưu
+        USER_CONTEXT.delete(user_id)
+        discard_context_save(user_id)
         
         # Xóa khỏi Google Sheets
         delete_user_context_from_sheets(user_id)
@@ -7222,7 +10461,10 @@ def stats():
     stats_data = {
         "products": {
             "total": len(PRODUCTS),
-            "loaded_at": time.ctime(LAST_LOAD) if LAST_LOAD > 0 else "Never"
+            "loaded_at": time.ctime(LAST_LOAD) if LAST_LOAD > 0 else "Never",
+            "refresh": get_catalog_refresh_stats(),
+            "snapshot": get_catalog_snapshot_stats(),
+            "price_analysis_cache": get_price_analysis_cache_stats()
         },
         "users": {
             "in_memory": len(USER_CONTEXT),
@@ -7233,6 +10475,18 @@ def stats():
             "message_queue": MESSAGE_QUEUE.qsize(),
             "facebook_queue": FACEBOOK_EVENT_QUEUE.qsize()
         },
+        "context_store": USER_CONTEXT.get_stats(),
+        "user_leases": get_user_lease_stats(),
+        "order_index": get_order_index_stats(),
+        "contact_index": get_contact_index_stats(),
+        "known_identity_filter": get_known_identity_filter_stats(),
+        "context_write_behind": get_context_write_behind_stats(),
+        "sheets_client": get_sheets_client_stats(),
+        "sheets_quota": get_sheets_scheduler_stats(),
+        "context_codec": get_context_codec_stats(),
+        "user_context_sync": get_user_context_sync_stats(),
+        "context_compaction": get_context_compaction_stats(),
+        "leader": get_leader_stats(),
         "workers": {
             "message_worker": MESSAGE_WORKER_RUNNING,
             "facebook_worker": FACEBOOK_WORKER_RUNNING,
@@ -7294,6 +10548,15 @@ def initialize_workers_once():
     context_save_thread = threading.Thread(target=periodic_context_save, daemon=True)
     context_save_thread.start()
     
+    # Giành lease leader cho các job singleton (keep-alive, compaction, lưu full)
+    start_leader_election()
+    
+    # Khởi động worker compaction sheet UserContext
+    start_context_compaction_worker()
+    
+    # Theo dõi file catalog dùng chung (leader tải sheet + publish)
+    start_shared_catalog_worker()
+    
     # Khởi tạo Google Sheets nếu cần
     if GOOGLE_SHEET_ID and GOOGLE_SHEETS_CREDENTIALS_JSON:
         try:
@@ -7307,6 +10570,30 @@ def initialize_workers_once():
 
 # Khởi động workers ngay khi app start
 initialize_workers_once()
+
+def _restart_workers_after_fork():
+    """
+    gunicorn preload_app: app được import ở master rồi mới fork worker.
+    Thread không sống qua fork và cờ running kế thừa từ master là sai -> mỗi worker khởi động lại
+    workers của mình (lease, compaction, catalog dùng chung, lưu context, keep-alive)
+    """
+    global WORKERS_INITIALIZED, MESSAGE_WORKER_RUNNING, FACEBOOK_WORKER_RUNNING
+    WORKERS_INITIALIZED = False
+    MESSAGE_WORKER_RUNNING = False
+    FACEBOOK_WORKER_RUNNING = False
+    SHEETS_CACHE['running'] = False
+    CONTEXT_WRITE_BEHIND['running'] = False
+
+    def start_in_worker():
+        initialize_workers_once()
+        if KOYEB_KEEP_ALIVE_ENABLED:
+            # Job schedule kế thừa từ master -> xóa để không ping 2 lần
+            schedule.clear()
+            start_keep_alive_scheduler()
+
+    threading.Thread(target=start_in_worker, daemon=True).start()
+
+os.register_at_fork(after_in_child=_restart_workers_after_fork)
     
 # ============================================
 # STARTUP OPTIMIZATION FOR KOYEB
@@ -0,0 +1,600 @@
+"""
+Benchmark các phần tối ưu của app.py (chạy tay, không chạy trong production).
+
+    python benchmarks.py context-memory --users 10000 100000
+    python benchmarks.py context-contention --threads 1 8 32 128
+    python benchmarks.py catalog-parse --rows 10000 100000
+    python benchmarks.py catalog-warm-start --rows 10000 100000
+    python benchmarks.py catalog-shared --rows 100000 --workers 4
+    python benchmarks.py catalog-memory --rows 10000 100000
+"""
+import os
+import sys
+import gc
+import functools
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import http.server
+import threading
+import tracemalloc
+import csv
+import signal
+
+# Tắt keep-alive / warm-up khi import app
+os.environ.setdefault("KOYEB_KEEP_ALIVE", "false")
+os.environ.setdefault("KOYEB_AUTO_WARMUP", "false")
+os.environ.setdefault("CONTEXT_DB_PATH", "")
+
+import app
+
+
+def legacy_user_context():
+    """Context dạng dict 20 key như trước khi có UserContext"""
+    return {
+        "last_msg_time": 0,
+        "last_ms": None,
+        "order_state": None,
+        "order_data": {},
+        "processing_lock": False,
+        "real_message_count": 0,
+        "product_history": [],
+        "conversation_history": [],
+        "referral_source": None,
+        "referral_payload": None,
+        "last_retailer_id": None,
+        "catalog_view_time": 0,
+        "has_sent_first_carousel": False,
+        "idempotent_postbacks": {},
+        "processed_message_mids": {},
+        "last_processed_text": "",
+        "poscake_orders": [],
+        "last_updated": time.time(),
+        "dirty": False,
+        "last_saved": 0
+    }
+
+
+def fill_context(ctx, i):
+    """Dữ liệu điển hình của 1 user đã chat vài lượt"""
+    ctx["last_ms"] = f"MS{i % 500:06d}"
+    ctx["real_message_count"] = 3
+    ctx["referral_source"] = "ADS_POST"
+    ctx["last_msg_time"] = time.time()
+    for k in range(3):
+        app.push_product_history(ctx, f"MS{(i + k) % 500:06d}")
+    for k in range(2):
+        app.push_conversation_turn(ctx, "còn size M không shop", "Dạ còn ạ")
+
+
+def fill_legacy_context(ctx, i):
+    """Như fill_context nhưng cập nhật history theo cách cũ (list + slicing)"""
+    ctx["last_ms"] = f"MS{i % 500:06d}"
+    ctx["real_message_count"] = 3
+    ctx["referral_source"] = "ADS_POST"
+    ctx["last_msg_time"] = time.time()
+    for k in range(3):
+        ms = f"MS{(i + k) % 500:06d}"
+        if ms in ctx["product_history"]:
+            ctx["product_history"].remove(ms)
+        ctx["product_history"].insert(0, ms)
+        ctx["product_history"] = ctx["product_history"][:5]
+    for k in range(2):
+        ctx["conversation_history"].append({"role": "user", "content": "còn size M không shop"})
+        ctx["conversation_history"].append({"role": "assistant", "content": "Dạ còn ạ"})
+        ctx["conversation_history"] = ctx["conversation_history"][-10:]
+
+
+def measure(factory, fill, users):
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    contexts = []
+    for i in range(users):
+        ctx = factory()
+        fill(ctx, i)
+        contexts.append(ctx)
+    elapsed = time.perf_counter() - started
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del contexts
+    gc.collect()
+    return after - before, peak - before, elapsed
+
+
+def bench_context_memory(args):
+    print(f"{'users':>8} {'kiểu':<12} {'bytes/user':>11} {'tổng MB':>9} {'peak MB':>9} {'tạo (s)':>8}")
+    for users in args.users:
+        results = {}
+        for name, factory, fill in (("dict", legacy_user_context, fill_legacy_context),
+                                    ("UserContext", app.default_user_context, fill_context)):
+            used, peak, elapsed = measure(factory, fill, users)
+            results[name] = used
+            print(f"{users:>8} {name:<12} {used / users:>11.0f} {used / 1048576:>9.1f} "
+                  f"{peak / 1048576:>9.1f} {elapsed:>8.2f}")
+        saved = 1 - results["UserContext"] / results["dict"]
+        print(f"{users:>8} {'tiết kiệm':<12} {saved:>11.0%}")
+
+
+def run_contention(store, threads, ops_per_thread, users):
+    """Mỗi thread đọc/ghi context user ngẫu nhiên; 1 thread nền liên tục duyệt items()"""
+    latencies = []
+    start_barrier = threading.Barrier(threads + 1)
+    stop = threading.Event()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        local = []
+        start_barrier.wait()
+        for _ in range(ops_per_thread):
+            uid = f"user{rnd.randrange(users)}"
+            t0 = time.perf_counter()
+            lease = app.try_acquire_user_lease(uid, "bench")
+            ctx = store[uid]
+            if rnd.random() < 0.2:
+                ctx["real_message_count"] = ctx["real_message_count"] + 1
+            if lease:
+                lease.release()
+            local.append(time.perf_counter() - t0)
+        latencies.extend(local)
+
+    def background():
+        while not stop.is_set():
+            sum(1 for _, ctx in store.items() if ctx.get("dirty"))
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    scanner = threading.Thread(target=background)
+    for t in workers:
+        t.start()
+    scanner.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    scanner.join()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+    return threads * ops_per_thread / elapsed, p99
+
+
+def bench_context_contention(args):
+    print(f"{'threads':>8} {'shards':>7} {'ops/s':>10} {'p99 (µs)':>9}")
+    for threads in args.threads:
+        for shards in (1, args.shards):
+            store = app.TieredContextStore(None, memory_budget=1 << 40, shards=shards)
+            ops, p99 = run_contention(store, threads, args.ops // threads or 1, args.users)
+            print(f"{threads:>8} {shards:>7} {ops:>10.0f} {p99:>9.1f}")
+
+
+CATALOG_HEADER = ["Mã sản phẩm", "Tên sản phẩm", "Giá bán", "Images", "Videos", "Tồn kho",
+                  "Mô tả", "màu (Thuộc tính)", "size (Thuộc tính)", "Thuộc tính", "Website"]
+
+
+def write_synthetic_catalog(path, rows, variants_per_product=4):
+    """CSV giống sheet thật: mỗi sản phẩm vài dòng variant màu/size, mô tả dài, 3 ảnh"""
+    colors = ["Đỏ", "Xanh", "Đen", "Trắng", "Be"]
+    sizes = ["S", "M", "L", "XL"]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CATALOG_HEADER)
+        for i in range(rows):
+            n = i // variants_per_product
+            images = ",".join(f"https://cdn.example.com/p{n}/{k}.jpg" for k in range(3))
+            writer.writerow([
+                f"MS{n:06d}", f"[MS{n:06d}] Áo thun cotton mẫu {n}", f"{199 + n % 50}.000", images, "",
+                str(i % 20), "Chất liệu cotton co giãn 4 chiều, form rộng, thấm hút tốt. " * 4,
+                colors[i % len(colors)], sizes[i % len(sizes)], "", f"https://shop.example.com/p/{n}",
+            ])
+
+
+def legacy_parse_products(content):
+    """Parse catalog như trước: cả file -> splitlines -> DictReader + dict(row) mỗi dòng + FullRow"""
+    products = {}
+    for raw_row in csv.DictReader(content.splitlines()):
+        row = dict(raw_row)
+        ms = (row.get("Mã sản phẩm") or "").strip()
+        ten = (row.get("Tên sản phẩm") or "").strip()
+        if not ms or not ten:
+            continue
+        gia_raw = (row.get("Giá bán") or "").strip()
+        images = (row.get("Images") or "").strip()
+        tonkho_raw = (row.get("Tồn kho") or row.get("Có thể bán") or "").strip()
+        mau = (row.get("màu (Thuộc tính)") or "").strip()
+        size = (row.get("size (Thuộc tính)") or "").strip()
+        try:
+            tonkho_int = int(str(tonkho_raw)) if str(tonkho_raw).strip() else None
+        except Exception:
+            tonkho_int = None
+        variant_images = app.parse_image_urls(images)
+        if ms not in products:
+            products[ms] = {
+                "MS": ms, "Ten": ten, "Gia": gia_raw, "MoTa": (row.get("Mô tả") or "").strip(),
+                "Images": images, "Videos": (row.get("Videos") or "").strip(), "Tồn kho": tonkho_raw,
+                "màu (Thuộc tính)": mau, "size (Thuộc tính)": size,
+                "Thuộc tính": (row.get("Thuộc tính") or "").strip(),
+                "Website": (row.get("Website") or "").strip(),
+                "FullRow": row, "variants": [], "all_colors": set(), "all_sizes": set(),
+            }
+        p = products[ms]
+        p["variants"].append({
+            "mau": mau, "size": size, "gia": app.extract_price_int(gia_raw), "gia_raw": gia_raw,
+            "tonkho": tonkho_int if tonkho_int is not None else tonkho_raw,
+            "images": images, "variant_image": variant_images[0] if variant_images else "",
+        })
+        if mau:
+            p["all_colors"].add(mau)
+        if size:
+            p["all_sizes"].add(size)
+    return products
+
+
+def parse_legacy(path):
+    # Như r.text: đọc cả file thành 1 chuỗi rồi mới parse
+    with open(path, "rb") as f:
+        return legacy_parse_products(f.read().decode("utf-8"))
+
+
+def legacy_catalog_with_fields(path):
+    """Catalog dict như trước khi có Product/Variant: FullRow, set + chuỗi nối màu/size, variant dict 7 key"""
+    products = parse_legacy(path)
+    for ms, p in products.items():
+        p["màu (Thuộc tính)"] = ", ".join(sorted(p["all_colors"]))
+        p["size (Thuộc tính)"] = ", ".join(sorted(p["all_sizes"]))
+        p["image_urls"] = app.parse_image_urls(p["Images"])
+        p["video_urls"] = app.parse_image_urls(p["Videos"])
+        p["gia_int"] = app.extract_price_int(p["Gia"])
+        p["display_name"] = app.clean_product_name(p["Ten"], ms)
+        p["variant_index"] = app.build_variant_index(p["variants"])
+        p["search_text"], p["search_keywords"], p["search_colors"] = app.build_product_search_keywords(p)
+        p["content_hash"] = app.product_content_hash(p)
+    return products
+
+
+def parse_streaming(path):
+    # Như response.raw: stream bytes giải mã dần
+    with open(path, "rb", buffering=0) as f:
+        return app.parse_products_csv(app.open_catalog_stream(f))[0]
+
+
+def _read_status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def measure_parse_rss(parse, path):
+    """Chạy parse trong process con (fork) để peak RSS không lẫn giữa các lượt -> (giây, peak MB)"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        # Reset VmHWM về RSS hiện tại (Linux), peak đo được chỉ của lần parse này
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        baseline = _read_status_kb("VmRSS")
+        started = time.perf_counter()
+        products = parse(path)
+        elapsed = time.perf_counter() - started
+        peak = _read_status_kb("VmHWM") - baseline
+        os.write(write_fd, f"{elapsed} {peak} {len(products)}".encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        elapsed, peak, count = f.read().split()
+    os.waitpid(pid, 0)
+    return float(elapsed), int(peak) / 1024, int(count)
+
+
+def bench_catalog_parse(args):
+    print(f"{'rows':>8} {'parser':<10} {'products':>9} {'parse (s)':>10} {'peak RSS MB':>12}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "catalog.csv")
+            write_synthetic_catalog(path, rows)
+            results = {}
+            # Cả 2 bên cùng làm 1 việc: parse + trường tính sẵn + content_hash (streaming làm ngay trong lúc parse)
+            for name, parse in (("legacy", legacy_catalog_with_fields), ("streaming", parse_streaming)):
+                elapsed, peak, count = measure_parse_rss(parse, path)
+                results[name] = (elapsed, peak)
+                print(f"{rows:>8} {name:<10} {count:>9} {elapsed:>10.2f} {peak:>12.1f}")
+            (legacy_s, legacy_mb), (streaming_s, streaming_mb) = results["legacy"], results["streaming"]
+            if legacy_mb:
+                print(f"{rows:>8} {'tiết kiệm':<10} {'':>9} {1 - streaming_s / legacy_s:>10.0%} "
+                      f"{1 - streaming_mb / legacy_mb:>12.0%}")
+
+
+WARM_START_CHILD = """
+import sys, time
+sys.path.insert(0, {root!r})
+import benchmarks, app
+started = time.perf_counter()
+app.load_products()
+while {probe!r} not in app.PRODUCTS:
+    time.sleep(0.001)
+# stderr: stdout lẫn log của các thread nền trong app
+sys.stderr.write(f"READY {{time.perf_counter() - started}} {{app.get_catalog_snapshot_stats()['first_ready_source']}}\\n")
+"""
+
+
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Phục vụ CSV giả lập thay cho Google Sheet, không in log từng request"""
+
+    def log_message(self, *args):
+        pass
+
+
+def time_to_first_answer(url, snapshot_path, probe_ms):
+    """Boot 1 process mới, đo từ lúc gọi load_products tới khi tra được probe_ms -> (giây, nguồn)"""
+    env = dict(os.environ, SHEET_CSV_URL=url, CATALOG_SNAPSHOT_PATH=snapshot_path)
+    code = WARM_START_CHILD.format(root=os.path.dirname(os.path.abspath(__file__)), probe=probe_ms)
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=120).stderr
+    for line in output.splitlines():
+        if line.startswith("READY "):
+            _, elapsed, source = line.split()
+            return float(elapsed), source
+    raise RuntimeError("process con không báo READY")
+
+
+def bench_catalog_warm_start(args):
+    print(f"{'rows':>8} {'boot':<10} {'nguồn':<9} {'tới câu trả lời đầu (ms)':>24} {'snapshot KB':>12}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            write_synthetic_catalog(os.path.join(tmp, "catalog.csv"), rows)
+            handler = functools.partial(QuietHTTPRequestHandler, directory=tmp)
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_port}/catalog.csv"
+            snapshot_path = os.path.join(tmp, "catalog_snapshot.bin")
+            probe_ms = f"MS{(rows - 1) // 4:06d}"
+            try:
+                # Lần 1: chưa có snapshot -> tải + parse sheet (và ghi snapshot)
+                # Lần 2: có snapshot -> nạp từ đĩa, sheet làm mới ở nền
+                for boot in ("cold", "snapshot"):
+                    elapsed, source = time_to_first_answer(url, snapshot_path, probe_ms)
+                    size = os.path.getsize(snapshot_path) / 1024 if os.path.exists(snapshot_path) else 0
+                    print(f"{rows:>8} {boot:<10} {source:<9} {elapsed * 1000:>24.1f} {size:>12.0f}")
+            finally:
+                server.shutdown()
+
+
+def _read_pss_kb():
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+    return 0
+
+
+SCAN_DESCRIPTION = "ảnh chụp áo thun nữ màu đỏ cổ tròn, chất cotton, phong cách basic"
+
+
+def scan_catalog(items):
+    """1 vòng quét toàn catalog như find_product_by_image_description_enhanced"""
+    desc_lower = app.normalize_vietnamese(SCAN_DESCRIPTION.lower())
+    desc_keywords = app.extract_keywords_from_description(desc_lower)
+    best = None
+    for ms, product in items:
+        score = app.calculate_product_similarity_score(ms, product, desc_lower, desc_keywords)
+        if best is None or score > best[1]:
+            best = (ms, score)
+    return best
+
+
+def measure_workers_pss(load, workers, lookups, scan_items, scans):
+    """
+    Fork N worker cùng giữ catalog rồi đo PSS tăng thêm của từng worker
+    (trang dùng chung như file mmap được chia đều cho các process) -> tổng MB cả host.
+    Mỗi worker tra ngẫu nhiên rồi quét toàn catalog vài lần; trả về (MB cả host, ms trung bình mỗi vòng quét).
+    """
+    children = []
+    for _ in range(workers):
+        start_r, start_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(start_w)
+            os.close(done_r)
+            os.read(start_r, 1)  # chờ fork xong hết -> baseline ổn định
+            gc.collect()
+            baseline = _read_pss_kb()
+            catalog = load()
+            keys = list(catalog)
+            rnd = random.Random(os.getpid())
+            for _ in range(lookups):
+                catalog[rnd.choice(keys)]
+            started = time.perf_counter()
+            for _ in range(scans):
+                scan_catalog(scan_items(catalog))
+            scan_ms = (time.perf_counter() - started) * 1000 / max(scans, 1)
+            os.write(done_w, b"r")
+            os.read(start_r, 1)  # chờ mọi worker đã nạp xong mới đo
+            os.write(done_w, f"{_read_pss_kb() - baseline} {scan_ms:.1f}".encode())
+            os._exit(0)
+        os.close(start_r)
+        os.close(done_w)
+        children.append((pid, start_w, done_r))
+
+    for _, start_w, _ in children:
+        os.write(start_w, b"s")
+    for _, _, done_r in children:
+        os.read(done_r, 1)
+    for _, start_w, _ in children:
+        os.write(start_w, b"m")
+    total_kb = 0
+    scan_ms = []
+    for pid, start_w, done_r in children:
+        pss_kb, worker_scan_ms = os.read(done_r, 64).split()
+        total_kb += int(pss_kb)
+        scan_ms.append(float(worker_scan_ms))
+        os.close(start_w)
+        os.close(done_r)
+        os.waitpid(pid, 0)
+    return total_kb / 1024, sum(scan_ms) / len(scan_ms)
+
+
+def check_forked_worker_sync(snapshot_path, new_products):
+    """
+    Như gunicorn preload_app: master fork worker đúng lúc đang tải sheet (giữ refresh_lock) và 1 thread
+    đang giải mã sản phẩm (giữ lock của MappedCatalog), sau đó publish version mới.
+    Worker phải chuyển sang version đó qua sync_shared_catalog -> (số sản phẩm trước, sau, ms; None nếu kẹt)
+    """
+    app.CATALOG_SNAPSHOT["shared"] = True
+    app.PRODUCTS = app.MappedCatalog(snapshot_path, 512)
+    app.CATALOG_SNAPSHOT["file_stat"] = app._catalog_file_stat(snapshot_path)
+
+    locked = threading.Event()
+    release = threading.Event()
+
+    def download():
+        with app.CATALOG_REFRESH["refresh_lock"], app.PRODUCTS._lock:
+            locked.set()
+            release.wait()
+
+    threading.Thread(target=download, daemon=True).start()
+    locked.wait()
+    go_r, go_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(go_w)
+        os.close(done_r)
+        signal.alarm(10)  # lock kế thừa bị kẹt -> process con chết, không treo benchmark
+        os.read(go_r, 1)
+        before = len(app.PRODUCTS)
+        app.PRODUCTS[next(iter(app.PRODUCTS))]  # worker vẫn phục vụ từ mapping kế thừa trước khi sync
+        started = time.perf_counter()
+        deadline = time.time() + 5
+        while not app.sync_shared_catalog(force=True) and time.time() < deadline:
+            time.sleep(0.05)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for ms in app.PRODUCTS:
+            app.PRODUCTS[ms]
+        os.write(done_w, f"{before} {len(app.PRODUCTS)} {elapsed_ms:.1f}".encode())
+        os._exit(0)
+    os.close(go_r)
+    os.close(done_w)
+    release.set()
+    app.save_catalog_snapshot(new_products, {})
+    os.write(go_w, b"g")
+    with os.fdopen(done_r) as f:
+        result = f.read().split()
+    os.close(go_w)
+    os.waitpid(pid, 0)
+    app.PRODUCTS = {}
+    if not result:
+        return None
+    before, after, elapsed_ms = result
+    return int(before), int(after), float(elapsed_ms)
+
+
+def bench_catalog_shared(args):
+    print(f"{'rows':>8} {'workers':>8} {'kiểu':<12} {'PSS cả host MB':>15} {'MB/worker':>10} {'ms/vòng quét':>13}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, "catalog.csv")
+            snapshot_path = os.path.join(tmp, "catalog_snapshot.bin")
+            write_synthetic_catalog(csv_path, rows)
+            app.CATALOG_SNAPSHOT["path"] = snapshot_path
+            products = parse_streaming(csv_path)
+            app.save_catalog_snapshot(products, {})
+
+            # dict: mỗi worker tự tải/parse như trước; mmap: mọi worker map cùng 1 file,
+            # quét qua bảng field quét (mmap) hoặc giải mã từng sản phẩm qua LRU (mmap-decode, cách trước đây)
+            for name, load, scan_items in (
+                ("dict", lambda: parse_streaming(csv_path), app.catalog_scan_items),
+                ("mmap", lambda: app.MappedCatalog(snapshot_path, 512), app.catalog_scan_items),
+                ("mmap-decode", lambda: app.MappedCatalog(snapshot_path, 512), lambda catalog: catalog.items()),
+            ):
+                total, scan_ms = measure_workers_pss(load, args.workers, args.lookups, scan_items, args.scans)
+                print(f"{rows:>8} {args.workers:>8} {name:<12} {total:>15.1f} {total / args.workers:>10.1f} {scan_ms:>13.1f}")
+
+            # Worker fork lúc master đang tải phải thấy version publish sau khi fork
+            first_ms = next(iter(products))
+            result = check_forked_worker_sync(snapshot_path, {first_ms: products[first_ms]})
+            if result is None:
+                print(f"{rows:>8} worker fork lúc đang tải: LỖI (kẹt lock kế thừa từ master)")
+            else:
+                before, after, elapsed_ms = result
+                status = "OK" if after == 1 else "LỖI (vẫn dùng version cũ)"
+                print(f"{rows:>8} worker fork lúc đang tải: {before} -> {after} products sau {elapsed_ms:.1f}ms: {status}")
+
+
+def measure_catalog_memory(load, path):
+    """RAM còn giữ sau khi nạp catalog (tracemalloc) -> (bytes, số sản phẩm)"""
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    products = load(path)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = len(products)
+    del products
+    gc.collect()
+    return after - before, count
+
+
+def bench_catalog_memory(args):
+    print(f"{'rows':>8} {'kiểu':<14} {'products':>9} {'tổng MB':>9} {'bytes/product':>14}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "catalog.csv")
+            write_synthetic_catalog(path, rows)
+            results = {}
+            for name, load in (("dict+FullRow", legacy_catalog_with_fields), ("Product slots", parse_streaming)):
+                used, count = measure_catalog_memory(load, path)
+                results[name] = used
+                print(f"{rows:>8} {name:<14} {count:>9} {used / 1048576:>9.1f} {used / count:>14.0f}")
+            saved = 1 - results["Product slots"] / results["dict+FullRow"]
+            print(f"{rows:>8} {'tiết kiệm':<14} {'':>9} {saved:>9.0%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("context-memory", help="RAM cho mỗi user: dict cũ vs UserContext")
+    p.add_argument("--users", type=int, nargs="+", default=[10000, 100000])
+    p.set_defaults(func=bench_context_memory)
+
+    p = sub.add_parser("context-contention", help="Thông lượng USER_CONTEXT khi nhiều thread: 1 lock vs sharded")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32, 128])
+    p.add_argument("--shards", type=int, default=16)
+    p.add_argument("--ops", type=int, default=200000, help="tổng số thao tác mỗi lượt")
+    p.add_argument("--users", type=int, default=10000)
+    p.set_defaults(func=bench_context_contention)
+
+    p = sub.add_parser("catalog-parse", help="Thời gian + peak RSS parse catalog CSV (kèm trường tính sẵn + hash): cách cũ vs streaming")
+    p.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    p.set_defaults(func=bench_catalog_parse)
+
+    p = sub.add_parser("catalog-warm-start", help="Thời gian từ boot tới câu trả lời đúng đầu tiên: tải sheet vs snapshot")
+    p.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    p.set_defaults(func=bench_catalog_warm_start)
+
+    p = sub.add_parser("catalog-shared", help="RAM catalog cả host khi nhiều worker gunicorn: dict riêng vs mmap dùng chung")
+    p.add_argument("--rows", type=int, nargs="+", default=[100000])
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--lookups", type=int, default=2000, help="số lần tra sản phẩm ngẫu nhiên mỗi worker")
+    p.add_argument("--scans", type=int, default=5, help="số vòng quét toàn catalog (tìm theo mô tả ảnh) mỗi worker")
+    p.set_defaults(func=bench_catalog_shared)
+
+    p = sub.add_parser("catalog-memory", help="RAM catalog trong 1 process: dict + FullRow vs Product/Variant __slots__")
+    p.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    p.set_defaults(func=bench_catalog_memory)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())